@@ -63,6 +63,9 @@ def retry(m):
                 retries += 1
                 if retries >= MAX_RETRIES:
                     raise FuseOSError(EIO)
+                if args and isinstance(args[0], BaseRecord):
+                    # Changed by someone else or read from the record cache - saving the same record fails again
+                    args[0].reload()
     return wrappedM
 
 # Note: st_mode, st_gid and st_uid are at inode level
@@ -104,39 +107,56 @@ class BaseRecord:
         else:
             item = self.accessor.table.new_item(attrs=newAttrs)
             item.put()
+        self.accessor.invalidateMissing(path)
 
         self.record = item
         logging.getLogger("dynamo-fuse-record").debug("Read record %s, version %d", os.path.join(self.record["path"], self.record["name"]), self.record["version"])
-        self.record.save = BaseRecord.safeSave(self.record, self.record.save)
-        self.record.delete = BaseRecord.overrideDelete(self.record, self.record.delete)
+        self.record.save = BaseRecord.safeSave(self.record, self.record.save, accessor)
+        self.record.delete = BaseRecord.overrideDelete(self.record, self.record.delete, accessor)
 
     def init(self, accessor, path, record):
         self.accessor = accessor
         self.path = path
         self.record = record
         logging.getLogger("dynamo-fuse-record").debug("Read record %s, version %d", os.path.join(record["path"], record["name"]), record["version"])
-        self.record.save = self.safeSave(self.record, self.record.save)
-        self.record.delete = BaseRecord.overrideDelete(self.record, self.record.delete)
+        self.record.save = self.safeSave(self.record, self.record.save, accessor)
+        self.record.delete = BaseRecord.overrideDelete(self.record, self.record.delete, accessor)
 
     @staticmethod
-    def safeSave(record, origSave):
+    def safeSave(record, origSave, accessor):
         def safeSaveImpl(**kwargs):
-            logging.getLogger("dynamo-fuse-record").debug("Saving record %s, version %d", os.path.join(record["path"], record["name"]), record["version"])
+            path = os.path.join(record["path"], record["name"])
+            logging.getLogger("dynamo-fuse-record").debug("Saving record %s, version %d", path, record["version"])
             record.add_attribute("version", 1)
-            return origSave(expected_value={"version": record["version"]}, **kwargs)
+            try:
+                res = origSave(expected_value={"version": record["version"]}, **kwargs)
+            finally:
+                # Saved, or the cached copy is out of date
+                accessor.invalidateRecord(path)
+            # Keep the local copy in line with the stored version so the record can be saved again (e.g. by an open file handle)
+            dict.__setitem__(record, "version", record["version"] + 1)
+            return res
         return safeSaveImpl
 
     @staticmethod
-    def overrideDelete(record, origDelete):
+    def overrideDelete(record, origDelete, accessor):
         def deleteImpl(**kwargs):
             record['recordDeleted'] = True
-            logging.getLogger("dynamo-fuse-record").debug("Deleting record %s, version %d", os.path.join(record["path"], record["name"]), record["version"])
-            return origDelete(**kwargs)
+            path = os.path.join(record["path"], record["name"])
+            logging.getLogger("dynamo-fuse-record").debug("Deleting record %s, version %d", path, record["version"])
+            try:
+                return origDelete(**kwargs)
+            finally:
+                accessor.invalidateRecord(path)
         return deleteImpl
 
     def getRecord(self):
         return self.record
 
+    def reload(self, ignoreDeleted=False):
+        self.accessor.invalidateRecord(self.path)
+        self.record = self.accessor.getRecordOrThrow(self.path, ignoreDeleted=ignoreDeleted).record
+
     def delete(self, duringMove=False):
         self.record.delete()
 
@@ -147,7 +167,8 @@ class BaseRecord:
 
         self.delete(duringMove=True)
 
-    def cloneItem(self, path, attrsToPreserve=('type', 'st_nlink', 'st_size', 'st_ino', 'st_dev', 'st_rdev', 'st_mode', 'blockId', 'st_gid', 'st_uid', 'deleted', 'link')):
+    def cloneItem(self, path, attrsToPreserve=('type', 'st_nlink', 'st_size', 'st_ino', 'st_dev', 'st_rdev', 'st_mode', 'blockId', 'st_gid', 'st_uid', 'deleted', 'link',
+                                               'inline', 'inlineData', 'st_blksize', 'blockCodec', 'dedup', 'extentLog', 'stripes')):
         attrs=dict(self.record)
         del attrs['name']
         del attrs['path']
@@ -0,0 +1,120 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import logging
+
+class BlockCache(object):
+    """
+    LRU cache of block data, bounded by the total size of the cached data.
+    Entries are keyed by (blockId, blockNum, version) and only the latest version seen by this mount is kept for a block.
+    Like the disk cache, each entry is stamped with the version of the file record it was read with and is only used
+    for that version - a change made by another client is seen once the file record is re-read.
+    Our own writes replace the cached version, truncates and deletes drop the blocks. Entries older than `ttl` seconds
+    are re-read as well (0 - entries don't expire).
+    """
+    log = logging.getLogger("dynamo-fuse-block ")
+
+    def __init__(self, maxBytes, ttl=0):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.entries = OrderedDict() # (blockId, blockNum, version) -> (data, time, fileVersion), least recently used first
+        self.blocks = dict() # blockId -> {blockNum: version}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, blockId, blockNum, fileVersion=None):
+        """Returns (version, data) of the block or None, with fileVersion only if it was cached for that file version"""
+        if not self.maxBytes:
+            return None
+        with self.lock:
+            version = self.blocks.get(blockId, {}).get(blockNum, None)
+            if version is None:
+                self.misses += 1
+                return None
+            key = (blockId, blockNum, version)
+            (data, cachedTime, cachedFileVersion) = self.entries.pop(key)
+            if (self.ttl and time() - cachedTime > self.ttl) or \
+                    (fileVersion is not None and cachedFileVersion != fileVersion):
+                self.removeEntry(key, data)
+                self.misses += 1
+                return None
+            self.entries[key] = (data, cachedTime, cachedFileVersion)
+            self.hits += 1
+            return version, data
+
+    def put(self, blockId, blockNum, version, data, fileVersion=None):
+        if not self.maxBytes or len(data) > self.maxBytes:
+            return
+        with self.lock:
+            current = self.blocks.get(blockId, {}).get(blockNum, None)
+            if current is not None:
+                if current > version:
+                    return # Already have a newer one
+                key = (blockId, blockNum, current)
+                self.removeEntry(key, self.entries.pop(key)[0])
+
+            self.entries[(blockId, blockNum, version)] = (data, time(), fileVersion)
+            self.blocks.setdefault(blockId, {})[blockNum] = version
+            self.size += len(data)
+            while self.size > self.maxBytes:
+                (key, (evicted, unused, unused)) = self.entries.popitem(last=False)
+                self.removeEntry(key, evicted)
+                self.evictions += 1
+
+    def drop(self, blockId, blockNum):
+        with self.lock:
+            version = self.blocks.get(blockId, {}).get(blockNum, None)
+            if version is not None:
+                key = (blockId, blockNum, version)
+                self.removeEntry(key, self.entries.pop(key)[0])
+
+    def invalidate(self, blockId, fromBlockNum=0):
+        """Drops the cached blocks of blockId starting from fromBlockNum"""
+        with self.lock:
+            for (blockNum, version) in self.blocks.get(blockId, {}).items():
+                if blockNum >= fromBlockNum:
+                    key = (blockId, blockNum, version)
+                    self.removeEntry(key, self.entries.pop(key)[0])
+
+    def restamp(self, blockId, oldFileVersion, newFileVersion):
+        """Moves the blocks valid for oldFileVersion to newFileVersion - used after our own change of the file"""
+        with self.lock:
+            for (blockNum, version) in self.blocks.get(blockId, {}).items():
+                key = (blockId, blockNum, version)
+                (data, cachedTime, fileVersion) = self.entries[key]
+                if fileVersion == oldFileVersion:
+                    self.entries[key] = (data, cachedTime, newFileVersion)
+
+    def removeEntry(self, key, data):
+        (blockId, blockNum, unused) = key
+        self.size -= len(data)
+        versions = self.blocks[blockId]
+        del versions[blockNum]
+        if not versions:
+            del self.blocks[blockId]
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, blocks=len(self.entries), bytes=self.size)
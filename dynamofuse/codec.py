@@ -0,0 +1,56 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__ = 'Denis Mikhalkin'
+
+from errno import EIO
+from fuse import FuseOSError
+import bz2
+import logging
+import zlib
+
+codecLog = logging.getLogger("dynamo-fuse-block ")
+
+# Block codecs: name -> (compress, decompress)
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "zlib1": (lambda data: zlib.compress(data, 1), zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress)
+}
+
+def checkCodec(name):
+    if name and not name in CODECS:
+        raise ValueError("Unknown block codec %s, supported: %s" % (name, ", ".join(sorted(CODECS.keys()))))
+    return name
+
+def encodeBlock(codec, data):
+    """Returns (codec, payload) to store. codec is None if the data is stored as is (no codec or it didn't make it smaller)"""
+    if not codec or not data:
+        return None, data
+    payload = CODECS[codec][0](data)
+    if len(payload) >= len(data):
+        return None, data
+    return codec, payload
+
+def decodeBlock(codec, payload, rawSize):
+    if not codec in CODECS:
+        codecLog.error("Block codec %s is not supported", codec)
+        raise FuseOSError(EIO)
+    data = CODECS[codec][1](payload)
+    if len(data) != rawSize:
+        codecLog.error("Block decoded with %s has %d bytes instead of %d", codec, len(data), rawSize)
+        raise FuseOSError(EIO)
+    return data
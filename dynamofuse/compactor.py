@@ -0,0 +1,62 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from collections import OrderedDict
+from threading import Condition, Thread
+import logging
+import sys
+import traceback
+
+class ExtentCompactor(object):
+    """
+    Folds the logged writes of blocks into the blocks (see DeltaRecord) in a background thread,
+    once the logs grow past the limit. Blocks are compacted in the order they were scheduled, each once.
+    """
+    log = logging.getLogger("dynamo-fuse-block ")
+
+    def __init__(self, accessor):
+        self.accessor = accessor
+        self.pending = OrderedDict() # (blockId, blockNum) -> path
+        self.condition = Condition()
+        self.thread = None
+
+    def schedule(self, path, blockId, blockNum):
+        with self.condition:
+            self.pending[(blockId, blockNum)] = path
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                ((blockId, blockNum), path) = self.pending.popitem(last=False)
+            try:
+                record = self.accessor.getRecordOrThrow(path)
+                # The file may be gone or have new blocks by now
+                if not record.isFile() or record.record["blockId"] != blockId:
+                    continue
+                record.compactBlock(blockNum)
+            except Exception, e:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.log.error("compaction of block %d of %s failed: %s", blockNum, path, "".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
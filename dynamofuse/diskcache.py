@@ -0,0 +1,227 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from threading import Lock
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+class DiskBlockCache(object):
+    """
+    Persistent block cache in local memory-mapped files, so that it survives remounts.
+    Blocks are kept in pools of fixed size slots, one pool (and file) per slot size - e.g. the mount block size
+    and the largest block size - each with an equal share of maxBytes. A block goes to the pool with the smallest
+    slots it fits in.
+
+    A cached block is valid for the version of the file record it was read under. Changes of the file
+    by other clients always change the record version so they make the cached blocks invalid, our own writes
+    move the unchanged blocks to the new version (see restamp).
+    """
+
+    def __init__(self, fileName, maxBytes, blockSizes):
+        sizes = sorted(set(blockSizes))
+        # The pool of the smallest slots keeps the name of the single cache file of the previous versions
+        self.pools = [DiskSlotPool(fileName if not i else "%s.%d" % (fileName, size), maxBytes / len(sizes), size)
+                      for (i, size) in enumerate(sizes)]
+
+    def poolOf(self, blockId, blockNum):
+        for pool in self.pools:
+            if pool.has(blockId, blockNum):
+                return pool
+        return self.pools[0]
+
+    def get(self, blockId, blockNum, fileVersion):
+        """Returns (blockVersion, data) if the block is cached for this version of the file, None otherwise"""
+        return self.poolOf(blockId, blockNum).get(blockId, blockNum, fileVersion)
+
+    def put(self, blockId, blockNum, blockVersion, fileVersion, data):
+        target = None
+        for pool in self.pools:
+            if target is None and len(data) <= pool.blockSize:
+                target = pool
+            else:
+                # The block may have been cached with another size
+                pool.drop(blockId, blockNum)
+        if target is not None:
+            target.put(blockId, blockNum, blockVersion, fileVersion, data)
+
+    def drop(self, blockId, blockNum):
+        for pool in self.pools:
+            pool.drop(blockId, blockNum)
+
+    def invalidate(self, blockId, fromBlockNum=0):
+        for pool in self.pools:
+            pool.invalidate(blockId, fromBlockNum)
+
+    def restamp(self, blockId, oldFileVersion, newFileVersion):
+        """Moves the blocks valid for oldFileVersion to newFileVersion - used after our own change of the file"""
+        for pool in self.pools:
+            pool.restamp(blockId, oldFileVersion, newFileVersion)
+
+    def stats(self):
+        stats = [pool.stats() for pool in self.pools]
+        return dict((name, sum(poolStats[name] for poolStats in stats)) for name in ["hits", "misses", "blocks"])
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+class DiskSlotPool(object):
+    """
+    Slots of one size in a memory-mapped file.
+    The file is a header followed by fixed size slots, each slot holds one block with its own header
+    (blockId, blockNum, block version, file version, length, CRC). The index is rebuilt from the slot headers on mount.
+    Slots are reused round-robin when the file is full.
+    """
+    log = logging.getLogger("dynamo-fuse-block ")
+
+    MAGIC = "DynamoFS block cache 1"
+    FILE_HEADER = struct.Struct("<32sII") # magic, slot size, slot count
+    FILE_HEADER_SIZE = 4096
+    SLOT_MAGIC = "DFSB"
+    SLOT_HEADER = struct.Struct("<4sqqqIIH64s") # magic, block version, file version, blockNum, length, crc, blockId length, blockId
+    SLOT_HEADER_SIZE = 128
+    MAX_BLOCK_ID = 64
+
+    def __init__(self, fileName, maxBytes, blockSize):
+        self.fileName = fileName
+        self.blockSize = blockSize
+        self.slotSize = self.SLOT_HEADER_SIZE + blockSize
+        self.slotCount = max(1, maxBytes / self.slotSize)
+        self.slots = [None] * self.slotCount # slot -> (blockId, blockNum, blockVersion, fileVersion)
+        self.blocks = dict() # blockId -> {blockNum: slot}
+        self.nextSlot = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+        size = self.FILE_HEADER_SIZE + self.slotCount * self.slotSize
+        exists = os.path.exists(fileName)
+        self.file = open(fileName, "r+b" if exists else "w+b")
+        header = self.FILE_HEADER.pack(self.MAGIC, self.slotSize, self.slotCount)
+        if not exists or self.file.read(self.FILE_HEADER.size) != header:
+            self.log.info("Initializing disk block cache %s", fileName)
+            self.file.seek(0)
+            self.file.truncate(0)
+            self.file.write(header)
+        self.file.truncate(size)
+        self.file.flush()
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.load()
+
+    def load(self):
+        freeSlot = None
+        for slot in xrange(self.slotCount):
+            offset = self.slotOffset(slot)
+            (magic, blockVersion, fileVersion, blockNum, length, crc, idLength, blockId) = \
+                self.SLOT_HEADER.unpack_from(self.mm, offset)
+            if magic != self.SLOT_MAGIC:
+                if freeSlot is None: freeSlot = slot
+                continue
+            blockId = blockId[:idLength]
+            self.slots[slot] = (blockId, blockNum, blockVersion, fileVersion)
+            self.blocks.setdefault(blockId, {})[blockNum] = slot
+        self.nextSlot = freeSlot or 0
+        self.log.info("Disk block cache %s has %d blocks", self.fileName, self.slotCount - self.slots.count(None))
+
+    def slotOffset(self, slot):
+        return self.FILE_HEADER_SIZE + slot * self.slotSize
+
+    def has(self, blockId, blockNum):
+        with self.lock:
+            return blockNum in self.blocks.get(blockId, {})
+
+    def get(self, blockId, blockNum, fileVersion):
+        """Returns (blockVersion, data) if the block is cached for this version of the file, None otherwise"""
+        with self.lock:
+            slot = self.blocks.get(blockId, {}).get(blockNum, None)
+            if slot is None or self.slots[slot][3] != fileVersion:
+                self.misses += 1
+                return None
+            offset = self.slotOffset(slot)
+            (unused, blockVersion, unused, unused, length, crc, unused, unused) = self.SLOT_HEADER.unpack_from(self.mm, offset)
+            data = self.mm[offset + self.SLOT_HEADER_SIZE:offset + self.SLOT_HEADER_SIZE + length]
+            if zlib.crc32(data) & 0xffffffff != crc:
+                self.log.debug("Disk cache slot %d of %s/%d is corrupted", slot, blockId, blockNum)
+                self.freeSlot(slot)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return blockVersion, data
+
+    def put(self, blockId, blockNum, blockVersion, fileVersion, data):
+        if len(data) > self.blockSize or len(blockId) > self.MAX_BLOCK_ID:
+            return
+        with self.lock:
+            slot = self.blocks.get(blockId, {}).get(blockNum, None)
+            if slot is None:
+                slot = self.nextSlot
+                self.nextSlot = (self.nextSlot + 1) % self.slotCount
+                if self.slots[slot]:
+                    self.freeSlot(slot)
+            offset = self.slotOffset(slot)
+            self.mm[offset + self.SLOT_HEADER_SIZE:offset + self.SLOT_HEADER_SIZE + len(data)] = data
+            self.writeHeader(slot, blockId, blockNum, blockVersion, fileVersion, len(data), zlib.crc32(data) & 0xffffffff)
+            self.slots[slot] = (blockId, blockNum, blockVersion, fileVersion)
+            self.blocks.setdefault(blockId, {})[blockNum] = slot
+
+    def writeHeader(self, slot, blockId, blockNum, blockVersion, fileVersion, length, crc):
+        self.SLOT_HEADER.pack_into(self.mm, self.slotOffset(slot), self.SLOT_MAGIC, blockVersion, fileVersion, blockNum,
+            length, crc, len(blockId), blockId)
+
+    def drop(self, blockId, blockNum):
+        with self.lock:
+            slot = self.blocks.get(blockId, {}).get(blockNum, None)
+            if slot is not None:
+                self.freeSlot(slot)
+
+    def invalidate(self, blockId, fromBlockNum=0):
+        with self.lock:
+            for (blockNum, slot) in self.blocks.get(blockId, {}).items():
+                if blockNum >= fromBlockNum:
+                    self.freeSlot(slot)
+
+    def restamp(self, blockId, oldFileVersion, newFileVersion):
+        with self.lock:
+            for slot in self.blocks.get(blockId, {}).values():
+                (unused, blockNum, blockVersion, fileVersion) = self.slots[slot]
+                if fileVersion == oldFileVersion:
+                    self.slots[slot] = (blockId, blockNum, blockVersion, newFileVersion)
+                    struct.pack_into("<q", self.mm, self.slotOffset(slot) + 12, newFileVersion)
+
+    def freeSlot(self, slot):
+        (blockId, blockNum, unused, unused) = self.slots[slot]
+        self.slots[slot] = None
+        self.mm[self.slotOffset(slot):self.slotOffset(slot) + len(self.SLOT_MAGIC)] = "\0" * len(self.SLOT_MAGIC)
+        versions = self.blocks[blockId]
+        del versions[blockNum]
+        if not versions:
+            del self.blocks[blockId]
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, blocks=self.slotCount - self.slots.count(None))
+
+    def close(self):
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
@@ -18,7 +18,16 @@
 
 from __future__ import with_statement
 from boto.s3.multidelete import Error
-from dynamofuse.lock import FileLockManager
+from dynamofuse.lock import FileLockManager, WriteLease
+from dynamofuse.handle import FileHandleTable, DirectoryHandleTable
+from dynamofuse.readahead import ReadAhead
+from dynamofuse.blockcache import BlockCache
+from dynamofuse.recordcache import RecordCache
+from dynamofuse.diskcache import DiskBlockCache
+from dynamofuse.codec import checkCodec
+from dynamofuse.writebuffer import WriteBuffer
+from dynamofuse.compactor import ExtentCompactor
+from dynamofuse.spool import WriteSpool
 
 __author__ = 'Denis Mikhalkin'
 
@@ -26,6 +35,7 @@ import dynamofuse
 from posix import R_OK, X_OK, W_OK
 from dynamofuse.records.directory import Directory
 from dynamofuse.records.file import File
+from dynamofuse.records.block import MAX_BLOCK_SIZE
 from dynamofuse.records.node import Node
 from dynamofuse.records.symlink import Symlink
 from dynamofuse.base import BaseRecord, DELETED_LINKS, CONSISTENT_OPER, retry
@@ -33,7 +43,7 @@ from dynamofuse.records.link import Link
 from errno import *
 from os.path import realpath
 from sys import argv, exit
-from threading import Lock
+from threading import Lock, local
 import boto.dynamodb
 from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError, DynamoDBConditionalCheckFailedError
 from boto.exception import BotoServerError, BotoClientError
@@ -50,6 +60,8 @@ import logging
 from logging import StreamHandler, FileHandler
 import sys
 import cStringIO
+import ctypes
+import fuse as fusepy
 import itertools
 import traceback
 from boto.dynamodb2.fields import HashKey, RangeKey, KeysOnlyIndex, AllIndex, IncludeIndex
@@ -76,8 +88,34 @@ F_SETLKW64 = 14
 F_RDLCK = 0
 F_WRLCK = 1
 F_UNLCK = 2
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
 global logStream
 
+def sizeOption(value):
+    """Parses a size with an optional K/M/G suffix"""
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in multipliers:
+        return int(value[:-1]) * multipliers[value[-1]]
+    return int(value)
+
+def flagOption(value):
+    """Parses an on/off option, given without a value it is on"""
+    return value.strip().lower() in ("", "1", "yes", "true", "on")
+
+# fusepy 3 copies the read result with memmove, which takes a ctypes array over the data as is.
+# fusepy 2 copies it through create_string_buffer, which takes only a str
+ZERO_COPY_READ = hasattr(FUSE, '_decode_optional_path')
+
+def fuseData(data):
+    """Read result for FUSE to copy from - with fusepy 3 a bytearray is handed over as is rather than copied into a str"""
+    if isinstance(data, bytearray):
+        if ZERO_COPY_READ and data:
+            return (ctypes.c_char * len(data)).from_buffer(data)
+        return str(data)
+    return data
+
 class BotoExceptionMixin(object):
     log = logging.getLogger("dynamo-fuse-oper  ")
     accessLog = logging.getLogger("dynamo-fuse-access")
@@ -109,8 +147,101 @@ class BotoExceptionMixin(object):
             self.log.error("  - %s: %s", op, "".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
             raise FuseOSError(EIO)
 
+def fallocateOperations():
+    """fusepy's fuse_operations with the slots libfuse 2.9 has after them, up to fallocate"""
+    names = [field[0] for field in fusepy.fuse_operations._fields_]
+    fields = [] if 'ioctl' in names else [('ioctl', ctypes.c_voidp)]
+    fields += [('poll', ctypes.c_voidp), ('write_buf', ctypes.c_voidp), ('read_buf', ctypes.c_voidp), ('flock', ctypes.c_voidp),
+        ('fallocate', ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_char_p, ctypes.c_int, fusepy.c_off_t, fusepy.c_off_t,
+            ctypes.POINTER(fusepy.fuse_file_info)))]
+    return type("fuse_operations", (fusepy.fuse_operations,), {"_fields_": fields})
+
+class DynamoFUSE(FUSE):
+    """
+    Passes the offset of readdir to the file system, so that a listing resumes where the previous call stopped.
+    Adds the fallocate operation, which fusepy doesn't have a slot for.
+    """
+
+    def __init__(self, operations, mountpoint, **kwargs):
+        # FUSE.__init__ builds the operations table from the fuse_operations of its module, and mounts
+        operationsType = fusepy.fuse_operations
+        fusepy.fuse_operations = fallocateOperations()
+        try:
+            FUSE.__init__(self, operations, mountpoint, **kwargs)
+        finally:
+            fusepy.fuse_operations = operationsType
+
+    def decodePath(self, path):
+        # fusepy 3 decodes paths which may be NULL with _decode_optional_path
+        if hasattr(self, '_decode_optional_path'):
+            return self._decode_optional_path(path)
+        return path.decode(self.encoding)
+
+    def fallocate(self, path, mode, offset, length, fip):
+        return self.operations('fallocate', self.decodePath(path), mode, offset, length, fip.contents.fh if fip else None)
+
+    def readdir(self, path, buf, filler, offset, fip):
+        for (name, attrs, entryOffset) in self.operations('readdir', self.decodePath(path), fip.contents.fh, offset):
+            # Non-zero offsets - the kernel asks again from the last entry that fit into its buffer
+            if filler(buf, name.encode(self.encoding), None, entryOffset) != 0:
+                break
+        return 0
+
 class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynamofuse.FileSystem):
     BLOCK_SIZE = 32768
+    READAHEAD_BLOCKS = 8
+    BLOCK_CACHE_SIZE = 64 * 1024 * 1024
+    BLOCK_CACHE_TTL = 5
+    ATTR_CACHE_SIZE = 10000
+    ATTR_CACHE_TTL = 1
+    NEG_CACHE_TTL = 1
+    READDIR_PLUS = False
+    DISK_CACHE_DIR = None
+    DISK_CACHE_SIZE = 1024 * 1024 * 1024
+    INLINE_DATA_SIZE = 0
+    LARGE_FILE_SIZE = 0
+    LARGE_BLOCK_SIZE = 256 * 1024
+    BLOCK_CODEC = None
+    DEDUP = False
+    WRITE_BUFFER_SIZE = 0
+    ATTR_DELAY = None
+    WRITE_LEASE_TIME = 0
+    OPTIMISTIC_WRITES = False
+    EXTENT_WRITE_SIZE = 0
+    EXTENT_COMPACT_SIZE = 8192
+    SPOOL_DIR = None
+    SPOOL_SIZE = 64 * 1024 * 1024
+    STRIPES = 1
+    # Deferred attributes are saved once the writes kept for them (see FileHandle) reach this size
+    MAX_DEFERRED_WRITES = 16 * 1024 * 1024
+
+    # Mount options (-o name=value) which override the settings above: name -> (attribute, parser)
+    MOUNT_OPTIONS = {
+        "blocksize": ("BLOCK_SIZE", sizeOption),
+        "readahead": ("READAHEAD_BLOCKS", int),
+        "blockcache": ("BLOCK_CACHE_SIZE", sizeOption),
+        "blockcachettl": ("BLOCK_CACHE_TTL", float),
+        "attrcache": ("ATTR_CACHE_SIZE", int),
+        "attrcachettl": ("ATTR_CACHE_TTL", float),
+        "negcachettl": ("NEG_CACHE_TTL", float),
+        "readdirplus": ("READDIR_PLUS", flagOption),
+        "diskcache": ("DISK_CACHE_DIR", str),
+        "diskcachesize": ("DISK_CACHE_SIZE", sizeOption),
+        "inline": ("INLINE_DATA_SIZE", sizeOption),
+        "largefile": ("LARGE_FILE_SIZE", sizeOption),
+        "largeblocksize": ("LARGE_BLOCK_SIZE", sizeOption),
+        "compress": ("BLOCK_CODEC", checkCodec),
+        "dedup": ("DEDUP", flagOption),
+        "writebuffer": ("WRITE_BUFFER_SIZE", sizeOption),
+        "attrdelay": ("ATTR_DELAY", float),
+        "writelease": ("WRITE_LEASE_TIME", float),
+        "optimistic": ("OPTIMISTIC_WRITES", flagOption),
+        "extentwrites": ("EXTENT_WRITE_SIZE", sizeOption),
+        "extentcompact": ("EXTENT_COMPACT_SIZE", sizeOption),
+        "spool": ("SPOOL_DIR", str),
+        "spoolsize": ("SPOOL_SIZE", sizeOption),
+        "stripes": ("STRIPES", int)
+    }
 
     recordTypes = {
         "File": File,
@@ -120,10 +251,11 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         "Link": Link
     }
 
-    def __init__(self, uri):
+    def __init__(self, uri, options=()):
         (unused, regionPath) = uri.split(':')
         (region, tableName) = regionPath.split('/')
         self.log = logging.getLogger("dynamo-fuse-oper  ")
+        self.applyOptions(options)
         self.tableName = tableName
         self.region = region
         for reg in boto.dynamodb2.regions():
@@ -145,10 +277,39 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
             self.createTable()
         self.counter = itertools.count()
         self.counter.next() # start from 1
-
+        self.fileHandles = FileHandleTable()
+        self.dirHandles = DirectoryHandleTable()
+        self.blockCache = BlockCache(self.BLOCK_CACHE_SIZE, self.BLOCK_CACHE_TTL)
+        self.recordCache = RecordCache(self.ATTR_CACHE_SIZE, self.ATTR_CACHE_TTL, self.NEG_CACHE_TTL)
+        self.diskCache = None
+        if self.DISK_CACHE_DIR:
+            # Slots for the blocks of the mount block size, of grown files and of files created with any other size
+            blockSizes = [min(self.BLOCK_SIZE, MAX_BLOCK_SIZE), MAX_BLOCK_SIZE]
+            if self.LARGE_FILE_SIZE:
+                blockSizes.append(min(self.LARGE_BLOCK_SIZE, MAX_BLOCK_SIZE))
+            self.diskCache = DiskBlockCache(os.path.join(self.DISK_CACHE_DIR, self.tableName + ".cache"),
+                self.DISK_CACHE_SIZE, blockSizes)
+        self.compactor = ExtentCompactor(self) if self.EXTENT_WRITE_SIZE else None
+        # Spooled writes left by the previous mount are loaded here and stored once the file system is initialized
+        self.spool = None
+        # The lock owner of the spooled write being stored by the spool thread, which has no FUSE context
+        self.storeContext = local()
+        if self.SPOOL_DIR:
+            self.spool = WriteSpool(os.path.join(self.SPOOL_DIR, self.tableName + ".spool"), self.SPOOL_SIZE, self.storeSpooled)
+
+        # Ids are handed out from the block reserved in the counter item, by all FUSE threads
+        self.idLock = Lock()
         self.__createRoot()
         print "Ready"
 
+    def applyOptions(self, options):
+        for option in options:
+            (name, unused, value) = option.partition("=")
+            if name in self.MOUNT_OPTIONS:
+                (attr, parse) = self.MOUNT_OPTIONS[name]
+                setattr(self, attr, parse(value))
+                self.log.debug(" option %s = %s", attr, getattr(self, attr))
+
     def createTable(self):
         provider = Provider('aws')
         connection = DynamoDBConnection(aws_access_key_id=provider.get_access_key(),
@@ -189,6 +350,8 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
     def init(self, conn):
         self.log.debug(" init")
         self.lockManager = dynamofuse.ioc.get(FileLockManager)
+        if self.spool:
+            self.spool.start()
 
     def __createRoot(self):
         if not self.table.has_item("/", "/"):
@@ -203,6 +366,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         self.checkAccess(os.path.dirname(path), X_OK)
 
         self.getRecordOrThrow(path).chmod(mode)
+        self.fileHandles.invalidate(path)
         return 0
 
     def chown(self, path, uid, gid):
@@ -211,6 +375,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         self.checkAccess(os.path.dirname(path), X_OK)
 
         self.getRecordOrThrow(path).chown(uid, gid)
+        self.fileHandles.invalidate(path)
         return 0
 
     def getattr(self, path, fh=None):
@@ -222,7 +387,22 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         if record.isHidden():
             raise FuseOSError(ENOENT)
 
-        return record.getattr()
+        attrs = record.getattr()
+        dirty = self.fileHandles.dirtyForPath(path)
+        if dirty:
+            # Buffered writes and unsaved sizes of written data may extend the file
+            attrs = dict(attrs)
+            attrs["st_size"] = max([attrs["st_size"]] + [handle.dirtySize() for handle in dirty])
+            mtime = max(handle.pendingTime for handle in dirty)
+            attrs["st_mtime"] = max(attrs["st_mtime"], mtime)
+            attrs["st_ctime"] = max(attrs["st_ctime"], mtime)
+        if self.spool and self.spool.isDirty(path):
+            (size, mtime) = self.spool.dirtyAttrs(path)
+            attrs = dict(attrs)
+            attrs["st_size"] = max(attrs["st_size"], size)
+            attrs["st_mtime"] = max(attrs["st_mtime"], mtime)
+            attrs["st_ctime"] = max(attrs["st_ctime"], mtime)
+        return attrs
 
     def open(self, path, flags):
         self.log.debug(" open(%s, flags=0x%x)", path, flags)
@@ -240,7 +420,8 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         if flags & os.O_CREAT: access |= W_OK
         self.checkAccess(os.path.dirname(path), access)
 
-        item = self.getRecordOrThrow(path, ["type", "readLock", "writeLock", "st_mode", "st_uid", "st_gid"])
+        # Full record - it is kept by the file handle for the following read/write calls
+        item = self.getRecordOrThrow(path)
 
         access = 0
         if flags & (os.O_RDONLY | os.O_RDWR) or flags == 0: access |= R_OK
@@ -251,7 +432,12 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
 
         self.lockManager.create(path)
 
-        return self.allocId()
+        fh = self.allocId()
+        # Appends are not buffered - their offset is only known when the range is reserved
+        append = flags & os.O_APPEND != 0
+        self.fileHandles.add(fh, path, item, self.lockManager.getFileLockOrNone(path), self.newReadAhead(item),
+            None if append else self.newWriteBuffer(item), append)
+        return fh
 
     def utimens(self, path, times=None):
         self.log.debug(" utimens(%s)", path)
@@ -261,6 +447,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         item = self.getRecordOrThrow(path)
 
         item.utimens(atime, mtime)
+        self.fileHandles.invalidate(path)
 
     def opendir(self, path):
         self.log.debug(" opendir(%s)", path)
@@ -269,19 +456,48 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         self.checkFileExists(path)
         self.checkAccess(path, R_OK | X_OK)
 
-        return self.allocId()
+        fh = self.allocId()
+        self.dirHandles.add(fh, path)
+        return fh
+
+    def releasedir(self, path, fh):
+        self.log.debug(" releasedir(%s, %d)", path, fh)
+        self.dirHandles.remove(fh)
+        return 0
 
-    def readdir(self, path, fh=None):
-        self.log.debug(" readdir(%s)", path)
+    def readdir(self, path, fh=None, offset=0):
+        self.log.debug(" readdir(%s, %d)", path, offset)
         # Verify the directory exists
         dir = self.getRecordOrThrow(path)
 
         if dir.access(R_OK | X_OK):
             raise FuseOSError(EACCES)
 
-        yield '.'
-        yield '..'
-        for v in dir.list(): yield v
+        return self.listEntries(dir, self.dirHandles.get(fh), offset)
+
+    def listEntries(self, dir, handle, offset):
+        """(name, attrs, offset) of the entries following offset. '.' and '..' are at offsets 1 and 2"""
+        after = None
+        skip = 0
+        if offset > 2:
+            after = handle.nameAt(offset) if handle else None
+            if after is None:
+                # Position we don't know (e.g. seekdir) - list from the start
+                skip = offset - 2
+
+        for (entryOffset, name) in [(1, '.'), (2, '..')]:
+            if entryOffset > offset:
+                yield (name, None, entryOffset)
+
+        entryOffset = max(offset, 2)
+        for name in dir.list(after):
+            if skip:
+                skip -= 1
+                continue
+            entryOffset += 1
+            if handle:
+                handle.remember(entryOffset, name)
+            yield (name, None, entryOffset)
 
     def mkdir(self, path, mode):
         self.log.debug(" mkdir(%s)", path)
@@ -318,6 +534,8 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         self.checkAccess(os.path.dirname(new), R_OK | W_OK | X_OK)
         self.checkSticky(old, new)
 
+        self.flushPath(old)
+        self.dropLease(old)
         item = self.getRecordOrThrow(old)
         newItem = self.getRecordOrNone(new)
         if item.isDirectory():
@@ -332,6 +550,11 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
             raise FuseOSError(ENOENT)
 
         item.moveTo(new)
+        # The entries under a moved directory are moved too
+        self.recordCache.invalidateTree(old)
+        self.recordCache.invalidateTree(new)
+        self.fileHandles.invalidate(old)
+        self.fileHandles.invalidate(new)
 
     def readlink(self, path):
         self.log.debug(" readlink(%s)", path)
@@ -397,14 +620,35 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         if path != "/":
             record.updateDirectoryMCTime(path)
 
-        return self.allocId()
+        fh = self.allocId()
+        self.fileHandles.add(fh, path, record, self.lockManager.getFileLockOrNone(path), self.newReadAhead(record), self.newWriteBuffer(record))
+        return fh
 
     def fsyncdir(self, path, datasync, fh):
         return super(DynamoFS, self).fsyncdir(path, datasync, fh)
 
+    def flush(self, path, fh):
+        self.log.debug(" flush(%s, %d)", path, fh)
+        self.flushHandle(path, self.fileHandles.get(fh))
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        self.log.debug(" fsync(%s, %d)", path, fh)
+        self.flushHandle(path, self.fileHandles.get(fh))
+        if self.spool:
+            self.spool.wait(path)
+            self.spool.checkError(path)
+        return 0
+
     def release(self, path, fh):
         self.log.debug(" release(%s, %d)", path, fh)
-        self.lockManager.release(path)
+        try:
+            self.flushHandle(path, self.fileHandles.get(fh))
+        finally:
+            self.fileHandles.remove(fh)
+            if not self.fileHandles.forPath(path):
+                self.dropLease(path)
+            self.lockManager.release(path)
         return 0
 
     def statfs(self, path):
@@ -425,12 +669,20 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
 
     def destroy(self, path):
         self.log.debug(" destroy(%s)", path)
+        self.log.info(" block cache: %s", self.blockCache.stats())
+        self.log.info(" record cache: %s", self.recordCache.stats())
+        if self.diskCache:
+            self.log.info(" disk block cache: %s", self.diskCache.stats())
+            self.diskCache.close()
+        if self.spool:
+            self.spool.close()
         self.table.refresh(wait_for_active=True)
 
     def truncate(self, path, length, fh=None):
         self.log.debug(" truncate(%s, %d)", path, length)
 
-        item = self.getRecordOrThrow(path)
+        self.flushPath(path)
+        item = self.getFileRecord(path, fh)
         if not item.isFile():
             raise FuseOSError(EINVAL)
 
@@ -440,6 +692,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
             raise FuseOSError(EACCES)
 
         item.truncate(length)
+        self.fileHandles.invalidate(path, fh)
 
     def unlink(self, path):
         self.log.debug(" unlink(%s)", path)
@@ -447,7 +700,10 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         self.checkAccess(os.path.dirname(path), W_OK | X_OK)
         self.checkSticky(path)
 
+        self.flushPath(path)
         self.getRecordOrThrow(path).delete()
+        self.dropLease(path)
+        self.fileHandles.invalidate(path)
 
     def write(self, path, data, offset, fh):
         self.log.debug(" write(%s, len=%d, offset=%d)", path, len(data), offset)
@@ -455,20 +711,126 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         (uid, gid, pid) = fuse_get_context()
         self.log.debug('  - uid: %d, gid: %d, pid: %d, lock_owner: %d', uid, gid, pid, getattr(self, 'lock_owner') if hasattr(self, 'lock_owner') else -1)
 
-        item = self.getRecordOrThrow(path)
+        item = self.getFileRecord(path, fh)
         if not item.isFile() and not item.isHardLink():
             raise FuseOSError(EINVAL)
 
-        return item.write(data, offset)
+        handle = self.fileHandles.get(fh)
+        if handle and handle.append:
+            return self.appendRecord(path, fh, data)
+        if handle and handle.writeBuffer:
+            if handle.writeBuffer.add(offset, data):
+                # Over the limit - store the complete blocks, the partial last one is likely to be continued
+                self.flushHandle(path, handle, keepTail=True)
+            return len(data)
+
+        return self.writeRecord(path, fh, data, offset)
+
+    def writeRecord(self, path, fh, data, offset):
+        if self.spool and fh is not None:
+            self.spool.add(path, offset, data, self.getLockOwner())
+            return len(data)
+        handle = self.fileHandles.get(fh)
+        # The size and times are saved by flushHandle
+        deferAttrs = handle is not None and self.ATTR_DELAY is not None
+        item = self.getFileRecord(path, fh)
+        file = item.getLink() if item.isHardLink() else item
+        if file.isFile() and file.largeBlockSize(offset + len(data)):
+            # The data is moved to the larger blocks up to the saved size - save the sizes deferred by the handles first
+            for pending in self.fileHandles.forPath(path):
+                if pending.hasPendingAttrs():
+                    self.saveAttrs(path, pending)
+            item = self.getFileRecord(path, fh)
+        if handle is not None and item.isFile():
+            self.acquireLease(path)
+        try:
+            written = item.write(data, offset, deferAttrs)
+        except DynamoDBConditionalCheckFailedError:
+            if handle is None:
+                raise
+            # The record kept by the handle was changed by another client - reload it and repeat
+            self.log.debug("  - handle %d is out of date, reloading", fh)
+            item = self.getFileRecord(path, fh, refresh=True)
+            written = item.write(data, offset, deferAttrs)
+        self.fileHandles.invalidate(path, fh)
+        if deferAttrs:
+            handle.deferAttrs(offset + written, int(time()), [(item.getRecord()["blockId"], offset, data)])
+            if (self.ATTR_DELAY and time() - handle.pendingSince >= self.ATTR_DELAY) or \
+                    handle.pendingBytes >= self.MAX_DEFERRED_WRITES:
+                self.saveAttrs(path, handle)
+        return written
+
+    def appendRecord(self, path, fh, data):
+        """O_APPEND write - the data goes to the end of the file, whatever the offset passed by the kernel"""
+        # The end is reserved from the saved size - buffered writes and deferred sizes of the other handles go first
+        self.flushPath(path)
+        item = self.getFileRecord(path, fh)
+        try:
+            written = item.append(data)
+        except DynamoDBConditionalCheckFailedError:
+            # The file was replaced or moved to larger blocks since the handle read it
+            self.log.debug("  - handle %d is out of date, reloading", fh)
+            item = self.getFileRecord(path, fh, refresh=True)
+            written = item.append(data)
+        self.fileHandles.invalidate(path, fh)
+        return written
 
     def read(self, path, size, offset, fh):
         self.log.debug(" read(%s, size=%d, offset=%d)", path, size, offset)
 
-        item = self.getRecordOrThrow(path)
+        handle = self.fileHandles.get(fh)
+        loaded = handle.loaded if handle else None
+        item = self.getFileRecord(path, fh)
         if not item.isFile() and not item.isHardLink():
             raise FuseOSError(EINVAL)
 
-        return item.read(offset, size)
+        readAhead = handle.readAhead if handle else None
+        dirty = self.fileHandles.dirtyForPath(path)
+        spooled = self.spool is not None and self.spool.isDirty(path)
+        if not dirty and not spooled:
+            if handle is not None and handle.loaded == loaded and offset + size > item.getattr()["st_size"]:
+                # The end of the file as it was read - another client may have appended to it since
+                item = self.getFileRecord(path, fh, refresh=True)
+            return fuseData(item.read(offset, size, readAhead))
+
+        # Written data not flushed yet is read from the buffers, the data past the saved size from the blocks
+        fileSize = max([item.getattr()["st_size"], self.spool.dirtyAttrs(path)[0] if spooled else 0] +
+                       [dirtyHandle.dirtySize() for dirtyHandle in dirty])
+        data = item.read(offset, size, readAhead, fileSize)
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if spooled:
+            # Older than the data in the buffers
+            self.spool.apply(path, data, offset)
+        for dirtyHandle in dirty:
+            if dirtyHandle.writeBuffer is not None:
+                dirtyHandle.writeBuffer.apply(data, offset)
+        return fuseData(data)
+
+    def fallocate(self, path, mode, offset, length, fh=None):
+        self.log.debug(" fallocate(%s, mode=%d, offset=%d, length=%d)", path, mode, offset, length)
+
+        self.flushPath(path)
+        item = self.getFileRecord(path, fh)
+        if not item.isFile() and not item.isHardLink():
+            raise FuseOSError(EINVAL)
+        if item.isHardLink():
+            item = item.getLink()
+
+        if item.access(W_OK):
+            raise FuseOSError(EACCES)
+
+        # Files are sparse - there is nothing to allocate, only the size may change
+        if mode == 0:
+            if offset + length > item["st_size"]:
+                item.truncate(offset + length)
+        elif mode == FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE:
+            item.punchHole(offset, length)
+        elif mode != FALLOC_FL_KEEP_SIZE:
+            raise FuseOSError(EOPNOTSUPP)
+
+        self.fileHandles.invalidate(path, fh)
+        return 0
 
     @retry
     def link(self, target, source):
@@ -476,6 +838,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
 
         self.checkAccess(source, R_OK)
 
+        self.flushPath(source)
         item = self.getRecordOrThrow(source)
         if not item.isFile() and not item.isNode() and not item.isHardLink():
             raise FuseOSError(EINVAL)
@@ -488,6 +851,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
 
         # This can throw exception
         record = Link().createRecord(self, target, {}, item)
+        self.fileHandles.invalidate(item.path)
 
         item.updateDirectoryMCTime(source)
         record.updateDirectoryMCTime(target)
@@ -526,6 +890,9 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         # For SETLK, if the lock is already held don't call dynamo
         # See http://sourceforge.net/mailarchive/forum.php?thread_name=b2397a6c1001271050y41c0164bk54ac3afa7c5aa928%40mail.gmail.com&forum_name=fuse-devel
         lock_owner = self.getLockOwner()
+        # Data written under the lock must be stored before other clients can get the lock
+        self.flushPath(path)
+        self.dropLease(path)
         record = self.getRecordOrThrow(path)
 
         if not record.isFile():
@@ -564,6 +931,7 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
             else:
                 lock.l_type = F_UNLCK
 
+        self.fileHandles.invalidate(path)
         return 0
 
     def bmap(self, path, blocksize, idx):
@@ -595,6 +963,8 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         # ============ PRIVATE ====================
 
     def getLockOwner(self):
+        if hasattr(self.storeContext, 'lockOwner'):
+            return self.storeContext.lockOwner
         (uid, gid, pid) = fuse_get_context()
 
         return getattr(self, 'lock_owner') if hasattr(self, 'lock_owner') else pid
@@ -618,7 +988,14 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
                             raise FuseOSError(EPERM)
 
     def checkAccess(self, path, mode):
-        if not self.access(path, mode) == 0:
+        (uid, gid, unused) = fuse_get_context()
+        # Mostly the parent directory, checked by every operation in it
+        allowed = self.recordCache.getAccess(path, uid, gid, mode)
+        if allowed is None:
+            item = self.getRecordOrThrow(path)
+            allowed = item.access(mode) == 0
+            self.recordCache.putAccess(path, uid, gid, mode, item["version"], allowed)
+        if not allowed:
             raise FuseOSError(EACCES)
 
     def checkPath(self, path):
@@ -647,11 +1024,153 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
     def allocId(self):
         return self.counter.next()
 
+    def getFileRecord(self, path, fh, refresh=False):
+        handle = self.fileHandles.get(fh)
+        if handle is None:
+            return self.getRecordOrThrow(path)
+        if refresh or handle.stale or handle.path != path or handle.isExpired(self.ATTR_CACHE_TTL):
+            # Not from the record cache, it may hold the same copy
+            self.invalidateRecord(path)
+            if handle.path == path and handle.record.isHardLink():
+                self.invalidateRecord(handle.record["link"])
+            version = handle.record["version"] if handle.path == path else None
+            handle.update(path, self.getRecordOrThrow(path))
+            if handle.readAhead and handle.record["version"] != version:
+                # Prefetched blocks may be of the old version
+                handle.readAhead.reset()
+        return handle.record
+
+    def newWriteBuffer(self, record):
+        if self.WRITE_BUFFER_SIZE and (record.isFile() or record.isHardLink()):
+            return WriteBuffer(self.WRITE_BUFFER_SIZE)
+        return None
+
+    def flushHandle(self, path, handle, keepTail=False):
+        if handle is None or not handle.isDirty():
+            return
+        if handle.writeBuffer is not None and handle.writeBuffer.isDirty():
+            blockSize = self.getFileRecord(path, handle.fh).blockSize() if keepTail else None
+            extents = handle.writeBuffer.take(blockSize)
+            self.log.debug("  - flushing %d extents of handle %d", len(extents), handle.fh)
+            for (i, (offset, data)) in enumerate(extents):
+                try:
+                    self.writeRecord(path, handle.fh, data, offset)
+                except:
+                    # Keep what has not been stored for the next flush
+                    for (unwritten, unwrittenData) in extents[i:]:
+                        handle.writeBuffer.add(unwritten, unwrittenData)
+                    raise
+        if not keepTail and handle.hasPendingAttrs():
+            self.saveAttrs(path, handle)
+
+    def saveAttrs(self, path, handle):
+        (size, mtime, writes) = handle.takePendingAttrs()
+        self.log.debug("  - saving size %d of handle %d", size, handle.fh)
+        try:
+            item = self.getFileRecord(path, handle.fh)
+            try:
+                self.rewriteDeferred(item, writes)
+                item.updateSizeAndTime(size, mtime)
+            except DynamoDBConditionalCheckFailedError:
+                item = self.getFileRecord(path, handle.fh, refresh=True)
+                self.rewriteDeferred(item, writes)
+                item.updateSizeAndTime(size, mtime)
+        except:
+            handle.deferAttrs(size, mtime, writes)
+            raise
+        self.fileHandles.invalidate(path, handle.fh)
+
+    def rewriteDeferred(self, item, writes):
+        blockId = item.getRecord()["blockId"]
+        for (writtenTo, offset, data) in writes:
+            if writtenTo != blockId:
+                # The blocks were replaced meanwhile (block size change, new file) - the data went to the old ones
+                self.log.debug("  - blocks of %s replaced, writing %d bytes at %d again", item.path, len(data), offset)
+                item.write(data, offset, True)
+
+    def acquireLease(self, path):
+        """Takes or renews the write lease of the open file, File.writeLock() then doesn't lock the file in DynamoDB"""
+        if not self.WRITE_LEASE_TIME:
+            return
+        fileLock = self.lockManager.getFileLockOrNone(path)
+        if fileLock is None:
+            return
+        with fileLock:
+            if fileLock.lease is None:
+                fileLock.lease = WriteLease(path, self, self.WRITE_LEASE_TIME)
+            lease = fileLock.lease
+        lease.acquire()
+
+    def dropLease(self, path):
+        fileLock = self.lockManager.getFileLockOrNone(path)
+        if fileLock is None or fileLock.lease is None:
+            return
+        with fileLock:
+            lease = fileLock.lease
+            fileLock.lease = None
+        lease.release()
+
+    def flushPath(self, path):
+        for handle in self.fileHandles.dirtyForPath(path):
+            self.flushHandle(path, handle)
+        if self.spool:
+            self.spool.wait(path)
+
+    def storeSpooled(self, path, offset, data, lockOwner):
+        # The locks of the owner may be gone by now (or with the writes from the previous mount, unknown),
+        # then the write takes the lock itself
+        self.storeContext.lockOwner = lockOwner if lockOwner is not None else -1
+        try:
+            self.writeRecord(path, None, data, offset)
+        finally:
+            del self.storeContext.lockOwner
+
+    def newReadAhead(self, record):
+        if self.READAHEAD_BLOCKS and (record.isFile() or record.isHardLink()):
+            return ReadAhead(self.READAHEAD_BLOCKS)
+        return None
+
     def checkFileExists(self, filepath):
         self.getItemOrThrow(filepath, attrs=[])
 
     def newItem(self, attrs):
-        return self.table.new_item(attrs=attrs)
+        # Lock and lease changes are made through these items, bypassing the record
+        item = self.table.new_item(attrs=attrs)
+        path = os.path.join(attrs["path"], attrs["name"])
+        for method in ["save", "put", "delete"]:
+            setattr(item, method, self.invalidating(path, getattr(item, method)))
+        return item
+
+    def invalidating(self, path, method):
+        def invalidatingImpl(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.recordCache.invalidate(path)
+        return invalidatingImpl
+
+    def invalidateRecord(self, path):
+        self.recordCache.invalidate(path)
+
+    def invalidateMissing(self, path):
+        """The path was created - the directory may have other new entries the cache has as missing"""
+        self.recordCache.invalidate(path)
+        self.recordCache.invalidateMissing(os.path.dirname(path))
+
+    def getCachedItem(self, path, name):
+        """Returns the full item of the path, from the record cache if it has it"""
+        attrs = self.recordCache.get(path)
+        if attrs is not None:
+            return self.table.new_item(attrs=attrs)
+        if self.recordCache.isMissing(path):
+            raise DynamoDBKeyNotFoundError("Key does not exist.")
+        try:
+            item = self.table.get_item(os.path.dirname(path), name, consistent_read=CONSISTENT_OPER)
+        except DynamoDBKeyNotFoundError:
+            self.recordCache.putMissing(path)
+            raise
+        self.recordCache.put(path, item)
+        return item
 
     def getItemOrThrow(self, filepath, attrs=None):
         self.checkPath(filepath)
@@ -688,8 +1207,11 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         if name == "":
             name = "/"
         try:
-            res = self.initRecord(filepath,
-                self.table.get_item(os.path.dirname(filepath), name, attributes_to_get=attrs, consistent_read=CONSISTENT_OPER))
+            if attrs is None:
+                item = self.getCachedItem(filepath, name)
+            else:
+                item = self.table.get_item(os.path.dirname(filepath), name, attributes_to_get=attrs, consistent_read=CONSISTENT_OPER)
+            res = self.initRecord(filepath, item)
             if not ignoreDeleted and res.isDeleted():
                 raise FuseOSError(ENOENT)
             return res
@@ -705,8 +1227,11 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         if name == "":
             name = "/"
         try:
-            res = self.initRecord(path,
-                self.table.get_item(os.path.dirname(path), name, attributes_to_get=attrs, consistent_read=CONSISTENT_OPER))
+            if attrs is None:
+                item = self.getCachedItem(path, name)
+            else:
+                item = self.table.get_item(os.path.dirname(path), name, attributes_to_get=attrs, consistent_read=CONSISTENT_OPER)
+            res = self.initRecord(path, item)
             if not ignoreDeleted and res.isDeleted():
                 raise FuseOSError(ENOENT)
             return res
@@ -724,22 +1249,23 @@ class DynamoFS(BotoExceptionMixin, Operations, dynamofuse.StorageAccessor, dynam
         return record
 
     def allocUniqueId(self):
-        if hasattr(self, 'idLimit'):
-            if hasattr(self, 'runningId'):
-                if self.runningId + 1 < self.idLimit:
-                    self.runningId += 1
+        with self.idLock:
+            if hasattr(self, 'idLimit'):
+                if hasattr(self, 'runningId'):
+                    if self.runningId + 1 < self.idLimit:
+                        self.runningId += 1
+                        return self.runningId
+                    # else reached top - fallthrough
+                else:
+                    self.runningId = self.idLimit - 1000
                     return self.runningId
-                # else reached top - fallthrough
-            else:
-                self.runningId = self.idLimit - 1000
-                return self.runningId
-        # Either no limit or reached top
-        idItem = self.table.new_item(attrs={'name': 'counter', 'path': 'global'})
-        idItem.add_attribute("value", 1000)
-        res = idItem.save(return_values="ALL_NEW")
-        self.idLimit = res["Attributes"]["value"]
-        self.runningId = self.idLimit - 1000
-        return self.runningId
+            # Either no limit or reached top
+            idItem = self.table.new_item(attrs={'name': 'counter', 'path': 'global'})
+            idItem.add_attribute("value", 1000)
+            res = idItem.save(return_values="ALL_NEW")
+            self.idLimit = res["Attributes"]["value"]
+            self.runningId = self.idLimit - 1000
+            return self.runningId
 
 
 def cleanup(uri):
@@ -786,12 +1312,11 @@ if __name__ == '__main__':
     elif argv[2] == "createTable":
         DynamoFS(argv[1]).createTable()
     else:
-        fg = False
-        if len(argv) == 4:
-            fg = "fg" in argv[3].split(",")
-        dynamoFS = DynamoFS(argv[1])
+        options = argv[3].split(",") if len(argv) == 4 else []
+        fg = "fg" in options
+        dynamoFS = DynamoFS(argv[1], options)
         dynamofuse.ioc = injector.Injector([DynamoFuseInjector(dynamoFS)])
-        fuse = FUSE(dynamoFS, argv[2], foreground=fg, nothreads=not MULTITHREADED, default_permissions=False,
+        fuse = DynamoFUSE(dynamoFS, argv[2], foreground=fg, nothreads=not MULTITHREADED, default_permissions=False,
             auto_cache=False, hard_remove=True,
             noauto_cache=True, kernel_cache=False, direct_io=True, allow_other=True, use_ino=True, attr_timeout=0)
 
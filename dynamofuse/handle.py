@@ -0,0 +1,182 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import logging
+
+handleLog = logging.getLogger("dynamo-fuse-handle")
+
+class FileHandle(object):
+    """
+    State of one open file between open/create and release.
+    Holds the record resolved at open time so read/write don't fetch it again on every call.
+    The record is re-read when the handle is marked stale (local change through another handle or path),
+    when another client changed it (version conflict on save), once it is older than the record cache TTL and
+    when a read reaches its end of file.
+    Written data may be held in writeBuffer, and the size and modification time of written data in
+    pendingSize/pendingTime, until the handle is flushed. Until then the writes are kept in pendingWrites with the
+    blockId they were stored under, to be written again if the blocks of the file are replaced meanwhile. Writes through an append handle (O_APPEND) go to the end of the file.
+    """
+
+    def __init__(self, fh, path, record, fileLock, readAhead=None, writeBuffer=None, append=False):
+        self.fh = fh
+        self.path = path
+        self.record = record
+        self.fileLock = fileLock
+        self.readAhead = readAhead
+        self.writeBuffer = writeBuffer
+        self.append = append
+        self.pendingSize = 0
+        self.pendingTime = 0
+        self.pendingSince = None
+        self.pendingWrites = []
+        self.pendingBytes = 0
+        self.stale = False
+        self.loaded = time()
+
+    def isDirty(self):
+        return self.writeBuffer is not None and self.writeBuffer.isDirty() or self.hasPendingAttrs()
+
+    def dirtySize(self):
+        return max(self.pendingSize, self.writeBuffer.end() if self.writeBuffer is not None else 0)
+
+    def hasPendingAttrs(self):
+        return self.pendingSince is not None
+
+    def deferAttrs(self, size, mtime, writes=()):
+        """writes is a list of (blockId, offset, data)"""
+        if self.pendingSince is None:
+            self.pendingSince = time()
+        self.pendingSize = max(self.pendingSize, size)
+        self.pendingTime = max(self.pendingTime, mtime)
+        self.pendingWrites.extend(writes)
+        self.pendingBytes += sum(len(data) for (unused, unused, data) in writes)
+
+    def takePendingAttrs(self):
+        pending = (self.pendingSize, self.pendingTime, self.pendingWrites)
+        self.pendingSize = 0
+        self.pendingTime = 0
+        self.pendingSince = None
+        self.pendingWrites = []
+        self.pendingBytes = 0
+        return pending
+
+    def update(self, path, record):
+        self.path = path
+        self.record = record
+        self.stale = False
+        self.loaded = time()
+
+    def isExpired(self, ttl):
+        """The record is older than ttl - changes of other clients (e.g. appends) are picked up after that. 0 - always"""
+        return not ttl or time() - self.loaded > ttl
+
+
+class FileHandleTable(object):
+
+    def __init__(self):
+        self.handles = dict()
+        self.handlesLock = Lock()
+
+    def add(self, fh, path, record, fileLock=None, readAhead=None, writeBuffer=None, append=False):
+        with self.handlesLock:
+            handleLog.debug("    handle %d - open %s", fh, path)
+            self.handles[fh] = FileHandle(fh, path, record, fileLock, readAhead, writeBuffer, append)
+
+    def get(self, fh):
+        if fh is None:
+            return None
+        with self.handlesLock:
+            return self.handles.get(fh, None)
+
+    def remove(self, fh):
+        with self.handlesLock:
+            handle = self.handles.pop(fh, None)
+            if handle:
+                handleLog.debug("    handle %d - released %s", fh, handle.path)
+            return handle
+
+    def invalidate(self, path, exceptFh=None):
+        with self.handlesLock:
+            for handle in self.handles.itervalues():
+                if handle.path != path:
+                    continue
+                # Prefetched blocks may be out of date for every handle, including the one which made the change
+                if handle.readAhead:
+                    handle.readAhead.reset()
+                if handle.fh != exceptFh:
+                    handleLog.debug("    handle %d - stale %s", handle.fh, path)
+                    handle.stale = True
+
+    def forPath(self, path):
+        with self.handlesLock:
+            return [handle for handle in self.handles.itervalues() if handle.path == path]
+
+    def dirtyForPath(self, path):
+        with self.handlesLock:
+            return [handle for handle in self.handles.itervalues() if handle.path == path and handle.isDirty()]
+
+
+class DirectoryHandle(object):
+    """
+    Listing position of one open directory between opendir and releasedir.
+    The names of the last entries returned by readdir are kept by their offsets, so that the next readdir
+    resumes the listing after the entry the kernel asks for instead of listing the directory from the start.
+    """
+    MAX_POSITIONS = 64
+
+    def __init__(self, fh, path):
+        self.fh = fh
+        self.path = path
+        self.positions = OrderedDict() # offset -> name, oldest first
+
+    def remember(self, offset, name):
+        self.positions[offset] = name
+        while len(self.positions) > self.MAX_POSITIONS:
+            self.positions.popitem(last=False)
+
+    def nameAt(self, offset):
+        return self.positions.get(offset, None)
+
+
+class DirectoryHandleTable(object):
+
+    def __init__(self):
+        self.handles = dict()
+        self.handlesLock = Lock()
+
+    def add(self, fh, path):
+        with self.handlesLock:
+            handleLog.debug("    handle %d - opendir %s", fh, path)
+            self.handles[fh] = DirectoryHandle(fh, path)
+
+    def get(self, fh):
+        if fh is None:
+            return None
+        with self.handlesLock:
+            return self.handles.get(fh, None)
+
+    def remove(self, fh):
+        with self.handlesLock:
+            handle = self.handles.pop(fh, None)
+            if handle:
+                handleLog.debug("    handle %d - releasedir %s", fh, handle.path)
+            return handle
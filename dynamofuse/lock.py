@@ -28,7 +28,7 @@ import logging
 import cStringIO
 import uuid
 from time import time, sleep
-from threading import Lock, current_thread
+from threading import Lock, Thread, Event, current_thread
 import traceback
 
 if not hasattr(__builtins__, 'bytes'):
@@ -37,6 +37,29 @@ if not hasattr(__builtins__, 'bytes'):
 MAX_LOCK_RETRIES = 5
 lockLog = logging.getLogger("dynamo-fuse-lock  ")
 
+def expiredLease(accessor, path):
+    """Returns the lock id of an expired write lease on path (its client is gone), None if there is none"""
+    record = accessor.getItemOrNone(path, attrs=['writeLock', 'writeLease'])
+    if record is not None and 'writeLock' in record and 'writeLease' in record and record['writeLease'] < time():
+        return record['writeLock']
+    return None
+
+def saveWriteLock(accessor, path, item):
+    """Conditional save of the writeLock of item, taking over an expired lease. Returns False if the file is locked"""
+    try:
+        item.save(expected_value={'writeLock': False, 'readLock': 0})
+        return True
+    except DynamoDBConditionalCheckFailedError:
+        expired = expiredLease(accessor, path)
+        if expired is None:
+            return False
+    lockLog.debug("   Taking over expired lease %s on %s", expired, path)
+    try:
+        item.save(expected_value={'writeLock': expired, 'readLock': 0})
+        return True
+    except DynamoDBConditionalCheckFailedError:
+        return False
+
 class DynamoLock:
     log = logging.getLogger("dynamo-fuse-lock  ")
 
@@ -200,6 +223,8 @@ class DynamoWriteLock:
         self.accessor = accessor
         self.item = item
         self.acquired = 0
+        # One entry per __enter__, True for the ones which borrowed the write lease of the file
+        self.borrowed = []
         self.lockId = uuid.uuid4().hex
         self.lockManager = dynamofuse.ioc.get(FileLockManager)
 
@@ -251,17 +276,17 @@ class DynamoWriteLock:
             "name": os.path.basename(self.path)
         })
         item.put_attribute('writeLock', self.lockId)
+        # In case an expired lease is taken over
+        item.delete_attribute('writeLease')
         retries = 0
         while retries < MAX_LOCK_RETRIES or wait:
-            try:
-                item.save(expected_value={'writeLock': False, 'readLock': 0})
+            if saveWriteLock(self.accessor, self.path, item):
                 self.log.debug("   Got the write lock on %s", self.path)
                 self.acquired += 1
                 return
-            except DynamoDBConditionalCheckFailedError:
-                # Somone acquired the write lock before us
-                sleep(1)
-                retries += 1
+            # Somone acquired the write lock before us
+            sleep(1)
+            retries += 1
         self.log.debug("   CANNOT write lock %s", self.path)
         #        self.__exit__()
         raise FuseOSError(EAGAIN)
@@ -276,11 +301,14 @@ class DynamoWriteLock:
                 self.__lockImpl(wait)
             else:
                 with fileLock:
-                    if fileLock.hasWriteLock(fs.getLockOwner()):
-                        self.acquired += 2 # One for existing lock, one for this lock. Ensures unlock will not bother dynamo
-                        self.log.debug("   Overlapping write lock %d", self.acquired)
-                    else:
-                        self.__lockImpl(wait)
+                    if fileLock.hasLease() or fileLock.hasWriteLock(fs.getLockOwner()):
+                        # The lease or the POSIX lock is the lock, nothing to release on exit. Not counted in acquired,
+                        # the lock object is reused by the open file and may later be entered without them
+                        self.borrowed.append(True)
+                        self.log.debug("   Overlapping write lock on %s", self.path)
+                        return
+                    self.__lockImpl(wait)
+        self.borrowed.append(False)
 
     def __unlockImpl(self):
         self.acquired -= 1
@@ -301,6 +329,8 @@ class DynamoWriteLock:
     def __exit__(self, type=None, value=None, traceback=None):
 #        fs = dynamofuse.ioc.get(dynamofuse.FileSystem)
 #        return self.unlock(fs.getLockOwner())
+        if self.borrowed and self.borrowed.pop():
+            return
         self.__unlockImpl()
 
     @classmethod
@@ -308,6 +338,106 @@ class DynamoWriteLock:
         attrs['writeLock'] = uuid.uuid4().hex
 
 
+class WriteLease(object):
+    """
+    Exclusive write lock on a file held by this mount while the file is open, so that writes don't lock and unlock
+    the file in DynamoDB every time. It is stored as a writeLock, with its expiry time in writeLease, so other clients
+    wait for it like for any write lock. A background thread renews the lease, other clients take it over if it
+    expires (the mount is gone).
+    """
+    log = logging.getLogger("dynamo-fuse-lock  ")
+
+    def __init__(self, path, accessor, duration):
+        self.path = path
+        self.accessor = accessor
+        self.duration = duration
+        self.lockId = uuid.uuid4().hex
+        self.expires = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.renewer = None
+
+    def isHeld(self):
+        return time() < self.expires
+
+    def acquire(self):
+        with self.lock:
+            remaining = self.expires - time()
+            if remaining > self.duration / 2:
+                return
+            if remaining > 0 and self.renew():
+                return
+
+            self.log.debug("   Acquiring write lease on %s", self.path)
+            item = self.newItem()
+            item.put_attribute('writeLock', self.lockId)
+            expires = time() + self.duration
+            item.put_attribute('writeLease', int(expires) + 1)
+            retries = 0
+            while not saveWriteLock(self.accessor, self.path, item):
+                retries += 1
+                if retries >= MAX_LOCK_RETRIES:
+                    self.log.debug("   CANNOT lease %s", self.path)
+                    raise FuseOSError(EAGAIN)
+                sleep(1)
+                expires = time() + self.duration
+                item.put_attribute('writeLease', int(expires) + 1)
+            self.expires = expires
+            self.log.debug("   Got the write lease on %s", self.path)
+
+            if self.renewer is None:
+                self.renewer = Thread(target=self.renewLoop)
+                self.renewer.daemon = True
+                self.renewer.start()
+
+    def renew(self):
+        item = self.newItem()
+        expires = time() + self.duration
+        item.put_attribute('writeLease', int(expires) + 1)
+        try:
+            item.save(expected_value={'writeLock': self.lockId})
+            self.expires = expires
+            return True
+        except DynamoDBConditionalCheckFailedError:
+            self.log.debug("   Lost the write lease on %s", self.path)
+            self.expires = 0
+            return False
+
+    def renewLoop(self):
+        while not self.stopped.wait(self.duration / 3):
+            with self.lock:
+                if not self.isHeld():
+                    continue
+                try:
+                    self.renew()
+                except Exception, e:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    self.log.error("  Unable to renew write lease on %s: %s", self.path,
+                        "".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+
+    def release(self):
+        self.stopped.set()
+        with self.lock:
+            if not self.isHeld():
+                return
+            self.expires = 0
+            self.log.debug("   Releasing write lease on %s", self.path)
+            item = self.newItem()
+            item.delete_attribute('writeLock')
+            item.delete_attribute('writeLease')
+            try:
+                item.save(expected_value={'writeLock': self.lockId})
+            except DynamoDBConditionalCheckFailedError:
+                # The file was deleted or moved, or the lease was taken over
+                pass
+
+    def newItem(self):
+        return self.accessor.newItem(attrs={
+            "path": os.path.dirname(self.path),
+            "name": os.path.basename(self.path)
+        })
+
+
 class FileLockManager(object):
 
     def __init__(self):
@@ -401,6 +531,7 @@ class FileLock(object):
         self.locks = dict()
         self.__objectLock = Lock()
         self.counter = 1
+        self.lease = None
 
 #        if path == "/a":
 #            if FileLock.locksHandle is not None: lockLog.debug("    file lock - locksHandle is not None")
@@ -446,6 +577,9 @@ class FileLock(object):
     def hasWriteLock(self, lock_owner):
         return lock_owner in self.locks and type(self.locks[lock_owner]) == str
 
+    def hasLease(self):
+        return self.lease is not None and self.lease.isHeld()
+
     def unlock(self, lock_owner):
         if lock_owner not in self.locks:
             lockLog.debug("    file lock %s %d - not locked", self.path, lock_owner)
@@ -0,0 +1,97 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from threading import Condition, Thread
+import logging
+import sys
+import traceback
+
+class ReadAhead(object):
+    """
+    Sequential read detector and block prefetcher for one open file.
+    Once the reads become sequential the next `blocks` blocks are fetched in a background thread
+    and kept (at most 2 * `blocks` of them) until the following read picks them up.
+    Any non-sequential read or local modification of the file drops the buffered blocks.
+    """
+    log = logging.getLogger("dynamo-fuse-block ")
+    SEQUENTIAL_READS = 2
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.maxBuffered = blocks * 2
+        self.buffer = dict()
+        self.inFlight = set()
+        self.nextOffset = None
+        self.sequential = 0
+        self.generation = 0
+        self.condition = Condition()
+
+    def take(self, blockNums):
+        with self.condition:
+            while self.inFlight.intersection(blockNums):
+                self.condition.wait()
+            return dict((blockNum, self.buffer.pop(blockNum)) for blockNum in blockNums if blockNum in self.buffer)
+
+    def update(self, file, offset, size, endBlock):
+        with self.condition:
+            if offset == self.nextOffset:
+                self.sequential += 1
+            else:
+                self.sequential = 0
+                self.buffer.clear()
+            self.nextOffset = offset + size
+
+            if self.sequential < self.SEQUENTIAL_READS or self.inFlight:
+                return
+
+            lastBlock = (file["st_size"] - 1) / file.blockSize()
+            blockNums = [blockNum for blockNum in range(endBlock + 1, min(endBlock + self.blocks, lastBlock) + 1)
+                         if not blockNum in self.buffer]
+            if not blockNums or len(self.buffer) + len(blockNums) > self.maxBuffered:
+                return
+            self.inFlight.update(blockNums)
+            generation = self.generation
+
+        self.log.debug("readahead blocks [%d .. %d] of %s", blockNums[0], blockNums[-1], file.path)
+        thread = Thread(target=self.prefetch, args=(file, blockNums, generation))
+        thread.daemon = True
+        thread.start()
+
+    def prefetch(self, file, blockNums, generation):
+        items = {}
+        try:
+            items = file.getBlocks(blockNums, getData=True)
+        except Exception, e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self.log.error("readahead of %s failed: %s", file.path, "".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+        finally:
+            with self.condition:
+                if generation == self.generation:
+                    self.inFlight.difference_update(blockNums)
+                    self.buffer.update(items)
+                self.condition.notify_all()
+
+    def reset(self):
+        with self.condition:
+            self.generation += 1
+            self.buffer.clear()
+            self.inFlight.clear()
+            self.sequential = 0
+            self.nextOffset = None
+            self.condition.notify_all()
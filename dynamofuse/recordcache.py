@@ -0,0 +1,175 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import logging
+import os
+
+class RecordCache(object):
+    """
+    LRU cache of file system records (attributes and directory entries) by path, bounded by the number of entries.
+    The attributes of the record are kept as read, every lookup gets its own copy of them.
+    Any local change of a record (save, delete, create, lock changes) drops its entry, changes made by other
+    clients become visible once the entry is older than `ttl` seconds (0 disables the cache). Saves of an
+    out of date record fail on its version, which drops the entry too.
+    Paths found missing are kept for `missingTtl` seconds, grouped by directory - creating or moving anything
+    into the directory drops them.
+    Access decisions on directories are kept by (path, uid, gid, mode) with the version of the directory they were
+    made on, for `ttl` seconds. A local change of the directory drops them, a newer cached version makes them stale.
+    """
+    log = logging.getLogger("dynamo-fuse-record")
+
+    def __init__(self, maxEntries, ttl, missingTtl=0):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.missingTtl = missingTtl
+        self.entries = OrderedDict() # path -> (attrs, time), least recently used first
+        self.missing = OrderedDict() # (dir, name) -> time, oldest first
+        self.missingDirs = dict() # dir -> set of names
+        self.access = OrderedDict() # (path, uid, gid, mode) -> (version, allowed, time), oldest first
+        self.accessPaths = dict() # path -> set of keys
+        self.hits = 0
+        self.misses = 0
+        self.missingHits = 0
+        self.accessHits = 0
+        self.lock = Lock()
+
+    def get(self, path):
+        """Returns a copy of the cached attributes of the record or None"""
+        if not self.maxEntries or not self.ttl:
+            return None
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None or time() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries[path] = entry
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, path, attrs):
+        if not self.maxEntries or not self.ttl:
+            return
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (dict(attrs), time())
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def isMissing(self, path):
+        if not self.maxEntries or not self.missingTtl:
+            return False
+        key = (os.path.dirname(path), os.path.basename(path))
+        with self.lock:
+            missingTime = self.missing.get(key, None)
+            if missingTime is None:
+                return False
+            if time() - missingTime > self.missingTtl:
+                self._dropMissing(key)
+                return False
+            self.missingHits += 1
+            return True
+
+    def putMissing(self, path):
+        if not self.maxEntries or not self.missingTtl:
+            return
+        key = (os.path.dirname(path), os.path.basename(path))
+        with self.lock:
+            self._dropMissing(key)
+            self.missing[key] = time()
+            self.missingDirs.setdefault(key[0], set()).add(key[1])
+            while len(self.missing) > self.maxEntries:
+                self._dropMissing(next(iter(self.missing)))
+
+    def _dropMissing(self, key):
+        if self.missing.pop(key, None) is not None:
+            names = self.missingDirs[key[0]]
+            names.discard(key[1])
+            if not names:
+                del self.missingDirs[key[0]]
+
+    def getAccess(self, path, uid, gid, mode):
+        """Returns the access decision made before, or None"""
+        if not self.maxEntries or not self.ttl:
+            return None
+        key = (path, uid, gid, mode)
+        with self.lock:
+            decision = self.access.get(key, None)
+            if decision is None:
+                return None
+            (version, allowed, decisionTime) = decision
+            entry = self.entries.get(path, None)
+            if time() - decisionTime > self.ttl or entry is not None and entry[0]["version"] != version:
+                self._dropAccess(key)
+                return None
+            self.accessHits += 1
+            return allowed
+
+    def putAccess(self, path, uid, gid, mode, version, allowed):
+        if not self.maxEntries or not self.ttl:
+            return
+        key = (path, uid, gid, mode)
+        with self.lock:
+            self._dropAccess(key)
+            self.access[key] = (version, allowed, time())
+            self.accessPaths.setdefault(path, set()).add(key)
+            while len(self.access) > self.maxEntries:
+                self._dropAccess(next(iter(self.access)))
+
+    def _dropAccess(self, key):
+        if self.access.pop(key, None) is not None:
+            keys = self.accessPaths[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.accessPaths[key[0]]
+
+    def _dropPathAccess(self, path):
+        for key in list(self.accessPaths.get(path, ())):
+            self._dropAccess(key)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+            self._dropMissing((os.path.dirname(path), os.path.basename(path)))
+            self._dropPathAccess(path)
+
+    def invalidateMissing(self, dir):
+        """Something was added to the directory"""
+        with self.lock:
+            for name in list(self.missingDirs.get(dir, ())):
+                self._dropMissing((dir, name))
+
+    def invalidateTree(self, path):
+        """Drops the path and everything under it - the paths of the entries of a moved directory change"""
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            for cached in [cached for cached in self.entries.keys() if cached == path or cached.startswith(prefix)]:
+                del self.entries[cached]
+            for key in [key for key in self.missing.keys() if key[0] == path or key[0].startswith(prefix)]:
+                self._dropMissing(key)
+            for accessPath in [accessPath for accessPath in self.accessPaths.keys() if accessPath == path or accessPath.startswith(prefix)]:
+                self._dropPathAccess(accessPath)
+            self._dropMissing((os.path.dirname(path), os.path.basename(path)))
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), missingHits=self.missingHits,
+                missing=len(self.missing), accessHits=self.accessHits, access=len(self.access))
@@ -20,137 +20,419 @@ from errno import EACCES, ENOENT, EINVAL, EEXIST, EOPNOTSUPP, EIO, EAGAIN
 from os.path import realpath
 from threading import Lock
 import boto.dynamodb
-from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError, DynamoDBConditionalCheckFailedError
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from datetime import datetime, timedelta
 from boto.dynamodb.condition import EQ, GT
 from boto.dynamodb.types import Binary
 import os
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 import logging
-from collections import deque
 import sys
 import cStringIO
+import hashlib
+from time import sleep
+from dynamofuse.codec import encodeBlock, decodeBlock
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
-blockCache = dict()
-blockHistory = deque()
 blockLog = logging.getLogger("dynamo-fuse-block ")
-BLOCK_CACHE_ENABLED=False
+# BatchGetItem limits - 100 keys and 16MB of data per request
+MAX_BATCH_GET_KEYS = 100
+MAX_BATCH_GET_BYTES = 16 * 1024 * 1024
+# BatchWriteItem limit - 25 items per request
+MAX_BATCH_WRITE_ITEMS = 25
+MAX_BATCH_RETRIES = 10
+# Largest block which fits into a DynamoDB item (400KB) with its keys and attributes
+MAX_BLOCK_SIZE = 384 * 1024
+# Block size of the files which don't have st_blksize (created or renamed before it was kept)
+LEGACY_BLOCK_SIZE = 32768
+ZERO_DATA = memoryview("\0" * MAX_BLOCK_SIZE)
+
+def isZeroData(data):
+    """data is a str, bytearray or memoryview - compared without copying it"""
+    if len(data) <= len(ZERO_DATA):
+        return ZERO_DATA[:len(data)] == data
+    return bytearray(data).count("\0") == len(data)
+
+def assembleBlock(itemData, startOffset, dataSlice):
+    """
+    Returns the block data itemData with dataSlice (str or memoryview) written at startOffset, the gap past the end
+    of itemData is a hole. A slice which replaces all of the data is copied once, otherwise the kept parts of
+    itemData and the slice are joined - the result can't be built in place, boto needs an immutable str.
+    """
+    end = startOffset + len(dataSlice)
+    if isinstance(dataSlice, memoryview):
+        dataSlice = dataSlice.tobytes()
+    if startOffset == 0 and end >= len(itemData):
+        return dataSlice
+    return "".join((itemData[0:startOffset], "\0" * (startOffset - len(itemData)), dataSlice, itemData[end:]))
+
+def blockKey(blockId, blockNum, stripes=1):
+    """
+    Hash key of a block. The blocks of a striped file are spread over `stripes` keys blockId#(blockNum mod stripes),
+    so that they land on different partitions of the table
+    """
+    return blockId if stripes <= 1 else "%s#%d" % (blockId, blockNum % stripes)
+
+def stripeKeys(blockId, stripes=1):
+    """Hash keys of all the blocks of a file"""
+    return [blockId] if stripes <= 1 else ["%s#%d" % (blockId, stripe) for stripe in range(stripes)]
+
+def contentId(data):
+    """Key of the shared content item holding data (with blockNum 0), can't clash with the numeric blockIds of files"""
+    return "sha1:" + hashlib.sha1(data).hexdigest()
 
 class BlockRecord:
-    BLOCK_ATTRS = ['version', "blockId", "blockNum"]
-    BLOCK_ALL_ATTRS = ["data"] + BLOCK_ATTRS
+    """
+    Block of file data. Blocks of files with deduplication don't hold the data themselves - their "hash" attribute
+    refers to a content item shared by all blocks with the same data, which counts its references in "refCount".
+    The path is blockId/blockNum of the file, the item is stored under blockKey() (see stripes); the caches use the path.
+    """
+    # hash is set in the blocks of files with deduplication, applied in the blocks of files with logged writes (see DeltaRecord)
+    BLOCK_ATTRS = ['version', "blockId", "blockNum", "hash", "applied"]
+    # codec and rawSize form the header of a compressed block, blocks without them are stored as is
+    BLOCK_ALL_ATTRS = ["data", "codec", "rawSize"] + BLOCK_ATTRS
+    CONTENT_ATTRS = ["blockId", "data", "codec", "rawSize"]
 
     log = logging.getLogger("dynamo-fuse-block ")
 
-    def __init__(self, accessor, path):
+    def __init__(self, accessor, path, codec=None, dedup=False, cached=True, stripes=1):
         self.accessor = accessor
         self.path = path
+        self.blockId = os.path.dirname(path)
+        self.blockNum = long(os.path.basename(path))
+        self.codec = codec
+        self.dedup = dedup
+        self.cached = cached
+        self.stripes = stripes
         self.item = None
+        self.fileVersion = None
 
-    def read(self, getData=False, forUpdate=False):
-        self.item = BlockRecord.getBlockItem(self.accessor, self.path, getData, forUpdate)
+    def read(self, getData=False, forUpdate=False, fileVersion=None):
+        self.fileVersion = fileVersion
+        self.item = BlockRecord.getBlockItem(self.accessor, self.path, getData, forUpdate, fileVersion, self.cached, self.stripes)
         return self
 
-    def create(self, attrs):
+    def create(self, attrs, fileVersion=None):
+        self.fileVersion = fileVersion
         attrs["version"] = 1
         self.item = self.accessor.blockTable.new_item(attrs=attrs)
         self.item.put(expected_value={'blockId':False, 'blockNum':False})
-        if BLOCK_CACHE_ENABLED: BlockRecord.cacheItem(self.path, self.item, self.item["version"])
         return self
 
     def __getitem__(self, key):
         return self.item[key]
 
     def __setitem__(self, key, value):
-        self.item[key] = value
+        if key == "data" and self.dedup:
+            # Stored in the content item on save
+            dict.__setitem__(self.item, key, value)
+        else:
+            self.item[key] = value
         return value
 
     def __contains__(self, item):
         return item in self.item
 
-    def save(self):
+    def save(self, conditional=False):
+        """With conditional the save fails if the block has been changed since it was read"""
+        data = self.item["data"].value if "data" in self.item else None
+        oldContent = None
+        if self.dedup and data is not None:
+            content = contentId(data)
+            if self.item.get("hash", None) == content:
+                self.log.debug("block %s content is unchanged", self.path)
+                return
+            BlockRecord.refContent(self.accessor, content, data, self.codec)
+            oldContent = self.item.get("hash", None)
+            self.item["hash"] = content
+        elif data is not None:
+            (codec, payload) = encodeBlock(self.codec, data)
+            if codec:
+                self.item["data"] = Binary(payload)
+                self.item["codec"] = codec
+                self.item["rawSize"] = len(data)
+            elif "codec" in self.item:
+                del self.item["codec"]
+                del self.item["rawSize"]
         self.item.add_attribute("version", 1)
-        if BLOCK_CACHE_ENABLED:
-            # Delete this properties before they are saved into DynamoDB. They will be restored next time the item is cached
-            if "updateTime" in self.item: del self.item["updateTime"]
-            if "fullPath" in self.item: del self.item["fullPath"]
-        self.item.save()
-        if BLOCK_CACHE_ENABLED:
-            BlockRecord.cacheItem(self.path, self.item, self.item["version"] + 1)
+        try:
+            self.item.save(expected_value={"version": self.item["version"]} if conditional else None)
+        except DynamoDBConditionalCheckFailedError:
+            if self.dedup and data is not None:
+                BlockRecord.unrefContent(self.accessor, self.item["hash"])
+            raise
+        dict.__setitem__(self.item, "version", self.item["version"] + 1)
+        if oldContent:
+            BlockRecord.unrefContent(self.accessor, oldContent)
+        if data is not None:
+            # The local item keeps the decoded data
+            dict.__setitem__(self.item, "data", Binary(data))
+        if self.accessor.diskCache:
+            self.accessor.diskCache.drop(self.blockId, self.blockNum)
+        if not self.cached:
+            self.accessor.blockCache.drop(self.blockId, self.blockNum)
+        elif "data" in self.item:
+            self.accessor.blockCache.put(self.blockId, self.blockNum, self.item["version"], self.item["data"].value, self.fileVersion)
 
-    def writeData(self, startOffset, dataSlice):
-        if "data" in self.item:
-            self.log.debug("write block %s has data", self.path)
-            itemData = self.item["data"].value
-            self.item['data'] = Binary(itemData[0:startOffset] + dataSlice + itemData[startOffset + len(dataSlice):])
+    def delete(self, conditional=False):
+        self.item.delete(expected_value={"version": self.item["version"]} if conditional else None)
+        if "hash" in self.item:
+            BlockRecord.unrefContent(self.accessor, self.item["hash"])
+        BlockRecord.dropBlock(self.accessor, self.blockId, self.blockNum)
+
+    @staticmethod
+    def deleteItems(accessor, entries):
+        """Deletes the block items returned by a query, releasing their content"""
+        for entry in entries:
+            entry.delete()
+            if entry["hash"]:
+                BlockRecord.unrefContent(accessor, entry["hash"])
+
+    @staticmethod
+    def refContent(accessor, content, data, codec=None):
+        item = accessor.blockTable.new_item(content, 0)
+        item.add_attribute("refCount", 1)
+        res = item.save(return_values="UPDATED_OLD")
+        refCount = res.get("Attributes", {}).get("refCount", None)
+        # Data of an existing content item is not uploaded again
+        if refCount is None or refCount <= 0:
+            blockLog.debug("storing new content %s, %d bytes", content, len(data))
+            (codec, payload) = encodeBlock(codec, data)
+            item = accessor.blockTable.new_item(content, 0)
+            item["data"] = Binary(payload)
+            if codec:
+                item["codec"] = codec
+                item["rawSize"] = len(data)
+            item.save()
         else:
-            self.log.debug("write block %s has NO data", self.path)
-            self.item['data'] = Binary(dataSlice)
+            blockLog.debug("content %s already stored, references %d", content, refCount + 1)
 
     @staticmethod
-    def getBlockItem(accessor, path, getData=False, forUpdate=False):
+    def unrefContent(accessor, content):
+        item = accessor.blockTable.new_item(content, 0)
+        item.add_attribute("refCount", -1)
+        res = item.save(return_values="UPDATED_NEW")
+        refCount = res["Attributes"]["refCount"]
+        if refCount <= 0:
+            try:
+                item.delete(expected_value={"refCount": refCount})
+                blockLog.debug("deleted unreferenced content %s", content)
+            except DynamoDBConditionalCheckFailedError:
+                # Referenced again in the meantime
+                pass
+
+    def writeData(self, startOffset, dataSlice):
+        self.log.debug("write block %s %s data", self.path, "has" if "data" in self.item else "has NO")
+        self['data'] = Binary(assembleBlock(self.item["data"].value if "data" in self.item else "", startOffset, dataSlice))
+
+    def isZero(self):
+        return not "data" in self.item or isZeroData(self.item["data"].value)
+
+    @staticmethod
+    def getBlockItem(accessor, path, getData=False, forUpdate=False, fileVersion=None, cached=True, stripes=1):
+        blockId = os.path.dirname(path)
+        blockNum = long(os.path.basename(path))
+        # Updates always start from the stored block - the cached one may be behind the writes of other clients
+        if getData and not forUpdate and cached:
+            cached = BlockRecord.getCachedBlock(accessor, blockId, blockNum, fileVersion)
+            if cached:
+                blockLog.debug('Returning cached block item for %s', path)
+                return BlockRecord.cachedItem(blockId, blockNum, cached)
         try:
-            blockItem = accessor.blockTable.get_item(os.path.dirname(path), long(os.path.basename(path)),
+            blockItem = accessor.blockTable.get_item(blockKey(blockId, blockNum, stripes), blockNum,
                 attributes_to_get=(BlockRecord.BLOCK_ALL_ATTRS if getData else BlockRecord.BLOCK_ATTRS))
         except DynamoDBKeyNotFoundError:
-            blockItem = None
-        cachedBlockItem = BlockRecord.getCachedBlockItem(path, forUpdate) if BLOCK_CACHE_ENABLED else None
-        if not blockItem:
-            if cachedBlockItem and (getData and "data" in cachedBlockItem or not getData):
-                blockLog.debug('Returning cached block item for %s', path)
-                return cachedBlockItem
+            blockLog.debug('Unable to find block for %s', path)
+            raise FuseOSError(ENOENT)
+        if getData and "hash" in blockItem:
+            BlockRecord.resolveContent(accessor, [blockItem])
+        BlockRecord.decode(blockItem)
+        if "data" in blockItem and cached:
+            BlockRecord.cacheBlock(accessor, blockId, blockNum, blockItem["version"], blockItem["data"].value, fileVersion)
+        return blockItem
+
+    @staticmethod
+    def decode(item):
+        if "codec" in item and "data" in item:
+            dict.__setitem__(item, "data", Binary(decodeBlock(item["codec"], item["data"].value, item["rawSize"])))
+        return item
+
+    @staticmethod
+    def getCachedBlock(accessor, blockId, blockNum, fileVersion=None):
+        cached = accessor.blockCache.get(blockId, blockNum, fileVersion)
+        if not cached and accessor.diskCache and fileVersion is not None:
+            cached = accessor.diskCache.get(blockId, blockNum, fileVersion)
+            if cached:
+                accessor.blockCache.put(blockId, blockNum, cached[0], cached[1], fileVersion)
+        return cached
+
+    @staticmethod
+    def cacheBlock(accessor, blockId, blockNum, version, data, fileVersion=None):
+        accessor.blockCache.put(blockId, blockNum, version, data, fileVersion)
+        if accessor.diskCache and fileVersion is not None:
+            accessor.diskCache.put(blockId, blockNum, version, fileVersion, data)
+
+    @staticmethod
+    def dropBlock(accessor, blockId, blockNum):
+        accessor.blockCache.drop(blockId, blockNum)
+        if accessor.diskCache:
+            accessor.diskCache.drop(blockId, blockNum)
+
+    @staticmethod
+    def invalidateBlocks(accessor, blockId, fromBlockNum=0):
+        accessor.blockCache.invalidate(blockId, fromBlockNum)
+        if accessor.diskCache:
+            accessor.diskCache.invalidate(blockId, fromBlockNum)
+
+    @staticmethod
+    def fileVersionChanged(accessor, blockId, oldVersion, newVersion):
+        # Our own change of the file - the blocks we didn't touch are still valid for the new version
+        accessor.blockCache.restamp(blockId, oldVersion, newVersion)
+        if accessor.diskCache:
+            accessor.diskCache.restamp(blockId, oldVersion, newVersion)
+
+    @staticmethod
+    def cachedItem(blockId, blockNum, cached):
+        (version, data) = cached
+        return {"blockId": blockId, "blockNum": blockNum, "version": version, "data": Binary(data)}
+
+    @staticmethod
+    def getBlockItems(accessor, blockId, blockNums, getData=False, fileVersion=None, blockSize=None, cached=True, stripes=1):
+        """
+        Reads the given blocks of one file with BatchGetItem. Returns dict of blockNum -> item,
+        blocks which do not exist are not in the result.
+        """
+        attrs = BlockRecord.BLOCK_ALL_ATTRS if getData else BlockRecord.BLOCK_ATTRS
+        chunkSize = max(1, min(MAX_BATCH_GET_KEYS, MAX_BATCH_GET_BYTES / (blockSize or accessor.BLOCK_SIZE)))
+        items = dict()
+        keys = []
+        for blockNum in blockNums:
+            cachedBlock = BlockRecord.getCachedBlock(accessor, blockId, long(blockNum), fileVersion) if getData and cached else None
+            if cachedBlock:
+                items[long(blockNum)] = BlockRecord.cachedItem(blockId, long(blockNum), cachedBlock)
             else:
-                blockLog.debug('Unable to find block or cached block for %s', path)
-                raise FuseOSError(ENOENT)
-        if cachedBlockItem and blockItem["version"] < cachedBlockItem["version"] and (getData and "data" in cachedBlockItem or not getData):
-            blockLog.debug('Returning cached block item for %s', path)
-            return cachedBlockItem
-        else:
-            try:
-                del blockCache[path]
-            except:
-                pass
-            try:
-                blockHistory.remove(blockItem)
-            except:
-                pass
-            return blockItem
-
-    @staticmethod
-    def getCachedBlockItem(path, forUpdate=False):
-        if forUpdate:
-            item = blockCache.pop(path, None)
-            # Need to remove the item because the next update will put it in at different offset
-            if item:
-                try:
-                    blockHistory.remove(item)
-                except:
-                    pass
-            return item
-        else:
-            return blockCache.get(path, None)
+                keys.append((blockKey(blockId, long(blockNum), stripes), long(blockNum)))
+        fetched = BlockRecord.batchGet(accessor, keys, attrs, chunkSize, blockId)
+        if getData:
+            BlockRecord.resolveContent(accessor, [item for item in fetched if "hash" in item], chunkSize)
+        for item in fetched:
+            BlockRecord.decode(item)
+            items[long(item['blockNum'])] = item
+            if "data" in item and cached:
+                BlockRecord.cacheBlock(accessor, blockId, long(item['blockNum']), item["version"], item["data"].value, fileVersion)
+        return items
 
     @staticmethod
-    def cacheItem(path, item, version):
-        blockLog.debug('Caching block for %s', path)
-        item["version"] = version
-        item["updateTime"] = datetime.now()
-        item["fullPath"] = path
-        blockCache[path] = item
-        blockHistory.append(item)
-        BlockRecord.expellExpiredBlocks()
+    def createBlocks(accessor, blockId, blocks, codec=None, stripes=1, fileVersion=None):
+        """
+        Stores new blocks, given as a list of (blockNum, data), with BatchWriteItem. Unlike create() the puts are
+        not conditional, so it is only for blocks nobody else can be writing: of a new blockId or past the end of a locked file.
+        """
+        tableName = accessor.blockTable.name
+        items = dict()
+        for (blockNum, data) in blocks:
+            items[long(blockNum)] = BlockRecord.newBlockItem(accessor, blockId, long(blockNum), data, codec, stripes)
+        pending = sorted(items.keys())
+        retries = 0
+        while pending:
+            sent = pending[:MAX_BATCH_WRITE_ITEMS]
+            batch = accessor.conn.new_batch_write_list()
+            batch.add_batch(accessor.blockTable, puts=[items[blockNum] for blockNum in sent])
+            res = batch.submit()
+            pending = pending[MAX_BATCH_WRITE_ITEMS:]
+
+            unprocessed = res.get('UnprocessedItems', {}).get(tableName, [])
+            # Counted per request which made no progress, throttling of some of the items is normal for large writes
+            retries = retries + 1 if len(unprocessed) == len(sent) else 0
+            if unprocessed:
+                # Throttled - put the blocks back in front and back off before sending them again
+                if retries > MAX_BATCH_RETRIES:
+                    blockLog.error('Unable to write blocks of %s - too many unprocessed items', blockId)
+                    raise FuseOSError(EIO)
+                blockLog.debug('Batch write of %s has %d unprocessed items, retry %d', blockId, len(unprocessed), retries)
+                pending = [long(request['PutRequest']['Item']['blockNum']) for request in unprocessed] + pending
+                sleep(min(0.05 * (2 ** retries), 1))
+
+        for (blockNum, data) in blocks:
+            BlockRecord.dropBlock(accessor, blockId, long(blockNum))
+            accessor.blockCache.put(blockId, long(blockNum), 1, data, fileVersion)
 
     @staticmethod
-    def expellExpiredBlocks():
-        now = datetime.now()
-        EXPELL_DELTA = timedelta(seconds=2)
-        while len(blockHistory) > 0 and (now - blockHistory[0]["updateTime"]) > EXPELL_DELTA:
-            block = blockHistory.popleft()
-            try:
-                del blockCache[block["fullPath"]]
-            except:
-                pass
\ No newline at end of file
+    def createBlock(accessor, blockId, blockNum, data, codec=None, stripes=1, applied=0, fileVersion=None):
+        """
+        Stores a new block with its data, without reading it first. Returns False if the block exists.
+        applied is the last logged write folded into the data (see DeltaRecord)
+        """
+        item = BlockRecord.newBlockItem(accessor, blockId, blockNum, data, codec, stripes)
+        if applied:
+            item["applied"] = applied
+        try:
+            item.put(expected_value={'blockId': False, 'blockNum': False})
+        except DynamoDBConditionalCheckFailedError:
+            return False
+        BlockRecord.dropBlock(accessor, blockId, blockNum)
+        accessor.blockCache.put(blockId, blockNum, 1, data, fileVersion)
+        return True
+
+    @staticmethod
+    def newBlockItem(accessor, blockId, blockNum, data, codec=None, stripes=1):
+        (blockCodec, payload) = encodeBlock(codec, data)
+        attrs = {"data": Binary(payload), "version": 1}
+        if blockCodec:
+            attrs["codec"] = blockCodec
+            attrs["rawSize"] = len(data)
+        return accessor.blockTable.new_item(blockKey(blockId, blockNum, stripes), blockNum, attrs=attrs)
+
+    @staticmethod
+    def resolveContent(accessor, items, chunkSize=MAX_BATCH_GET_KEYS):
+        """Fills in the data of deduplicated blocks from their content items"""
+        if not items:
+            return
+        contents = dict()
+        pending = set(item["hash"] for item in items)
+        retries = 0
+        while pending:
+            found = len(contents)
+            for content in BlockRecord.batchGet(accessor, [(content, 0) for content in pending], BlockRecord.CONTENT_ATTRS, chunkSize, "content"):
+                # A new content item exists before its data is uploaded
+                if "data" in content:
+                    contents[content["blockId"]] = BlockRecord.decode(content)["data"]
+            pending.difference_update(contents.keys())
+            retries = retries + 1 if len(contents) == found else 0
+            if pending:
+                if retries > MAX_BATCH_RETRIES:
+                    blockLog.error('Unable to read content %s', ", ".join(pending))
+                    raise FuseOSError(EIO)
+                sleep(min(0.05 * (2 ** retries), 1))
+        for item in items:
+            dict.__setitem__(item, "data", contents[item["hash"]])
+
+    @staticmethod
+    def batchGet(accessor, keys, attrs, chunkSize, name):
+        """BatchGetItem of the keys from the block table, retrying the unprocessed ones. Returns the list of found items"""
+        tableName = accessor.blockTable.name
+        items = []
+        retries = 0
+        while keys:
+            sent = keys[:chunkSize]
+            batch = accessor.conn.new_batch_list()
+            batch.add_batch(accessor.blockTable, sent, attributes_to_get=attrs)
+            res = batch.submit()
+            keys = keys[chunkSize:]
+            if tableName in res['Responses']:
+                items.extend(res['Responses'][tableName]['Items'])
+
+            unprocessed = res['UnprocessedKeys'][tableName]['Keys'] if tableName in res.get('UnprocessedKeys', {}) else []
+            # Counted per request which made no progress
+            retries = retries + 1 if len(unprocessed) == len(sent) else 0
+            if unprocessed:
+                # Throttled - put the keys back in front and back off before asking again
+                if retries > MAX_BATCH_RETRIES:
+                    blockLog.error('Unable to read blocks of %s - too many unprocessed keys', name)
+                    raise FuseOSError(EIO)
+                blockLog.debug('Batch read of %s has %d unprocessed keys, retry %d', name, len(unprocessed), retries)
+                keys = [(key['HashKeyElement'], long(key['RangeKeyElement'])) for key in unprocessed] + keys
+                sleep(min(0.05 * (2 ** retries), 1))
+        return items
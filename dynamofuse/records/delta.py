@@ -0,0 +1,151 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__ = 'Denis Mikhalkin'
+
+from dynamofuse.records.block import BlockRecord, blockKey
+from errno import EAGAIN
+from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError, DynamoDBConditionalCheckFailedError
+from boto.dynamodb.types import Binary
+from fuse import FuseOSError
+from time import sleep
+import logging
+import random
+import struct
+
+EXTENT_HEADER = struct.Struct("<QII") # seq, offset in the block, length
+MAX_DELTA_RETRIES = 8
+
+def deltaNum(blockNum):
+    """The delta of a block is kept under the blockId of the file, with a negative blockNum"""
+    return -(blockNum + 1)
+
+def encodeExtents(extents):
+    return "".join(EXTENT_HEADER.pack(seq, offset, len(data)) + data for (seq, offset, data) in extents)
+
+def decodeExtents(payload):
+    extents = []
+    pos = 0
+    while pos < len(payload):
+        (seq, offset, length) = EXTENT_HEADER.unpack_from(payload, pos)
+        pos += EXTENT_HEADER.size
+        extents.append((seq, offset, payload[pos:pos + length]))
+        pos += length
+    return extents
+
+def applyExtents(data, extents, applied=0):
+    """Applies the extents newer than applied to the block data. Returns (data, the last applied seq)"""
+    for (seq, offset, extentData) in extents:
+        if seq <= applied:
+            continue
+        if len(data) < offset:
+            data += "\0" * (offset - len(data))
+        data = data[0:offset] + extentData + data[offset + len(extentData):]
+        applied = seq
+    return data, applied
+
+class DeltaRecord:
+    """
+    Log of small writes to one block of a file, so that they don't rewrite the whole block.
+    The item keeps the writes as extents (seq, offset, data) in the order they were made, and the last seq.
+    The block records in its "applied" attribute the last seq folded into its data - the extents up to it
+    are skipped when reading and trimmed from the log later. The item is not deleted with its block, so that
+    the seq keeps growing.
+    """
+    ATTRS = ["blockId", "blockNum", "version", "seq", "extents"]
+
+    log = logging.getLogger("dynamo-fuse-block ")
+
+    def __init__(self, accessor, blockId, blockNum, stripes=1):
+        self.accessor = accessor
+        self.blockId = blockId
+        self.blockNum = blockNum
+        # Kept in the stripe of its block
+        self.key = blockKey(blockId, blockNum, stripes)
+
+    def getItem(self):
+        try:
+            return self.accessor.blockTable.get_item(self.key, deltaNum(self.blockNum), attributes_to_get=self.ATTRS)
+        except DynamoDBKeyNotFoundError:
+            return None
+
+    def getExtents(self):
+        item = self.getItem()
+        return decodeExtents(item["extents"].value) if item is not None and "extents" in item else []
+
+    def append(self, offset, data, onlyIfLogged=False):
+        """Adds a write to the log, returns the size of the logged data. With onlyIfLogged only if the log has extents"""
+        retries = 0
+        while True:
+            item = self.getItem()
+            if onlyIfLogged and (item is None or not "extents" in item):
+                return 0
+            try:
+                if item is None:
+                    payload = encodeExtents([(1, offset, data)])
+                    item = self.accessor.blockTable.new_item(self.key, deltaNum(self.blockNum),
+                        attrs={"seq": 1, "version": 1, "extents": Binary(payload)})
+                    item.put(expected_value={'blockId': False, 'blockNum': False})
+                else:
+                    payload = (item["extents"].value if "extents" in item else "") + encodeExtents([(item["seq"] + 1, offset, data)])
+                    item["extents"] = Binary(payload)
+                    item.add_attribute("seq", 1)
+                    item.add_attribute("version", 1)
+                    item.save(expected_value={"version": item["version"]})
+                self.log.debug("delta of %s/%d - %d bytes at %d, %d bytes logged", self.blockId, self.blockNum, len(data), offset, len(payload))
+                return len(payload)
+            except DynamoDBConditionalCheckFailedError:
+                retries += 1
+                if retries >= MAX_DELTA_RETRIES:
+                    raise FuseOSError(EAGAIN)
+                sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+
+    def trim(self, applied):
+        """Removes the extents folded into the block. Newer extents may be added meanwhile, they stay"""
+        retries = 0
+        while True:
+            item = self.getItem()
+            if item is None or not "extents" in item:
+                return
+            extents = decodeExtents(item["extents"].value)
+            remaining = [extent for extent in extents if extent[0] > applied]
+            if len(remaining) == len(extents):
+                return
+            if remaining:
+                item["extents"] = Binary(encodeExtents(remaining))
+            else:
+                del item["extents"]
+            item.add_attribute("version", 1)
+            try:
+                item.save(expected_value={"version": item["version"]})
+                return
+            except DynamoDBConditionalCheckFailedError:
+                retries += 1
+                if retries >= MAX_DELTA_RETRIES:
+                    # Harmless - the extents are skipped when reading
+                    self.log.debug("delta of %s/%d - unable to trim", self.blockId, self.blockNum)
+                    return
+                sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+
+    @staticmethod
+    def getDeltas(accessor, blockId, blockNums, stripes=1):
+        """Returns dict of blockNum -> extents for the blocks which have any"""
+        keys = [(blockKey(blockId, long(blockNum), stripes), deltaNum(long(blockNum))) for blockNum in blockNums]
+        deltas = dict()
+        for item in BlockRecord.batchGet(accessor, keys, DeltaRecord.ATTRS, 100, blockId):
+            if "extents" in item:
+                deltas[deltaNum(long(item["blockNum"]))] = decodeExtents(item["extents"].value)
+        return deltas
@@ -16,7 +16,7 @@
 
 __author__ = 'Denis Mikhalkin'
 
-from dynamofuse.base import BaseRecord
+from dynamofuse.base import BaseRecord, CONSISTENT_OPER
 from errno import  ENOENT, EINVAL
 import os
 from os.path import realpath, join, dirname, basename
@@ -35,20 +35,49 @@ from posix import *
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
+# Entries read per query page - about as many short names as fit into one 4K readdir buffer of FUSE,
+# which usually stops consuming the listing after that
+LIST_PAGE_SIZE = 128
+
 class Directory(BaseRecord):
     def getattr(self):
         self.record["st_nlink"] = 1
         self.record["st_size"] = 0
         return self.record
 
-    def list(self):
-        items = self.accessor.tablev2.query(path__eq=self.path, attributes=['name', 'deleted', 'hidden'])
+    def list(self, after=None):
+        """Names of the entries in name order, following the name after. Pages are read as the names are consumed"""
+        if self.accessor.READDIR_PLUS:
+            for entry in self.listRecords(after):
+                yield entry['name']
+            return
+
+        conditions = {"path__eq": self.path}
+        if after is not None:
+            conditions["name__gt"] = after
+        # Deleted and hidden entries are filtered out by DynamoDB, only "true" is ever stored in these attributes
+        items = self.accessor.tablev2.query_2(attributes=['name'], query_filter={"deleted__null": True, "hidden__null": True},
+            max_page_size=LIST_PAGE_SIZE, **conditions)
 
         for entry in items:
-            if entry['name'] == "/" or ("deleted" in entry and entry['deleted']) or ('hidden' in entry):
+            if entry['name'] == "/":
                 continue # This could be the folder itself
             yield entry['name']
 
+    def listRecords(self, after=None):
+        """Lists the entries with all their attributes, caching them for the getattr calls that usually follow"""
+        # Whole records, the record cache doesn't keep partial ones. Deleted ones are cached as well, so they are not filtered out.
+        # Files with inline data are not cached - listing a directory of small files would fill the cache with their data
+        for entry in self.accessor.table.query(self.path, range_key_condition=GT(after) if after is not None else None,
+                request_limit=LIST_PAGE_SIZE, consistent_read=CONSISTENT_OPER):
+            if entry['name'] == "/":
+                continue
+            if not "inlineData" in entry:
+                self.accessor.recordCache.put(os.path.join(self.path, entry['name']), entry)
+            if ("deleted" in entry and entry['deleted']) or ('hidden' in entry):
+                continue
+            yield entry
+
 
     def moveTo(self, newPath, forceUpdate=False):
         self.cloneItem(newPath, ['type', 'st_nlink', 'st_size', 'st_ino', 'st_mode'])
@@ -58,8 +87,7 @@ class Directory(BaseRecord):
         self.delete()
 
     def moveDirectory(self, new):
-        for entry in self.accessor.readdir(self.path):
-            if entry == "." or entry == "..": continue
+        for entry in self.list():
             self.accessor.rename(os.path.join(self.path, entry), os.path.join(new, entry))
 
     def isEmpty(self):
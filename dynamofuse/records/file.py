@@ -17,28 +17,41 @@
 __author__ = 'Denis Mikhalkin'
 
 from posix import R_OK, X_OK, W_OK
-from dynamofuse.records.block import BlockRecord
+from dynamofuse.records.block import BlockRecord, isZeroData, assembleBlock, blockKey, stripeKeys, MAX_BLOCK_SIZE, \
+    LEGACY_BLOCK_SIZE
+from dynamofuse.records.delta import DeltaRecord, applyExtents, deltaNum
 from dynamofuse.base import BaseRecord, DELETED_LINKS
-from errno import  ENOENT, EINVAL, EPERM
+from errno import  ENOENT, EINVAL, EPERM, EAGAIN
 import os
 from os.path import realpath, join, dirname, basename
 from threading import Lock
-from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
-from time import time
+from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError, DynamoDBConditionalCheckFailedError
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException
+from time import time, sleep
 from boto.dynamodb.condition import EQ, GT
 from boto.dynamodb.types import Binary
 import logging
-import cStringIO
 from stat import *
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
 import itertools
+import random
 import uuid
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
+MAX_WRITE_RETRIES = 8
+# Files are moved to larger blocks in chunks of this many of them, and only up to this size
+RESIZE_CHUNK_BLOCKS = 16
+MAX_LARGE_FILE_SIZE = 64 * 1024 * 1024
+# Blocks replaced by larger ones are kept this long (seconds) for the other clients which still read them,
+# until their handles revalidate the record
+RETIRED_BLOCKS_TIME = 60
+
 class File(BaseRecord):
     log = logging.getLogger("dynamo-fuse-master")
+    # Size written by this object with the save of st_size deferred
+    unsavedSize = 0
 
     def create(self, accessor, path, attrs):
         self.path = path
@@ -47,24 +60,218 @@ class File(BaseRecord):
         assert 'st_mode' in attrs
 
         if not 'st_blksize' in attrs:
-            attrs['st_blksize'] = accessor.BLOCK_SIZE
+            attrs['st_blksize'] = min(accessor.BLOCK_SIZE, MAX_BLOCK_SIZE)
 
         if not "blockId" in attrs:
             attrs["blockId"] = str(self.accessor.allocUniqueId())
             attrs["st_ino"] = long(attrs["blockId"])
+            # New files keep their data in the record until it grows past INLINE_DATA_SIZE
+            if self.inlineDataSize():
+                attrs["inline"] = True
+            # The codec is chosen when the file is created, each block records whether it was compressed
+            if accessor.BLOCK_CODEC:
+                attrs["blockCodec"] = accessor.BLOCK_CODEC
+            # Blocks of the file refer to shared content items
+            if accessor.DEDUP:
+                attrs["dedup"] = True
+            # Small writes to the blocks of the file are logged in their deltas
+            if accessor.EXTENT_WRITE_SIZE:
+                attrs["extentLog"] = True
+            # Blocks spread over this many hash keys
+            if accessor.STRIPES > 1:
+                attrs["stripes"] = accessor.STRIPES
 
         BaseRecord.create(self, accessor, path, attrs)
 
+    def blockSize(self):
+        # Not the mount block size - the blocks of these files were written with the old fixed size
+        return self.record["st_blksize"] if "st_blksize" in self.record else LEGACY_BLOCK_SIZE
+
+    def inlineDataSize(self):
+        # Like a block, the inline data has to fit into the item with the other attributes of the record
+        return min(self.accessor.INLINE_DATA_SIZE, MAX_BLOCK_SIZE)
+
+    def largeBlockSize(self, size):
+        """Returns the block size the file should switch to when it grows to size, or None"""
+        largeBlockSize = min(self.accessor.LARGE_BLOCK_SIZE, MAX_BLOCK_SIZE)
+        largeFileSize = min(self.accessor.LARGE_FILE_SIZE, MAX_LARGE_FILE_SIZE)
+        # Only when crossing the threshold - the data to move is bounded by it
+        if largeFileSize and self.record["st_size"] <= largeFileSize < size and self.blockSize() < largeBlockSize:
+            return largeBlockSize
+        return None
+
+    def resizeBlocks(self, blockSize):
+        """
+        Copies the data of the file with the new block size under a new blockId. The record is saved by the caller,
+        until then the file still reads from the old blocks. The old blocks are kept as retired (see deleteRetiredBlocks).
+        """
+        oldBlockId = self.record["blockId"]
+        oldBlockSize = self.record["st_blksize"] if "st_blksize" in self.record else None
+        newBlockId = str(self.accessor.allocUniqueId())
+        # Written by this record with the size not saved yet
+        size = max(self.record["st_size"], self.unsavedSize)
+        self.log.debug("changing block size of %s from %d to %d, %d bytes to move", self.path, self.blockSize(), blockSize, size)
+        chunkSize = blockSize * RESIZE_CHUNK_BLOCKS
+        for offset in range(0, size, chunkSize):
+            data = self.read(offset, min(chunkSize, size - offset), fileSize=size)
+            self.useBlocks(newBlockId, blockSize)
+            try:
+                self._write(data, offset, fresh=True)
+            finally:
+                self.useBlocks(oldBlockId, oldBlockSize)
+        self.record["blockId"] = newBlockId
+        self.record["st_blksize"] = blockSize
+        self.record["retiredBlockId"] = oldBlockId
+        self.record["retiredTime"] = int(time())
+
+    def useBlocks(self, blockId, blockSize):
+        """Switches the record between the old and the new blocks while copying, without changing the stored record"""
+        dict.__setitem__(self.record, "blockId", blockId)
+        if blockSize is not None:
+            dict.__setitem__(self.record, "st_blksize", blockSize)
+        elif "st_blksize" in self.record:
+            dict.__delitem__(self.record, "st_blksize")
+
+    def retiredBlocks(self, now=None):
+        """The blockId of the blocks replaced by larger ones, once nobody reads them anymore (all of them with now=None)"""
+        if not "retiredBlockId" in self.record:
+            return None
+        if now is not None and now - self.record["retiredTime"] < RETIRED_BLOCKS_TIME:
+            return None
+        return self.record["retiredBlockId"]
+
+    def deleteBlocks(self, blockId):
+        BlockRecord.deleteItems(self.accessor, self.queryBlocks(blockId, attributes=['blockId', 'blockNum', 'hash']))
+        BlockRecord.invalidateBlocks(self.accessor, blockId)
+
+    def isInline(self):
+        return 'inline' in self.record and self.record['inline']
+
+    def getInlineData(self):
+        return self.record["inlineData"].value if "inlineData" in self.record else ""
+
+    def setInlineData(self, data):
+        # DynamoDB does not store empty binary values
+        if data:
+            self.record["inlineData"] = Binary(data)
+        elif "inlineData" in self.record:
+            del self.record["inlineData"]
+
     def getFirstBlock(self, getData=False):
         return self.record
 
     def getBlock(self, blockNum, getData=False, forUpdate=False):
-        return BlockRecord(self.accessor, os.path.join(self.record["blockId"], str(blockNum))).read(getData, forUpdate)
+        return self.newBlockRecord(blockNum).read(getData, forUpdate, self.record["version"])
+
+    def getBlocks(self, blockNums, getData=False):
+        # Logged writes don't change the version of the block, so the blocks of such files are not cached
+        items = BlockRecord.getBlockItems(self.accessor, self.record["blockId"], blockNums, getData, self.record["version"],
+            self.blockSize(), not self.isExtentLog(), self.stripes())
+        if getData and self.isExtentLog():
+            self.mergeDeltas(items, blockNums)
+        return items
+
+    def newBlockRecord(self, blockNum):
+        return BlockRecord(self.accessor, os.path.join(self.record["blockId"], str(blockNum)), self.getCodec(), self.isDedup(),
+            not self.isExtentLog(), self.stripes())
+
+    def newDelta(self, blockNum):
+        return DeltaRecord(self.accessor, self.record["blockId"], blockNum, self.stripes())
+
+    def stripes(self):
+        return int(self.record["stripes"]) if "stripes" in self.record else 1
+
+    def queryBlocks(self, blockId, **conditions):
+        """Queries the block items of all stripes of the file"""
+        return itertools.chain(*[self.accessor.blockTablev2.query(blockId__eq=key, **conditions)
+                                 for key in stripeKeys(blockId, self.stripes())])
+
+    def isExtentLog(self):
+        return 'extentLog' in self.record and self.record['extentLog']
+
+    def mergeDeltas(self, items, blockNums):
+        """Applies the logged writes to the read blocks, blocks which only have logged writes are added"""
+        for (blockNum, extents) in DeltaRecord.getDeltas(self.accessor, self.record["blockId"], blockNums, self.stripes()).items():
+            item = items.get(blockNum, None)
+            applied = item["applied"] if item is not None and "applied" in item else 0
+            (data, unused) = applyExtents(item["data"].value if item is not None and "data" in item else "", extents, applied)
+            if item is None:
+                item = items[blockNum] = {"blockId": self.record["blockId"], "blockNum": blockNum}
+            dict.__setitem__(item, "data", Binary(data))
+
+    def mergeDelta(self, block, blockNum):
+        """Folds the logged writes into the block read for update. Returns the last folded seq, 0 if none"""
+        applied = block["applied"] if "applied" in block else 0
+        extents = self.newDelta(blockNum).getExtents()
+        (data, newApplied) = applyExtents(block["data"].value if "data" in block else "", extents, applied)
+        if newApplied == applied:
+            return 0
+        block["data"] = Binary(data)
+        block["applied"] = newApplied
+        return newApplied
+
+    def compactBlock(self, blockNum):
+        """
+        Folds the logged writes of the block into it. A block which is a hole is created from its logged writes,
+        unless it is past the end of the file (removed by truncate of another client).
+        """
+        retries = 0
+        while True:
+            try:
+                try:
+                    block = self.getBlock(blockNum, getData=True, forUpdate=True)
+                except FuseOSError, fe:
+                    if fe.errno != ENOENT:
+                        raise
+                    block = None
+                if block is None:
+                    if self.compactHole(blockNum):
+                        return
+                    # Created by a write meanwhile - folded into it on the next round
+                else:
+                    applied = self.mergeDelta(block, blockNum)
+                    if not applied:
+                        return
+                    self.log.debug("compacted block %d of %s up to %d", blockNum, self.path, applied)
+                    if block.isZero():
+                        block.delete(True)
+                    else:
+                        block.save(True)
+                    self.newDelta(blockNum).trim(applied)
+                    return
+            except DynamoDBConditionalCheckFailedError:
+                pass
+            retries += 1
+            if retries >= MAX_WRITE_RETRIES:
+                self.log.debug("compact block %d of %s - too many conflicts", blockNum, self.path)
+                return
+            sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+
+    def compactHole(self, blockNum):
+        """Returns False if the block was created meanwhile"""
+        self.reload()
+        if blockNum * self.blockSize() >= self.record["st_size"]:
+            return True
+        (data, applied) = applyExtents("", self.newDelta(blockNum).getExtents())
+        if not applied:
+            return True
+        if not isZeroData(data) and not BlockRecord.createBlock(self.accessor, self.record["blockId"], long(blockNum), data,
+                self.getCodec(), self.stripes(), applied, self.record["version"]):
+            return False
+        self.log.debug("compacted hole %d of %s up to %d", blockNum, self.path, applied)
+        self.newDelta(blockNum).trim(applied)
+        return True
+
+    def getCodec(self):
+        return self.record["blockCodec"] if "blockCodec" in self.record else None
+
+    def isDedup(self):
+        return 'dedup' in self.record and self.record['dedup']
 
     def createBlock(self, blockNum):
-        return BlockRecord(self.accessor, os.path.join(self.record["blockId"], str(blockNum))).create(attrs={
-            "blockId": self.record["blockId"], "blockNum": blockNum
-        })
+        return self.newBlockRecord(blockNum).create(attrs={
+            "blockId": blockKey(self.record["blockId"], blockNum, self.stripes()), "blockNum": blockNum
+        }, fileVersion=self.record["version"])
 
     def getRecord(self):
         return self.record
@@ -82,12 +289,15 @@ class File(BaseRecord):
 
     def getattr(self):
         block = self.getFirstBlock()
-        block["st_blocks"] = (block["st_size"] + self.record["st_blksize"] - 1) / self.record["st_blksize"]
-        block["st_ino"] = long(self.record["blockId"])
+        block["st_blocks"] = (block["st_size"] + self.blockSize() - 1) / self.blockSize()
+        # blockId changes when the file moves to larger blocks, the inode number stays
+        block["st_ino"] = long(self.record["st_ino"]) if "st_ino" in self.record else long(self.record["blockId"])
         return block
 
     def delete(self, duringMove=False):
         with self.writeLock():
+            # The record may come from the record cache - under the lock the stored one can't change
+            self.reload()
             self.deleteFile()
 
     def deleteFile(self, linked=False):
@@ -101,9 +311,10 @@ class File(BaseRecord):
             block['deleted'] = True
         if block["st_nlink"] == 1:
             self.log.debug("No more links - deleting records")
-            items = self.accessor.blockTablev2.query(blockId__eq=self.record["blockId"], attributes=['blockId', 'blockNum'])
-            for entry in items:
-                entry.delete()
+            self.deleteBlocks(self.record["blockId"])
+            retired = self.retiredBlocks()
+            if retired:
+                self.deleteBlocks(retired)
 
             BaseRecord.delete(self)
         else:
@@ -113,74 +324,366 @@ class File(BaseRecord):
             else:
                 block.save()
 
-    def write(self, data, offset):
+    def write(self, data, offset, deferAttrs=False):
+        """With deferAttrs the size and times are left for the caller to save with updateSizeAndTime, unless the record is saved anyway"""
+        # Inline data and block size changes are in the record, they still need the lock
+        if self.accessor.OPTIMISTIC_WRITES and not self.isInline() and not self.largeBlockSize(offset + len(data)):
+            return self.writeOptimistic(data, offset, deferAttrs)
         with self.writeLock():
-            self._write(data, offset)
-            block = self.getFirstBlock()
-            block["st_size"] = max(block["st_size"], offset + len(data))
-            block['st_ctime'] = max(block['st_ctime'], int(time()))
-            block['st_mtime'] = max(block['st_mtime'], int(time()))
-            block.save()
+            largeBlockSize = self.largeBlockSize(offset + len(data))
+            if self.isInline():
+                deferAttrs = False
+                if offset + len(data) <= self.inlineDataSize():
+                    self._writeInline(data, offset)
+                else:
+                    # No blocks yet - the block size can be changed for free
+                    if largeBlockSize:
+                        self.record["st_blksize"] = largeBlockSize
+                    self.promoteInline()
+                    self._write(data, offset)
+            else:
+                if largeBlockSize:
+                    self.resizeBlocks(largeBlockSize)
+                    deferAttrs = False
+                self._write(data, offset)
+            if deferAttrs:
+                # Not in st_size yet, but the blocks exist
+                self.unsavedSize = max(self.unsavedSize, offset + len(data))
+                return len(data)
+            self._updateSizeAndTime(offset + len(data), int(time()))
 
             return len(data)
 
-    def _write(self, data, offset):
-        startBlock = offset / self.accessor.BLOCK_SIZE
-        endBlock = (offset + len(data) - 1) / self.accessor.BLOCK_SIZE
-        initialBlockOffset = self.accessor.BLOCK_SIZE - (offset % self.accessor.BLOCK_SIZE)
+    def writeOptimistic(self, data, offset, deferAttrs=False):
+        """Write without the file lock, the blocks and the record are saved on condition of their versions"""
+        blockId = self.record["blockId"]
+        self._write(data, offset, conditional=True)
+        if deferAttrs:
+            # The caller writes the data again if the blocks are replaced before it saves the size (DynamoFS.saveAttrs)
+            return len(data)
+        retries = 0
+        while True:
+            try:
+                self._updateSizeAndTime(offset + len(data), int(time()))
+                return len(data)
+            except DynamoDBConditionalCheckFailedError:
+                # The size and times only grow, so it is enough to apply them to the current record
+                retries += 1
+                if retries >= MAX_WRITE_RETRIES:
+                    raise FuseOSError(EAGAIN)
+                sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+                self.reload()
+                if self.record["blockId"] != blockId:
+                    # The blocks were replaced meanwhile (block size change, new file) - the data went to the old ones
+                    blockId = self.record["blockId"]
+                    self._write(data, offset, conditional=True)
+
+    def append(self, data):
+        """
+        Writes the data at the end of the file (O_APPEND) without locking the file.
+        The range is reserved with an atomic increment of the reservedSize attribute, so that concurrent appenders
+        get distinct ranges, the blocks of the range are written on condition of their versions, then st_size published.
+        """
+        offset = self.reserve(len(data))
+        self.log.debug("append %d bytes to %s at %d", len(data), self.path, offset)
+        # Inline data and block size changes are in the record, they still need the lock
+        if self.isInline() or self.largeBlockSize(offset + len(data)):
+            return self.write(data, offset)
+        blockId = self.record["blockId"]
+        self._write(data, offset, conditional=True)
+        retries = 0
+        # The data is stored - from here on the append doesn't fail, repeating it would append the data twice
+        while not self.publishSize(offset + len(data), int(time()), blockId):
+            # The blocks were replaced meanwhile (block size change, new file) - the data went to the old ones
+            blockId = self.record["blockId"]
+            self._write(data, offset, conditional=True)
+            retries += 1
+            if retries >= MAX_WRITE_RETRIES:
+                self.log.error("append to %s at %d - unable to publish the size", self.path, offset)
+                break
+            sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+        return len(data)
+
+    def publishSize(self, size, mtime, blockId):
+        """
+        Moves st_size up to size, unless it is already past it. Unlike updateSizeAndTime the record may be changed
+        by others meanwhile. Returns False if the blocks of the file are not blockId anymore
+        """
+        table = self.accessor.tablev2
+        number = lambda value: {"N": str(value)}
+        try:
+            attrs = table.connection.update_item(table.table_name,
+                key={"path": {"S": self.record["path"]}, "name": {"S": self.record["name"]}},
+                attribute_updates={"st_size": {"Action": "PUT", "Value": number(size)},
+                                   "st_mtime": {"Action": "PUT", "Value": number(mtime)},
+                                   "st_ctime": {"Action": "PUT", "Value": number(mtime)},
+                                   "version": {"Action": "ADD", "Value": number(1)}},
+                expected={"st_size": {"ComparisonOperator": "LT", "AttributeValueList": [number(size)]},
+                          "blockId": {"ComparisonOperator": "EQ", "AttributeValueList": [{"S": blockId}]}},
+                return_values="ALL_NEW")["Attributes"]
+        except ConditionalCheckFailedException:
+            # Either published past it by another writer, or the blocks were replaced
+            self.reload()
+            return self.record["blockId"] == blockId
+        self.accessor.invalidateRecord(self.path)
+        version = int(attrs["version"]["N"])
+        BlockRecord.fileVersionChanged(self.accessor, blockId, version - 1, version)
+        if version == self.record["version"] + 1:
+            # Nothing else changed meanwhile
+            for (name, value) in [("st_size", size), ("st_mtime", mtime), ("st_ctime", mtime), ("version", version)]:
+                dict.__setitem__(self.record, name, value)
+        return True
+
+    def reserve(self, size):
+        """Returns the start of the reserved range of size bytes"""
+        retries = 0
+        while True:
+            item = self.accessor.newItem({"path": self.record["path"], "name": self.record["name"]})
+            item.add_attribute("reservedSize", size)
+            # The same request returns the published size - the file may have been written otherwise or truncated since
+            attrs = item.save(expected_value={"blockId": self.record["blockId"]}, return_values="ALL_NEW")["Attributes"]
+            end = attrs["reservedSize"]
+            if end - size >= attrs["st_size"]:
+                return end - size
+
+            # Reservations are behind the end of the file (e.g. the first append) - move them past it
+            item = self.accessor.newItem({"path": self.record["path"], "name": self.record["name"]})
+            item["reservedSize"] = attrs["st_size"] + size
+            try:
+                item.save(expected_value={"blockId": self.record["blockId"], "reservedSize": end})
+                return attrs["st_size"]
+            except DynamoDBConditionalCheckFailedError:
+                # Another appender got in between
+                retries += 1
+                if retries >= MAX_WRITE_RETRIES:
+                    raise FuseOSError(EAGAIN)
+
+    def updateSizeAndTime(self, size, mtime):
+        if self.accessor.OPTIMISTIC_WRITES:
+            self._updateSizeAndTime(size, mtime)
+            return
+        with self.writeLock():
+            self._updateSizeAndTime(size, mtime)
+
+    def _updateSizeAndTime(self, size, mtime):
+        # Never moves the size or times back - an earlier write may be saved after a later one
+        block = self.getFirstBlock()
+        block["st_size"] = max(block["st_size"], size)
+        block['st_ctime'] = max(block['st_ctime'], mtime)
+        block['st_mtime'] = max(block['st_mtime'], mtime)
+        retired = self.retiredBlocks(int(time()))
+        if retired:
+            del block["retiredBlockId"]
+            del block["retiredTime"]
+        block.save()
+        BlockRecord.fileVersionChanged(self.accessor, self.record["blockId"], block["version"] - 1, block["version"])
+        if retired:
+            self.deleteBlocks(retired)
+
+    def _write(self, data, offset, conditional=False, fresh=False):
+        """
+        With conditional every block is saved only if it is still at the version it was read at, retrying on conflicts.
+        fresh means that the file has no blocks yet.
+        """
+        blockSize = self.blockSize()
+        # Blocks of a fresh blockId can't exist yet, so they are stored in batches without reading them first.
+        # Blocks past the known end of the file are likely new but may have been written by another client
+        # under deferred attributes or a reservation - they are created only if they don't exist
+        newBlocks = []
+        firstNewBlock = None
+        if not conditional and not self.isDedup():
+            firstNewBlock = 0 if fresh else (max(self.record["st_size"], self.unsavedSize) + blockSize - 1) / blockSize
+        startBlock = offset / blockSize
+        endBlock = (offset + len(data) - 1) / blockSize
+        initialBlockOffset = blockSize - (offset % blockSize)
         blockOffset = 0
         self.log.debug("write start=%d, last=%d, initial offset %d", startBlock, endBlock, initialBlockOffset)
+        # Slices of the view don't copy the data, it is copied once when the block data is assembled
+        view = memoryview(data)
         for blockNum in range(startBlock, endBlock + 1):
-            try:
-                block = self.getBlock(blockNum, getData=True)
-            except FuseOSError, fe:
-                if fe.errno == ENOENT:
-                    self.log.debug("write block %d is None", blockNum)
-                    block = self.createBlock(blockNum)
-                else:
-                    raise
-            dataSlice = data[0:initialBlockOffset] if blockNum == startBlock else\
-            data[blockOffset: blockOffset + self.accessor.BLOCK_SIZE]
+            dataSlice = view[0:initialBlockOffset] if blockNum == startBlock else\
+            view[blockOffset: blockOffset + blockSize]
 
             self.log.debug("write block %d slice length %d from offset %d", blockNum, len(dataSlice), blockOffset)
             blockOffset += len(dataSlice)
 
-            block.writeData((offset % self.accessor.BLOCK_SIZE) if blockNum == startBlock else 0, dataSlice)
-            block.save()
-
-    def read(self, offset, size):
-        startBlock = offset / self.accessor.BLOCK_SIZE
-        if offset+size > self.record["st_size"]:
-            size = self.record["st_size"] - offset
-        endBlock = (offset + size - 1) / self.accessor.BLOCK_SIZE
-        data = cStringIO.StringIO()
-        try:
-            self.log.debug("read blocks [%d .. %d]", startBlock, endBlock)
-            for block in range(startBlock, endBlock+1):
+            startOffset = (offset % blockSize) if blockNum == startBlock else 0
+            if firstNewBlock is not None and blockNum >= firstNewBlock:
+                if isZeroData(dataSlice):
+                    if fresh:
+                        continue
+                elif fresh:
+                    newBlocks.append((blockNum, assembleBlock("", startOffset, dataSlice)))
+                    continue
+                elif BlockRecord.createBlock(self.accessor, self.record["blockId"], long(blockNum),
+                        assembleBlock("", startOffset, dataSlice), self.getCodec(), self.stripes(), fileVersion=self.record["version"]):
+                    continue
+                else:
+                    self.log.debug("write block %d past the end already exists", blockNum)
+            if self.isExtentLog() and len(dataSlice) <= self.accessor.EXTENT_WRITE_SIZE:
+                # Small write - logged instead of rewriting the block
+                logged = self.newDelta(blockNum).append(startOffset, dataSlice.tobytes())
+                if logged > self.accessor.EXTENT_COMPACT_SIZE and self.accessor.compactor:
+                    self.accessor.compactor.schedule(self.path, self.record["blockId"], blockNum)
+                continue
+            if not conditional:
+                self._writeBlock(blockNum, startOffset, dataSlice)
+                continue
+            retries = 0
+            while True:
                 try:
-                    item = self.getBlock(block, getData=True)
-                except FuseOSError, fe:
-                    if fe.errno == ENOENT:
-                        break
-                    else:
-                        raise
-                if item is None:
-                    self.log.debug("read block %d does not exist", block)
+                    self._writeBlock(blockNum, startOffset, dataSlice, conditional=True)
                     break
-                if not "data" in item:
-                    self.log.debug("read block %d has no data", block)
-                    break
-                itemData = item["data"].value
-                writeLen = min(size, self.accessor.BLOCK_SIZE, len(itemData))
-                startOffset = (offset % self.accessor.BLOCK_SIZE) if block == startBlock else 0
-                self.log.debug("read block %d has %d data, write %d from %d", block, len(itemData), writeLen,
-                    startOffset)
-                data.write(itemData[startOffset:startOffset + writeLen])
-                size -= writeLen
-
-            return data.getvalue()
-        finally:
-            data.close()
+                except DynamoDBConditionalCheckFailedError:
+                    # Changed by another writer since we read it - read it again and repeat
+                    retries += 1
+                    if retries >= MAX_WRITE_RETRIES:
+                        self.log.debug("write block %d - too many conflicts", blockNum)
+                        raise FuseOSError(EAGAIN)
+                    self.log.debug("write block %d conflict, retry %d", blockNum, retries)
+                    sleep(random.uniform(0, min(0.02 * (2 ** retries), 1)))
+
+        if newBlocks:
+            self.log.debug("write %d new blocks in batches", len(newBlocks))
+            BlockRecord.createBlocks(self.accessor, self.record["blockId"], newBlocks, self.getCodec(), self.stripes(),
+                self.record["version"])
+
+    def _writeBlock(self, blockNum, startOffset, dataSlice, conditional=False):
+        try:
+            block = self.getBlock(blockNum, getData=True, forUpdate=True)
+        except FuseOSError, fe:
+            if fe.errno == ENOENT:
+                if isZeroData(dataSlice):
+                    self.log.debug("write block %d is None and data is zeros - leaving a hole", blockNum)
+                    if self.isExtentLog():
+                        # The zeros replace the logged writes to the hole
+                        self.newDelta(blockNum).append(startOffset, dataSlice.tobytes(), onlyIfLogged=True)
+                    return
+                self.log.debug("write block %d is None", blockNum)
+                # Fails if another writer has created it meanwhile
+                block = self.createBlock(blockNum)
+            else:
+                raise
+
+        applied = self.mergeDelta(block, blockNum) if self.isExtentLog() else 0
+        block.writeData(startOffset, dataSlice)
+        if block.isZero():
+            self.log.debug("write block %d is all zeros - deleting", blockNum)
+            block.delete(conditional)
+        else:
+            block.save(conditional)
+        if applied:
+            self.newDelta(blockNum).trim(applied)
+
+    def _writeInline(self, data, offset):
+        current = self.getInlineData()
+        if len(current) < offset:
+            current += "\0" * (offset - len(current))
+        self.log.debug("write inline %d bytes at %d", len(data), offset)
+        self.setInlineData(current[0:offset] + data + current[offset + len(data):])
+
+    def promoteInline(self):
+        # The record is saved by the caller - until then the file still reads from the inline data
+        data = self.getInlineData()
+        self.log.debug("moving %d bytes of inline data of %s to blocks", len(data), self.path)
+        if data:
+            self._write(data, 0, fresh=True)
+        self.setInlineData("")
+        del self.record["inline"]
+
+    def punchHole(self, offset, length):
+        with self.writeLock():
+            end = min(offset + length, self.record["st_size"])
+            if end <= offset:
+                return
+            if self.isInline():
+                inlineEnd = min(end, len(self.getInlineData()))
+                if inlineEnd > offset:
+                    self._writeInline("\0" * (inlineEnd - offset), offset)
+                self.updateMCTime()
+                return
+            blockSize = self.blockSize()
+            startBlock = (offset + blockSize - 1) / blockSize
+            endBlock = end / blockSize
+            self.log.debug("punch hole [%d .. %d), whole blocks [%d .. %d)", offset, end, startBlock, endBlock)
+            if startBlock >= endBlock:
+                # Within one block
+                self._write("\0" * (end - offset), offset)
+            else:
+                if offset < startBlock * blockSize:
+                    self._write("\0" * (startBlock * blockSize - offset), offset)
+                items = self.queryBlocks(self.record["blockId"], blockNum__between=(startBlock, endBlock - 1),
+                    attributes=["blockId", "blockNum", "hash"])
+                for entry in items:
+                    BlockRecord.deleteItems(self.accessor, [entry])
+                    BlockRecord.dropBlock(self.accessor, self.record["blockId"], long(entry["blockNum"]))
+                if self.isExtentLog():
+                    BlockRecord.deleteItems(self.accessor, self.queryBlocks(self.record["blockId"],
+                        blockNum__between=(deltaNum(endBlock - 1), deltaNum(startBlock)), attributes=["blockId", "blockNum"]))
+                if end > endBlock * blockSize:
+                    self._write("\0" * (end - endBlock * blockSize), endBlock * blockSize)
+
+            item = self.getFirstBlock()
+            l_time = int(time())
+            item['st_ctime'] = max(l_time, item['st_ctime'])
+            item['st_mtime'] = max(l_time, item['st_mtime'])
+            item.save()
+            BlockRecord.fileVersionChanged(self.accessor, self.record["blockId"], item["version"] - 1, item["version"])
+
+    def readBlocks(self, startBlock, endBlock, readAhead=None):
+        blockNums = range(startBlock, endBlock + 1)
+        items = readAhead.take(blockNums) if readAhead else {}
+        missing = [blockNum for blockNum in blockNums if not blockNum in items]
+        if len(missing) == 1 and not self.isExtentLog():
+            try:
+                items[missing[0]] = self.getBlock(missing[0], getData=True)
+            except FuseOSError, fe:
+                if fe.errno != ENOENT:
+                    raise
+        elif missing:
+            # Several blocks - get them all in one go instead of a GetItem per block
+            items.update(self.getBlocks(missing, getData=True))
+        return items
+
+    def read(self, offset, size, readAhead=None, fileSize=None):
+        """
+        Returns the data as a bytearray. fileSize overrides the stored size, when this mount has written past it and
+        not saved the size yet
+        """
+        blockSize = self.blockSize()
+        startBlock = offset / blockSize
+        if fileSize is None:
+            fileSize = self.record["st_size"]
+        if offset+size > fileSize:
+            size = fileSize - offset
+        if size <= 0:
+            return ""
+        # The data is copied once, from the blocks into the result. Missing blocks and the parts past the end
+        # of their data are holes, which read as the zeros the result starts with
+        data = bytearray(size)
+        if self.isInline():
+            inline = memoryview(self.getInlineData())[offset:offset + size]
+            data[0:len(inline)] = inline
+            return data
+        endBlock = (offset + size - 1) / blockSize
+        self.log.debug("read blocks [%d .. %d]", startBlock, endBlock)
+        items = self.readBlocks(startBlock, endBlock, readAhead)
+        pos = 0
+        for block in range(startBlock, endBlock+1):
+            item = items.get(block, None)
+            itemData = item["data"].value if item is not None and "data" in item else ""
+            startOffset = (offset % blockSize) if block == startBlock else 0
+            readLen = min(size - pos, blockSize - startOffset)
+            self.log.debug("read block %d has %d data, write %d from %d", block, len(itemData), readLen,
+                startOffset)
+            available = min(readLen, len(itemData) - startOffset)
+            if available > 0:
+                data[pos:pos + available] = memoryview(itemData)[startOffset:startOffset + available]
+            pos += readLen
+
+        if readAhead:
+            readAhead.update(self, offset, len(data), endBlock)
+        return data
 
     def moveTo(self, newPath, forceUpdate=False):
         # Files can be hard-linked. When moved, they will update the targets of their hard-links to point to new name (as hard links are actually by name)
@@ -194,33 +697,56 @@ class File(BaseRecord):
                 for link in items:
                     link["link"] = newPath
                     link.save()
+                    self.accessor.invalidateRecord(os.path.join(link["path"], link["name"]))
 
             self.record.delete()
 
     def truncate(self, length, fh=None):
         with self.writeLock():
-            lastBlock = length / self.accessor.BLOCK_SIZE
             l_time = int(time())
 
-            items = self.accessor.blockTablev2.query(blockId__eq=self.record["blockId"], blockNum__gt=lastBlock, attributes=["blockId", "blockNum"])
-            for entry in items:
-                entry.delete()
-
-            if length:
-                try:
-                    lastItem = self.getBlock(lastBlock, getData=True)
-                    if lastItem is not None and "data" in lastItem:
-                        lastItem['data'] = Binary(lastItem['data'].value[0:(length % self.accessor.BLOCK_SIZE)])
-                        lastItem.save()
-                except FuseOSError, fe:
-                    # Block is missing - so nothing to update
-                    if fe.errno == ENOENT:
-                        pass
-                    else:
-                        raise fe
+            if self.isInline():
+                self.setInlineData(self.getInlineData()[0:length])
+            else:
+                self._truncateBlocks(length)
 
             item = self.getFirstBlock()
             item['st_size'] = length
+            # Appends continue from the new end
+            item['reservedSize'] = length
             item['st_ctime'] = max(l_time, item['st_ctime'])
             item['st_mtime'] = max(l_time, item['st_mtime'])
             item.save()
+            BlockRecord.fileVersionChanged(self.accessor, self.record["blockId"], item["version"] - 1, item["version"])
+
+    def _truncateBlocks(self, length):
+        lastBlock = length / self.blockSize()
+
+        items = self.queryBlocks(self.record["blockId"], blockNum__gt=lastBlock, attributes=["blockId", "blockNum", "hash"])
+        BlockRecord.deleteItems(self.accessor, items)
+        BlockRecord.invalidateBlocks(self.accessor, self.record["blockId"], lastBlock + 1)
+        if self.isExtentLog():
+            # Logged writes of the removed blocks
+            BlockRecord.deleteItems(self.accessor, self.queryBlocks(self.record["blockId"],
+                blockNum__lt=deltaNum(lastBlock), attributes=["blockId", "blockNum"]))
+
+        try:
+            lastItem = self.getBlock(lastBlock, getData=True, forUpdate=True)
+            applied = self.mergeDelta(lastItem, lastBlock) if self.isExtentLog() else 0
+            if lastItem is not None and "data" in lastItem:
+                lastItem['data'] = Binary(lastItem['data'].value[0:(length % self.blockSize())])
+                # Nothing left in the block (or only zeros) - it becomes a hole
+                if lastItem.isZero():
+                    lastItem.delete()
+                else:
+                    lastItem.save()
+            if applied:
+                self.newDelta(lastBlock).trim(applied)
+        except FuseOSError, fe:
+            # Block is missing - so nothing to update, but its logged writes past the new end
+            if fe.errno == ENOENT:
+                if self.isExtentLog():
+                    tail = length % self.blockSize()
+                    self.newDelta(lastBlock).append(tail, "\0" * (self.blockSize() - tail), onlyIfLogged=True)
+            else:
+                raise fe
@@ -68,6 +68,11 @@ class Link(BaseRecord):
     def updateLink(self):
         self.link.link()
 
+    def reload(self, ignoreDeleted=False):
+        BaseRecord.reload(self, ignoreDeleted)
+        # The operations go to the file, so it is re-read as well
+        self.link.reload(ignoreDeleted=True)
+
     def delete(self, duringMove=False):
         # If deleting during move no need to update the n_link on file - the record is duplicated
         if not duringMove:
@@ -75,12 +80,22 @@ class Link(BaseRecord):
                 # Lock ensures the file is exclusive. Then we delete link record - if that fails the lock is released and we can repeat.
                 # Otherwise, if record is deleted we are guaranteed to be able to delete the file
                 BaseRecord.delete(self)
+                self.link.reload(ignoreDeleted=True)
                 self.link.deleteFile(True)
         else:
             BaseRecord.delete(self)
 
-    def read(self, offset, size):
-        return self.link.read(offset, size)
+    def read(self, offset, size, readAhead=None, fileSize=None):
+        return self.link.read(offset, size, readAhead, fileSize)
+
+    def write(self, data, offset, deferAttrs=False):
+        return self.link.write(data, offset, deferAttrs)
+
+    def append(self, data):
+        return self.link.append(data)
+
+    def updateSizeAndTime(self, size, mtime):
+        return self.link.updateSizeAndTime(size, mtime)
 
-    def write(self, data, offset):
-        return self.link.write(data, offset)
\ No newline at end of file
+    def blockSize(self):
+        return self.link.blockSize()
\ No newline at end of file
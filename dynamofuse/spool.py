@@ -0,0 +1,258 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from collections import deque
+from errno import EAGAIN, EIO
+from fuse import FuseOSError
+from threading import Condition, Thread
+from time import time, sleep
+import logging
+import os
+import struct
+import sys
+import traceback
+import zlib
+
+def encodePath(path):
+    return path.encode("utf-8") if isinstance(path, unicode) else path
+
+class WriteSpool(object):
+    """
+    Local write-ahead journal of written data. A write is acknowledged once it is appended to the journal file,
+    a background thread then stores the writes with `store` in the order they were made.
+    The journal survives the death of the process: the writes which were not stored are loaded from it on mount
+    and stored then (storing a write again is harmless, it has the same data at the same offset).
+    Until they are stored, the spooled writes are applied over the data read from the blocks.
+    A write which can't be stored after MAX_STORE_RETRIES (or whose file is gone) is dropped, the retries running out
+    is reported by the next fsync.
+
+    The file is a header with the seq of the last stored write, followed by the writes, each with its own
+    header (seq, offset, mtime, length, CRC, path length). A torn write at the end is dropped on load.
+    Once the stored writes take maxBytes, the file is rewritten with only the pending ones.
+    """
+    log = logging.getLogger("dynamo-fuse-spool ")
+
+    MAGIC = "DynamoFS write spool 1"
+    FILE_HEADER = struct.Struct("<32sq") # magic, seq of the last stored write
+    FILE_HEADER_SIZE = 4096
+    ENTRY_MAGIC = "DFSW"
+    ENTRY_HEADER = struct.Struct("<4sqqqIIH") # magic, seq, offset, mtime, length, crc of path and data, path length
+    RETRY_DELAY = 1
+    MAX_STORE_RETRIES = 10
+
+    def __init__(self, fileName, maxBytes, store):
+        self.fileName = fileName
+        self.maxBytes = maxBytes
+        # Called with (path, offset, data, lockOwner), the lock owner is None for the writes loaded from the file
+        self.store = store
+        self.pending = deque() # (seq, path, offset, mtime, data, lockOwner) not stored yet, oldest first
+        self.paths = dict() # path -> number of pending writes
+        self.errors = dict() # path -> errno of the dropped writes, until reported
+        self.size = 0
+        self.seq = 0
+        self.stored = 0
+        self.end = self.FILE_HEADER_SIZE # end of the file
+        self.pendingBytes = 0 # bytes of the file taken by the pending writes
+        self.condition = Condition()
+        self.thread = None
+
+        exists = os.path.exists(fileName)
+        self.file = open(fileName, "r+b" if exists else "w+b")
+        self.load()
+
+    def load(self):
+        header = self.file.read(self.FILE_HEADER.size)
+        if len(header) < self.FILE_HEADER.size or self.FILE_HEADER.unpack(header)[0].rstrip("\0") != self.MAGIC:
+            self.log.info("Initializing write spool %s", self.fileName)
+            self.writeHeader()
+            self.file.truncate(self.FILE_HEADER_SIZE)
+            return
+        self.stored = self.seq = self.FILE_HEADER.unpack(header)[1]
+
+        end = self.FILE_HEADER_SIZE
+        self.file.seek(end)
+        while True:
+            entryHeader = self.file.read(self.ENTRY_HEADER.size)
+            if len(entryHeader) < self.ENTRY_HEADER.size:
+                break
+            (magic, seq, offset, mtime, length, crc, pathLength) = self.ENTRY_HEADER.unpack(entryHeader)
+            payload = self.file.read(pathLength + length)
+            if magic != self.ENTRY_MAGIC or len(payload) < pathLength + length or zlib.crc32(payload) & 0xffffffff != crc:
+                self.log.info("Write spool %s - dropping the torn write at %d", self.fileName, end)
+                break
+            end = self.file.tell()
+            self.seq = max(self.seq, seq)
+            if seq > self.stored:
+                self.addPending(seq, payload[:pathLength].decode("utf-8"), offset, mtime, payload[pathLength:], None)
+        self.file.truncate(end)
+        self.end = end
+        self.log.info("Write spool %s has %d writes to store", self.fileName, len(self.pending))
+
+    def writeHeader(self):
+        self.file.seek(0)
+        self.file.write(self.FILE_HEADER.pack(self.MAGIC, self.stored))
+        self.file.flush()
+
+    def entry(self, seq, path, offset, mtime, data):
+        # The paths come from FUSE as unicode, they are stored as UTF-8
+        pathBytes = encodePath(path)
+        payload = pathBytes + data
+        return self.ENTRY_HEADER.pack(self.ENTRY_MAGIC, seq, offset, mtime, len(data),
+            zlib.crc32(payload) & 0xffffffff, len(pathBytes)) + payload
+
+    def entrySize(self, path, data):
+        return self.ENTRY_HEADER.size + len(encodePath(path)) + len(data)
+
+    def addPending(self, seq, path, offset, mtime, data, lockOwner):
+        self.pending.append((seq, path, offset, mtime, data, lockOwner))
+        self.paths[path] = self.paths.get(path, 0) + 1
+        self.size += len(data)
+        self.pendingBytes += self.entrySize(path, data)
+
+    def removePending(self):
+        (seq, path, offset, mtime, data, lockOwner) = self.pending.popleft()
+        self.paths[path] -= 1
+        if not self.paths[path]:
+            del self.paths[path]
+        self.size -= len(data)
+        self.pendingBytes -= self.entrySize(path, data)
+        self.stored = seq
+        self.writeHeader()
+        if not self.pending:
+            self.file.truncate(self.FILE_HEADER_SIZE)
+            self.end = self.FILE_HEADER_SIZE
+        elif self.end - self.FILE_HEADER_SIZE - self.pendingBytes >= self.maxBytes:
+            self.compact()
+
+    def compact(self):
+        """Replaces the file with one with only the pending writes"""
+        self.log.debug("Write spool %s - compacting %d bytes to %d", self.fileName, self.end, self.FILE_HEADER_SIZE + self.pendingBytes)
+        tempName = self.fileName + ".tmp"
+        with open(tempName, "wb") as temp:
+            temp.write(self.FILE_HEADER.pack(self.MAGIC, self.stored))
+            temp.truncate(self.FILE_HEADER_SIZE)
+            temp.seek(self.FILE_HEADER_SIZE)
+            for (seq, path, offset, mtime, data, unused) in self.pending:
+                temp.write(self.entry(seq, path, offset, mtime, data))
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.rename(tempName, self.fileName)
+        self.file.close()
+        self.file = open(self.fileName, "r+b")
+        self.end = self.FILE_HEADER_SIZE + self.pendingBytes
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def add(self, path, offset, data, lockOwner=None):
+        """The write is stored on behalf of the lock owner, so that it goes through the locks held by the owner"""
+        with self.condition:
+            # Writers wait for the uploader when the spool is full
+            while self.size >= self.maxBytes and self.pending:
+                self.condition.wait()
+            self.seq += 1
+            mtime = int(time())
+            entry = self.entry(self.seq, path, offset, mtime, data)
+            self.file.seek(self.end)
+            self.file.write(entry)
+            self.file.flush()
+            self.end += len(entry)
+            self.addPending(self.seq, path, offset, mtime, data, lockOwner)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                (seq, path, offset, mtime, data, lockOwner) = self.pending[0]
+            self.storeWrite(path, offset, data, lockOwner)
+            with self.condition:
+                self.removePending()
+                self.condition.notify_all()
+
+    def storeWrite(self, path, offset, data, lockOwner):
+        retries = 0
+        while True:
+            try:
+                self.store(path, offset, data, lockOwner)
+                return
+            except FuseOSError, e:
+                if e.errno not in (EAGAIN, EIO):
+                    # Nothing to store it to (e.g. the file is gone)
+                    self.log.error("spooled write of %d bytes to %s at %d dropped: %s", len(data), path, offset, e.strerror)
+                    return
+                error = e.strerror
+            except Exception, e:
+                # DynamoDB errors come here as they are, they are not translated for FUSE yet
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                error = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+            retries += 1
+            if retries >= self.MAX_STORE_RETRIES:
+                self.log.error("spooled write of %d bytes to %s at %d dropped after %d retries: %s", len(data), path, offset, retries, error)
+                with self.condition:
+                    self.errors[path] = EIO
+                return
+            self.log.debug("storing spooled write to %s failed, retry %d: %s", path, retries, error)
+            sleep(min(0.05 * (2 ** retries), self.RETRY_DELAY))
+
+    def wait(self, path=None):
+        """Waits until the writes to the path (all writes without path) are stored"""
+        with self.condition:
+            while self.paths.get(path, 0) if path is not None else self.pending:
+                self.condition.wait()
+
+    def checkError(self, path):
+        """Raises the error of the writes to the path dropped since the last check"""
+        with self.condition:
+            error = self.errors.pop(path, None)
+        if error is not None:
+            raise FuseOSError(error)
+
+    def isDirty(self, path):
+        with self.condition:
+            return path in self.paths
+
+    def dirtyAttrs(self, path):
+        """Returns (size, mtime) of the spooled writes to the path"""
+        with self.condition:
+            writes = [(offset + len(data), mtime) for (unused, writePath, offset, mtime, data, unused1) in self.pending if writePath == path]
+            return max(size for (size, unused) in writes) if writes else 0, max(mtime for (unused, mtime) in writes) if writes else 0
+
+    def apply(self, path, data, offset):
+        """Copies the spooled data over the bytearray data read from offset, in the order of the writes"""
+        with self.condition:
+            dataEnd = offset + len(data)
+            for (unused, writePath, writeOffset, unused1, writeData, unused2) in self.pending:
+                if writePath != path:
+                    continue
+                start = max(offset, writeOffset)
+                end = min(dataEnd, writeOffset + len(writeData))
+                if start < end:
+                    data[start - offset:end - offset] = writeData[start - writeOffset:end - writeOffset]
+
+    def close(self):
+        if self.thread is not None:
+            self.wait()
+        with self.condition:
+            self.file.close()
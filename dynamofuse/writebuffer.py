@@ -0,0 +1,104 @@
+#    Dynamo-Fuse - POSIX-compliant distributed FUSE file system with AWS DynamoDB as backend
+#    Copyright (C) 2013 Denis Mikhalkin
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import with_statement
+
+__author__ = 'Denis Mikhalkin'
+
+from threading import Lock
+import logging
+
+class WriteBuffer(object):
+    """
+    Dirty data of one open file, not yet written to the blocks.
+    Writes are kept as sorted, non-overlapping extents; touching or overlapping writes are merged into one extent,
+    so that a sequential writer stores every block once when the buffer is flushed instead of once per write() call.
+    """
+    log = logging.getLogger("dynamo-fuse-handle")
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.extents = [] # [offset, bytearray], sorted by offset
+        self.size = 0
+        self.lock = Lock()
+
+    def add(self, offset, data):
+        """Adds the data of a write. Returns True when the buffer is over its limit and should be flushed"""
+        if not data:
+            return False
+        with self.lock:
+            end = offset + len(data)
+            first = 0
+            while first < len(self.extents) and self.extents[first][0] + len(self.extents[first][1]) < offset:
+                first += 1
+            last = first
+            while last < len(self.extents) and self.extents[last][0] <= end:
+                last += 1
+
+            if first == last:
+                self.extents.insert(first, [offset, bytearray(data)])
+                self.size += len(data)
+            else:
+                # Merge the extents touched by the write into the first of them, the new data wins
+                (start, buf) = self.extents[first]
+                self.size -= len(buf)
+                if start > offset:
+                    buf[0:0] = "\0" * (start - offset)
+                    start = offset
+                for (extentOffset, extentData) in self.extents[first + 1:last]:
+                    self.size -= len(extentData)
+                    pos = extentOffset - start
+                    if len(buf) < pos:
+                        buf.extend("\0" * (pos - len(buf)))
+                    buf[pos:pos + len(extentData)] = extentData
+                buf[offset - start:end - start] = data
+                self.extents[first:last] = [[start, buf]]
+                self.size += len(buf)
+            return self.size >= self.maxBytes
+
+    def isDirty(self):
+        return len(self.extents) > 0
+
+    def end(self):
+        with self.lock:
+            return self.extents[-1][0] + len(self.extents[-1][1]) if self.extents else 0
+
+    def apply(self, data, offset):
+        """Copies the dirty data over the bytearray data read from offset"""
+        with self.lock:
+            dataEnd = offset + len(data)
+            for (extentOffset, extentData) in self.extents:
+                start = max(offset, extentOffset)
+                end = min(dataEnd, extentOffset + len(extentData))
+                if start < end:
+                    data[start - offset:end - offset] = extentData[start - extentOffset:end - extentOffset]
+
+    def take(self, blockSize=None):
+        """
+        Removes and returns the dirty extents as a list of (offset, data).
+        With blockSize the partial last block of the buffer stays, as it is likely to be completed by the next write.
+        """
+        with self.lock:
+            extents = self.extents
+            self.extents = []
+            self.size = 0
+            if blockSize and extents:
+                (offset, data) = extents[-1]
+                tail = (offset + len(data)) % blockSize
+                if 0 < tail < len(data):
+                    self.extents = [[offset + len(data) - tail, data[len(data) - tail:]]]
+                    self.size = tail
+                    del data[len(data) - tail:]
+            return [(offset, str(data)) for (offset, data) in extents]
@@ -0,0 +1,231 @@
+__author__ = 'Denis Mikhalkin'
+
+# Microbenchmark of the copying in the block data path: bytes copied in Python per MB transferred and MB/s of
+# File.read and File._write over blocks kept by a stub accessor in memory, without DynamoDB.
+# The copies are counted by giving the file and block modules counting versions of the buffer types they copy
+# with (memoryview.tobytes, str slices and joins, bytearray construction and slice assignment), so whatever
+# the code does is what is counted. MB/s is measured separately, without the counting.
+# Usage: python tests/copybench.py [blockSize] [requestSize]
+
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.blockcache import BlockCache
+import dynamofuse.records.block
+import dynamofuse.records.file
+from dynamofuse.records.file import File
+from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError, DynamoDBConditionalCheckFailedError
+from boto.dynamodb.types import Binary
+
+MB = 1024 * 1024
+ROUNDS = 20
+
+class Counter(object):
+    copied = 0
+
+class CountingStr(str):
+    """Block data as returned by DynamoDB - its slices are copies"""
+    def __getslice__(self, start, end):
+        data = str.__getslice__(self, start, end)
+        Counter.copied += len(data)
+        return data
+
+    def __getitem__(self, key):
+        data = str.__getitem__(self, key)
+        if isinstance(key, slice):
+            Counter.copied += len(data)
+        return data
+
+class CountingView(object):
+    """memoryview whose slices are views and tobytes() is a copy"""
+    def __init__(self, data):
+        self.view = data.view if isinstance(data, CountingView) else memoryview(data)
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            view = CountingView.__new__(CountingView)
+            view.view = self.view[key]
+            return view
+        return self.view[key]
+
+    def __eq__(self, other):
+        return self.view == (other.view if isinstance(other, CountingView) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tobytes(self):
+        Counter.copied += len(self.view)
+        return self.view.tobytes()
+
+class CountingBytearray(bytearray):
+    """bytearray built from data or assigned into is a copy"""
+    def __init__(self, source=0, *args):
+        if isinstance(source, CountingView):
+            source = source.view
+        if not isinstance(source, (int, long)):
+            Counter.copied += len(source)
+        bytearray.__init__(self, source, *args)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, CountingView):
+            value = value.view
+        if isinstance(key, slice):
+            Counter.copied += len(value)
+        bytearray.__setitem__(self, key, value)
+
+def countingAssembleBlock(itemData, startOffset, dataSlice):
+    data = originalAssembleBlock(itemData, startOffset, dataSlice)
+    if isinstance(dataSlice, CountingView) and len(data) != len(dataSlice):
+        # The kept parts of the old data were joined with the slice
+        Counter.copied += len(data)
+    return data
+
+originalAssembleBlock = dynamofuse.records.block.assembleBlock
+PATCHES = [(dynamofuse.records.file, "memoryview", CountingView), (dynamofuse.records.block, "memoryview", CountingView),
+           (dynamofuse.records.file, "bytearray", CountingBytearray), (dynamofuse.records.block, "bytearray", CountingBytearray),
+           (dynamofuse.records.file, "assembleBlock", countingAssembleBlock),
+           (dynamofuse.records.block, "assembleBlock", countingAssembleBlock)]
+
+def counting(enable):
+    for (module, name, value) in PATCHES:
+        if enable:
+            setattr(module, name, value)
+        elif name in module.__dict__ and module.__dict__[name] is value:
+            if name == "assembleBlock":
+                setattr(module, name, originalAssembleBlock)
+            else:
+                delattr(module, name)
+
+class StubItem(dict):
+    def __init__(self, table, attrs):
+        dict.__init__(self, attrs)
+        self.table = table
+
+    def add_attribute(self, name, value):
+        self[name] = self.get(name, 0) + value
+
+    def save(self, expected_value=None, return_values=None):
+        self.table.store(self)
+
+    def put(self, expected_value=None):
+        if (self["blockId"], self["blockNum"]) in self.table.items:
+            raise DynamoDBConditionalCheckFailedError(400, "exists", {})
+        self.table.store(self)
+
+    def delete(self, expected_value=None):
+        del self.table.items[(self["blockId"], self["blockNum"])]
+
+class StubTable(object):
+    """Block table in memory. Stored data is read back as a new str, as from DynamoDB"""
+    name = "blocks"
+
+    def __init__(self):
+        self.items = dict()
+
+    def store(self, item):
+        attrs = dict(item)
+        if "data" in attrs:
+            attrs["data"] = Binary(str(attrs["data"].value))
+        self.items[(item["blockId"], item["blockNum"])] = attrs
+
+    def load(self, hashKey, rangeKey):
+        attrs = dict(self.items[(hashKey, rangeKey)])
+        if "data" in attrs:
+            attrs["data"] = Binary(CountingStr(attrs["data"].value))
+        return StubItem(self, attrs)
+
+    def get_item(self, hashKey, rangeKey, attributes_to_get=None):
+        if not (hashKey, rangeKey) in self.items:
+            raise DynamoDBKeyNotFoundError("not found")
+        return self.load(hashKey, rangeKey)
+
+    def new_item(self, hash_key=None, range_key=None, attrs=None):
+        attrs = dict(attrs or {})
+        if hash_key is not None:
+            attrs.update(blockId=hash_key, blockNum=range_key)
+        return StubItem(self, attrs)
+
+class StubBatch(object):
+    def __init__(self, table):
+        self.table = table
+        self.keys = []
+        self.puts = []
+
+    def add_batch(self, table, keys=None, attributes_to_get=None, puts=None):
+        self.keys.extend(keys or [])
+        self.puts.extend(puts or [])
+
+    def submit(self):
+        for item in self.puts:
+            self.table.store(item)
+        items = [self.table.load(*key) for key in self.keys if key in self.table.items]
+        return {"Responses": {self.table.name: {"Items": items}}}
+
+class StubConnection(object):
+    def __init__(self, table):
+        self.table = table
+
+    def new_batch_list(self):
+        return StubBatch(self.table)
+
+    def new_batch_write_list(self):
+        return StubBatch(self.table)
+
+class StubAccessor(object):
+    def __init__(self, blockSize):
+        self.BLOCK_SIZE = blockSize
+        self.blockTable = StubTable()
+        self.conn = StubConnection(self.blockTable)
+        # Off - every read goes to the table
+        self.blockCache = BlockCache(0)
+        self.diskCache = None
+
+def newFile(blockSize):
+    file = File()
+    file.accessor = StubAccessor(blockSize)
+    file.path = "/file"
+    file.record = {"blockId": "1", "st_size": MB + blockSize, "st_blksize": blockSize, "version": 1}
+    for blockNum in range(MB / blockSize + 1):
+        file.accessor.blockTable.store(StubItem(None, {"blockId": "1", "blockNum": blockNum, "version": 1,
+            "data": Binary(os.urandom(blockSize))}))
+    return file
+
+def run(name, operation, blockSize, requestSize, offsets):
+    data = os.urandom(requestSize)
+    results = []
+    for count in [True, False]:
+        file = newFile(blockSize)
+        counting(count)
+        Counter.copied = 0
+        start = time()
+        try:
+            for unused in range(ROUNDS):
+                for offset in offsets:
+                    if operation == "write":
+                        file._write(data, offset)
+                    else:
+                        file.read(offset, requestSize)
+        finally:
+            counting(False)
+        results.append((Counter.copied, time() - start))
+    ((copied, unused), (unused, elapsed)) = results
+    transferred = float(ROUNDS * len(offsets) * requestSize) / MB
+    print "%-28s %10.0f bytes copied per MB %10.1f MB/s" % (name, copied / transferred, transferred / elapsed if elapsed else 0)
+
+if __name__ == '__main__':
+    blockSize = int(sys.argv[1]) if len(sys.argv) > 1 else 32768
+    requestSize = int(sys.argv[2]) if len(sys.argv) > 2 else 131072
+    print "block size %d, request size %d" % (blockSize, requestSize)
+    aligned = range(0, MB, requestSize)
+    # Small writes in the middle of the blocks
+    small = range(blockSize / 3, MB, blockSize)
+    run("write", "write", blockSize, requestSize, aligned)
+    run("small write", "write", blockSize, 4096, small)
+    run("read", "read", blockSize, requestSize, aligned)
+    run("small read", "read", blockSize, 4096, small)
@@ -0,0 +1,87 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.blockcache import BlockCache
+
+class TestBlockCache(unittest.TestCase):
+
+    def testGetPut(self):
+        cache = BlockCache(1024)
+        self.assertIsNone(cache.get("1", 0))
+        cache.put("1", 0, 1, "aaaa")
+        self.assertEqual((1, "aaaa"), cache.get("1", 0))
+        self.assertEqual(1, cache.stats()["hits"])
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def testNewerVersionReplaces(self):
+        cache = BlockCache(1024)
+        cache.put("1", 0, 1, "aaaa")
+        cache.put("1", 0, 2, "bb")
+        self.assertEqual((2, "bb"), cache.get("1", 0))
+        self.assertEqual(2, cache.stats()["bytes"])
+        # An older version read by someone else doesn't replace the newer one
+        cache.put("1", 0, 1, "aaaa")
+        self.assertEqual((2, "bb"), cache.get("1", 0))
+
+    def testLeastRecentlyUsedEvicted(self):
+        cache = BlockCache(8)
+        cache.put("1", 0, 1, "aaaa")
+        cache.put("1", 1, 1, "bbbb")
+        cache.get("1", 0)
+        cache.put("1", 2, 1, "cccc")
+        self.assertIsNone(cache.get("1", 1))
+        self.assertEqual((1, "aaaa"), cache.get("1", 0))
+        self.assertEqual((1, "cccc"), cache.get("1", 2))
+        self.assertEqual(1, cache.stats()["evictions"])
+        self.assertEqual(8, cache.stats()["bytes"])
+
+    def testTooLargeNotCached(self):
+        cache = BlockCache(2)
+        cache.put("1", 0, 1, "aaaa")
+        self.assertIsNone(cache.get("1", 0))
+
+    def testDisabled(self):
+        cache = BlockCache(0)
+        cache.put("1", 0, 1, "aaaa")
+        self.assertIsNone(cache.get("1", 0))
+
+    def testInvalidate(self):
+        cache = BlockCache(1024)
+        for blockNum in range(4):
+            cache.put("1", blockNum, 1, "aaaa")
+        cache.put("2", 3, 1, "aaaa")
+        cache.invalidate("1", 2)
+        self.assertIsNotNone(cache.get("1", 1))
+        self.assertIsNone(cache.get("1", 2))
+        self.assertIsNone(cache.get("1", 3))
+        self.assertIsNotNone(cache.get("2", 3))
+        cache.drop("1", 1)
+        self.assertIsNone(cache.get("1", 1))
+        self.assertEqual(8, cache.stats()["bytes"])
+
+    def testFileVersion(self):
+        cache = BlockCache(1024)
+        cache.put("1", 0, 1, "aaaa", 5)
+        self.assertEqual((1, "aaaa"), cache.get("1", 0, 5))
+        # Our own change of the file
+        cache.restamp("1", 5, 6)
+        self.assertEqual((1, "aaaa"), cache.get("1", 0, 6))
+        # The file was changed by another client
+        self.assertIsNone(cache.get("1", 0, 7))
+        self.assertIsNone(cache.get("1", 0, 6))
+        self.assertEqual(0, cache.stats()["bytes"])
+
+    def testExpired(self):
+        cache = BlockCache(1024, 0.05)
+        cache.put("1", 0, 1, "aaaa")
+        sleep(0.1)
+        self.assertIsNone(cache.get("1", 0))
+        self.assertEqual(0, cache.stats()["bytes"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.codec import CODECS, checkCodec, encodeBlock, decodeBlock
+from fuse import FuseOSError
+
+class TestCodec(unittest.TestCase):
+
+    def testRoundTrip(self):
+        data = "abcd" * 1000
+        for name in CODECS.keys():
+            (codec, payload) = encodeBlock(name, data)
+            self.assertEqual(name, codec)
+            self.assertTrue(len(payload) < len(data))
+            self.assertEqual(data, decodeBlock(codec, payload, len(data)))
+
+    def testIncompressibleStoredAsIs(self):
+        data = os.urandom(4096)
+        self.assertEqual((None, data), encodeBlock("zlib", data))
+
+    def testNoCodec(self):
+        self.assertEqual((None, "aaaa"), encodeBlock(None, "aaaa"))
+        self.assertEqual((None, ""), encodeBlock("zlib", ""))
+
+    def testWrongSize(self):
+        (codec, payload) = encodeBlock("zlib", "a" * 100)
+        with self.assertRaises(FuseOSError):
+            decodeBlock(codec, payload, 99)
+
+    def testUnknownCodec(self):
+        with self.assertRaises(FuseOSError):
+            decodeBlock("lzma", "", 0)
+        with self.assertRaises(ValueError):
+            checkCodec("lzma")
+        self.assertEqual("bz2", checkCodec("bz2"))
+        self.assertIsNone(checkCodec(None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.records.delta import deltaNum, encodeExtents, decodeExtents, applyExtents
+
+class TestDelta(unittest.TestCase):
+
+    def testDeltaNum(self):
+        self.assertEqual(-1, deltaNum(0))
+        self.assertEqual(-11, deltaNum(10))
+        self.assertEqual(10, deltaNum(deltaNum(10)))
+
+    def testRoundTrip(self):
+        extents = [(1, 0, "abc"), (2, 100, ""), (3, 5, "\0" * 10)]
+        self.assertEqual(extents, decodeExtents(encodeExtents(extents)))
+        self.assertEqual([], decodeExtents(""))
+
+    def testApplyInOrder(self):
+        extents = [(1, 0, "aaaa"), (2, 2, "bb")]
+        self.assertEqual(("aabb567", 2), applyExtents("0124567", extents))
+
+    def testApplySkipsApplied(self):
+        extents = [(1, 0, "aaaa"), (2, 2, "bb"), (3, 6, "c")]
+        self.assertEqual(("01bb45c", 3), applyExtents("012345", extents, applied=1))
+        self.assertEqual(("012345", 3), applyExtents("012345", extents, applied=3))
+
+    def testApplyPastEnd(self):
+        self.assertEqual(("01\0\0ab", 1), applyExtents("01", [(1, 4, "ab")]))
+        self.assertEqual(("ab", 1), applyExtents("", [(1, 0, "ab")]))
+
+    def testApplyNothing(self):
+        self.assertEqual(("data", 5), applyExtents("data", [], applied=5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.diskcache import DiskBlockCache
+
+BLOCK_SIZE = 1024
+LARGE_BLOCK_SIZE = 8192
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "test.cache")
+        self.cache = self.open()
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return DiskBlockCache(self.fileName, 64 * 1024, [BLOCK_SIZE, LARGE_BLOCK_SIZE])
+
+    def testGetPut(self):
+        self.assertIsNone(self.cache.get("1", 0, 1))
+        self.cache.put("1", 0, 3, 1, "aaaa")
+        self.assertEqual((3, "aaaa"), self.cache.get("1", 0, 1))
+        # Cached for another version of the file
+        self.assertIsNone(self.cache.get("1", 0, 2))
+
+    def testLargeBlocks(self):
+        data = "b" * (BLOCK_SIZE * 4)
+        self.cache.put("1", 0, 1, 1, data)
+        self.assertEqual((1, data), self.cache.get("1", 0, 1))
+        self.assertTrue(os.path.exists("%s.%d" % (self.fileName, LARGE_BLOCK_SIZE)))
+        # Too large for any slot
+        self.cache.put("1", 1, 1, 1, "c" * (LARGE_BLOCK_SIZE + 1))
+        self.assertIsNone(self.cache.get("1", 1, 1))
+
+    def testBlockChangesPool(self):
+        self.cache.put("1", 0, 1, 1, "a" * BLOCK_SIZE * 2)
+        self.cache.put("1", 0, 2, 2, "bbbb")
+        self.assertEqual((2, "bbbb"), self.cache.get("1", 0, 2))
+        self.assertEqual(1, self.cache.stats()["blocks"])
+
+    def testReopen(self):
+        self.cache.put("1", 0, 1, 5, "aaaa")
+        self.cache.put("1", 1, 1, 5, "b" * BLOCK_SIZE * 2)
+        self.cache.close()
+        self.cache = self.open()
+        self.assertEqual((1, "aaaa"), self.cache.get("1", 0, 5))
+        self.assertEqual((1, "b" * BLOCK_SIZE * 2), self.cache.get("1", 1, 5))
+
+    def testRestampAndInvalidate(self):
+        for blockNum in range(3):
+            self.cache.put("1", blockNum, 1, 1, "aaaa")
+        self.cache.restamp("1", 1, 2)
+        self.assertEqual((1, "aaaa"), self.cache.get("1", 0, 2))
+        self.cache.invalidate("1", 1)
+        self.assertIsNotNone(self.cache.get("1", 0, 2))
+        self.assertIsNone(self.cache.get("1", 1, 2))
+        self.cache.drop("1", 0)
+        self.assertIsNone(self.cache.get("1", 0, 2))
+        self.assertEqual(0, self.cache.stats()["blocks"])
+
+    def testCorruptedSlot(self):
+        self.cache.put("1", 0, 1, 1, "aaaa")
+        pool = self.cache.pools[0]
+        offset = pool.slotOffset(pool.blocks["1"][0]) + pool.SLOT_HEADER_SIZE
+        pool.mm[offset:offset + 1] = "x"
+        self.assertIsNone(self.cache.get("1", 0, 1))
+        self.assertEqual(0, self.cache.stats()["blocks"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.blockcache import BlockCache
+from dynamofuse.records.block import BlockRecord, MAX_BLOCK_SIZE
+from dynamofuse.records.file import File
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException
+from errno import ENOENT
+from fuse import FuseOSError
+
+BLOCK_SIZE = 16
+
+class StubEntry(dict):
+    """Block item returned by a query"""
+    def __init__(self, blocks, blockNum):
+        dict.__init__(self, blockNum=blockNum)
+        self.blocks = blocks
+
+    def __getitem__(self, name):
+        return self.get(name, None)
+
+    def delete(self):
+        del self.blocks[self["blockNum"]]
+
+class StubBlockTable(object):
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def query(self, blockId__eq, blockNum__between, attributes=None):
+        (first, last) = blockNum__between
+        return [StubEntry(self.blocks, blockNum) for blockNum in sorted(self.blocks.keys()) if first <= blockNum <= last]
+
+class StubAccessor(object):
+    def __init__(self, blocks):
+        self.blockTablev2 = StubBlockTable(blocks)
+        self.blockCache = BlockCache(1024 * 1024)
+        self.diskCache = None
+
+class StubRecord(dict):
+    def save(self):
+        self["version"] += 1
+
+class NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        pass
+
+class TestPunchHole(unittest.TestCase):
+    """File.punchHole over blocks kept in memory"""
+
+    def setUp(self):
+        self.blocks = dict((blockNum, bytearray(chr(ord("a") + blockNum) * BLOCK_SIZE)) for blockNum in range(4))
+        self.file = File()
+        self.file.accessor = StubAccessor(self.blocks)
+        self.file.path = "/file"
+        self.file.record = StubRecord(blockId="1", st_size=4 * BLOCK_SIZE, st_blksize=BLOCK_SIZE, version=1,
+            st_ctime=0, st_mtime=0)
+        self.file.writeLock = lambda: NoLock()
+        self.file._write = self.write
+
+    def write(self, data, offset, conditional=False, fresh=False):
+        blockNum = offset / BLOCK_SIZE
+        self.assertEqual(blockNum, (offset + len(data) - 1) / BLOCK_SIZE)
+        start = offset % BLOCK_SIZE
+        self.blocks[blockNum][start:start + len(data)] = data
+
+    def content(self):
+        return "".join(str(self.blocks[blockNum]) if blockNum in self.blocks else "\0" * BLOCK_SIZE for blockNum in range(4))
+
+    def testWithinBlock(self):
+        self.file.punchHole(2, 4)
+        self.assertEqual("aa" + "\0" * 4 + "a" * 10 + "b" * 16 + "c" * 16 + "d" * 16, self.content())
+        self.assertEqual(4, len(self.blocks))
+
+    def testWholeBlocksDeleted(self):
+        self.file.punchHole(BLOCK_SIZE - 4, 2 * BLOCK_SIZE + 8)
+        self.assertEqual([0, 3], sorted(self.blocks.keys()))
+        self.assertEqual("a" * 12 + "\0" * 40 + "d" * 12, self.content())
+        self.assertEqual(2, self.file.record["version"])
+
+    def testAlignedBlocks(self):
+        self.file.punchHole(BLOCK_SIZE, BLOCK_SIZE)
+        self.assertEqual([0, 2, 3], sorted(self.blocks.keys()))
+
+    def testPastEndOfFile(self):
+        self.file.punchHole(3 * BLOCK_SIZE, 10 * BLOCK_SIZE)
+        self.assertEqual([0, 1, 2], sorted(self.blocks.keys()))
+        self.file.punchHole(5 * BLOCK_SIZE, BLOCK_SIZE)
+        self.assertEqual([0, 1, 2], sorted(self.blocks.keys()))
+        self.assertEqual(4 * BLOCK_SIZE, self.file.record["st_size"])
+
+class StubDelta(object):
+    def __init__(self, extents):
+        self.extents = extents
+
+    def getExtents(self):
+        return self.extents
+
+    def trim(self, applied):
+        self.extents = [extent for extent in self.extents if extent[0] > applied]
+
+class TestCompactHole(unittest.TestCase):
+    """File.compactBlock of a block which only has logged writes"""
+
+    def setUp(self):
+        self.created = dict()
+        self.file = File()
+        self.file.accessor = StubAccessor(dict())
+        self.file.path = "/file"
+        self.file.record = StubRecord(blockId="1", st_size=4 * BLOCK_SIZE, st_blksize=BLOCK_SIZE, version=1)
+        self.file.reload = lambda: None
+        self.file.getBlock = self.getBlock
+        self.delta = StubDelta([(1, 2, "aa"), (2, 6, "bb")])
+        self.file.newDelta = lambda blockNum: self.delta
+        self.origCreateBlock = BlockRecord.createBlock
+        BlockRecord.createBlock = staticmethod(self.createBlock)
+
+    def tearDown(self):
+        BlockRecord.createBlock = staticmethod(self.origCreateBlock)
+
+    def getBlock(self, blockNum, getData=False, forUpdate=False):
+        raise FuseOSError(ENOENT)
+
+    def createBlock(self, accessor, blockId, blockNum, data, codec=None, stripes=1, applied=0, fileVersion=None):
+        self.created[blockNum] = (data, applied)
+        return True
+
+    def testCreated(self):
+        self.file.compactBlock(1)
+        self.assertEqual({1: ("\0\0aa\0\0bb", 2)}, self.created)
+        self.assertEqual([], self.delta.extents)
+
+    def testZeros(self):
+        self.delta = StubDelta([(1, 2, "\0\0")])
+        self.file.compactBlock(1)
+        self.assertEqual({}, self.created)
+        self.assertEqual([], self.delta.extents)
+
+    def testPastEndOfFile(self):
+        self.file.compactBlock(4)
+        self.assertEqual({}, self.created)
+        self.assertEqual(2, len(self.delta.extents))
+
+class StubTable(object):
+    """The file record of the tests of appends, updated with UpdateItem"""
+    table_name = "test"
+
+    def __init__(self, record):
+        self.connection = self
+        self.record = record
+        self.updates = 0
+
+    def update_item(self, table_name, key, attribute_updates, expected, return_values):
+        self.updates += 1
+        size = int(expected["st_size"]["AttributeValueList"][0]["N"])
+        blockId = expected["blockId"]["AttributeValueList"][0]["S"]
+        if not (self.record["st_size"] < size and self.record["blockId"] == blockId):
+            raise ConditionalCheckFailedException(400, "Bad Request")
+        for (name, update) in attribute_updates.items():
+            value = int(update["Value"]["N"])
+            self.record[name] = self.record[name] + value if update["Action"] == "ADD" else value
+        return {"Attributes": {"version": {"N": str(self.record["version"])}}}
+
+class TestAppend(unittest.TestCase):
+    """File.append with the size published by other appenders meanwhile"""
+
+    def setUp(self):
+        self.stored = StubRecord(path="/", name="file", blockId="1", st_size=10, st_blksize=BLOCK_SIZE, version=1,
+            st_ctime=0, st_mtime=0)
+        self.writes = []
+        self.file = File()
+        self.file.accessor = StubAccessor(dict())
+        self.file.accessor.tablev2 = StubTable(self.stored)
+        self.file.accessor.invalidateRecord = lambda path: None
+        self.file.accessor.LARGE_FILE_SIZE = 0
+        self.file.accessor.LARGE_BLOCK_SIZE = BLOCK_SIZE
+        self.file.path = "/file"
+        self.file.record = StubRecord(self.stored)
+        self.file.reserve = lambda size: 10
+        self.file.reload = self.reload
+        self.file._write = lambda data, offset, conditional=False, fresh=False: self.writes.append((self.file.record["blockId"], offset))
+
+    def reload(self):
+        self.file.record = StubRecord(self.stored)
+
+    def testPublished(self):
+        self.assertEqual(4, self.file.append("abcd"))
+        self.assertEqual(14, self.stored["st_size"])
+        self.assertEqual(2, self.stored["version"])
+        self.assertEqual(14, self.file.record["st_size"])
+        self.assertEqual([("1", 10)], self.writes)
+
+    def testPublishedPastByOthers(self):
+        self.stored["st_size"] = 20
+        self.assertEqual(4, self.file.append("abcd"))
+        self.assertEqual(20, self.stored["st_size"])
+        self.assertEqual(1, self.file.accessor.tablev2.updates)
+
+    def testBlocksReplaced(self):
+        self.stored["blockId"] = "2"
+        self.assertEqual(4, self.file.append("abcd"))
+        self.assertEqual([("1", 10), ("2", 10)], self.writes)
+        self.assertEqual(14, self.stored["st_size"])
+
+class TestResizeBlocks(unittest.TestCase):
+    """File.resizeBlocks copying the data to larger blocks"""
+
+    def setUp(self):
+        self.reads = []
+        self.writes = []
+        self.file = File()
+        self.file.accessor = StubAccessor(dict())
+        self.file.accessor.allocUniqueId = lambda: 2
+        self.file.path = "/file"
+        self.file.record = StubRecord(blockId="1", st_size=40 * BLOCK_SIZE + 3, st_blksize=BLOCK_SIZE, version=1)
+        self.file.read = self.read
+        self.file._write = self.write
+
+    def read(self, offset, size, readAhead=None, fileSize=None):
+        self.reads.append((self.file.record["blockId"], self.file.blockSize(), offset, size))
+        return "x" * size
+
+    def write(self, data, offset, conditional=False, fresh=False):
+        self.assertTrue(fresh)
+        self.writes.append((self.file.record["blockId"], self.file.blockSize(), offset, len(data)))
+
+    def testChunks(self):
+        self.file.resizeBlocks(2 * BLOCK_SIZE)
+        chunk = 32 * BLOCK_SIZE
+        self.assertEqual([("1", BLOCK_SIZE, 0, chunk), ("1", BLOCK_SIZE, chunk, 8 * BLOCK_SIZE + 3)], self.reads)
+        self.assertEqual([("2", 2 * BLOCK_SIZE, 0, chunk), ("2", 2 * BLOCK_SIZE, chunk, 8 * BLOCK_SIZE + 3)], self.writes)
+        self.assertEqual("2", self.file.record["blockId"])
+        self.assertEqual(2 * BLOCK_SIZE, self.file.blockSize())
+        # The old blocks are still read by other clients for a while
+        self.assertEqual("1", self.file.retiredBlocks())
+        self.assertIsNone(self.file.retiredBlocks(self.file.record["retiredTime"] + 1))
+        self.assertEqual("1", self.file.retiredBlocks(self.file.record["retiredTime"] + 3600))
+
+    def testLegacyBlockSize(self):
+        del self.file.record["st_blksize"]
+        self.file.record["st_size"] = 10
+        self.file.resizeBlocks(2 * BLOCK_SIZE)
+        self.assertEqual([("1", 32768, 0, 10)], self.reads)
+        self.assertEqual(2 * BLOCK_SIZE, self.file.blockSize())
+
+class TestInline(unittest.TestCase):
+    """Writes to a file keeping its data in the record"""
+
+    def setUp(self):
+        self.writes = []
+        self.file = File()
+        self.file.accessor = StubAccessor(dict())
+        self.file.accessor.OPTIMISTIC_WRITES = False
+        self.file.accessor.LARGE_FILE_SIZE = 0
+        self.file.accessor.LARGE_BLOCK_SIZE = 0
+        # More than fits into a DynamoDB item
+        self.file.accessor.INLINE_DATA_SIZE = 1024 * 1024
+        self.file.path = "/file"
+        self.file.record = StubRecord(blockId="1", st_size=0, st_blksize=BLOCK_SIZE, version=1, inline=True,
+            st_ctime=0, st_mtime=0)
+        self.file.writeLock = lambda: NoLock()
+        self.file._write = lambda data, offset, conditional=False, fresh=False: self.writes.append((offset, len(data)))
+
+    def testWithinLimit(self):
+        self.file.write("a" * MAX_BLOCK_SIZE, 0)
+        self.assertTrue(self.file.isInline())
+        self.assertEqual([], self.writes)
+
+    def testPastLimit(self):
+        self.file.write("a" * (MAX_BLOCK_SIZE + 1), 0)
+        self.assertFalse(self.file.isInline())
+        self.assertEqual([(0, MAX_BLOCK_SIZE + 1)], self.writes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import logging
+import dynamofuse.handle
+from dynamofuse.fs import DynamoFS
+from dynamofuse.handle import FileHandle
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError
+
+class TestFileHandle(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.origTime = dynamofuse.handle.time
+        dynamofuse.handle.time = lambda: self.now
+        self.handle = FileHandle(1, "/file", None, None)
+
+    def tearDown(self):
+        dynamofuse.handle.time = self.origTime
+
+    def testExpired(self):
+        self.assertFalse(self.handle.isExpired(1))
+        self.now += 1.5
+        self.assertTrue(self.handle.isExpired(1))
+        self.assertFalse(self.handle.isExpired(2))
+
+    def testNoTtl(self):
+        # attrcachettl=0 - the record is read again every time
+        self.assertTrue(self.handle.isExpired(0))
+        self.assertTrue(self.handle.isExpired(None))
+
+    def testPendingAttrs(self):
+        self.assertFalse(self.handle.isDirty())
+        self.handle.deferAttrs(10, 5, [("1", 0, "a" * 10)])
+        self.handle.deferAttrs(4, 7, [("1", 2, "bb")])
+        self.assertTrue(self.handle.isDirty())
+        self.assertEqual(12, self.handle.pendingBytes)
+        self.assertEqual((10, 7, [("1", 0, "a" * 10), ("1", 2, "bb")]), self.handle.takePendingAttrs())
+        self.assertFalse(self.handle.isDirty())
+        self.assertEqual(0, self.handle.pendingBytes)
+
+class StubFile(object):
+    def __init__(self, blockId, failSave=False):
+        self.path = "/file"
+        self.record = {"blockId": blockId}
+        self.failSave = failSave
+        self.writes = []
+        self.saved = None
+
+    def getRecord(self):
+        return self.record
+
+    def write(self, data, offset, deferAttrs=False):
+        self.writes.append((offset, data))
+        return len(data)
+
+    def updateSizeAndTime(self, size, mtime):
+        if self.failSave:
+            raise DynamoDBConditionalCheckFailedError(400, "changed", {})
+        self.saved = (size, mtime)
+
+class StubFS(object):
+    """Just what DynamoFS.saveAttrs uses"""
+    log = logging.getLogger("dynamo-fuse-oper  ")
+    rewriteDeferred = DynamoFS.rewriteDeferred.__func__
+
+    def __init__(self, record, refreshed):
+        self.record = record
+        self.refreshed = refreshed
+        self.fileHandles = self
+        self.invalidated = []
+
+    def getFileRecord(self, path, fh, refresh=False):
+        return self.refreshed if refresh else self.record
+
+    def invalidate(self, path, fh):
+        self.invalidated.append(path)
+
+class TestSaveAttrs(unittest.TestCase):
+    """Saving the size deferred by the writes of a handle"""
+
+    def setUp(self):
+        self.handle = FileHandle(1, "/file", None, None)
+        self.handle.deferAttrs(10, 5, [("1", 0, "aaaa")])
+        self.handle.deferAttrs(12, 6, [("1", 8, "bbbb")])
+
+    def save(self, fs):
+        DynamoFS.saveAttrs.__func__(fs, "/file", self.handle)
+
+    def testSameBlocks(self):
+        file = StubFile("1")
+        self.save(StubFS(file, None))
+        self.assertEqual([], file.writes)
+        self.assertEqual((12, 6), file.saved)
+        self.assertFalse(self.handle.isDirty())
+
+    def testBlocksReplaced(self):
+        # Another client moved the file to larger blocks after the writes
+        refreshed = StubFile("2")
+        self.save(StubFS(StubFile("1", failSave=True), refreshed))
+        self.assertEqual([(0, "aaaa"), (8, "bbbb")], refreshed.writes)
+        self.assertEqual((12, 6), refreshed.saved)
+
+    def testKeptOnFailure(self):
+        fs = StubFS(StubFile("1", failSave=True), StubFile("1", failSave=True))
+        with self.assertRaises(DynamoDBConditionalCheckFailedError):
+            self.save(fs)
+        self.assertEqual((12, 6, [("1", 0, "aaaa"), ("1", 8, "bbbb")]), self.handle.takePendingAttrs())
+
+if __name__ == '__main__':
+    unittest.main()
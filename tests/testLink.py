@@ -0,0 +1,77 @@
+__author__ = 'Denis Mikhalkin'
+
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.fs import DynamoFS
+from dynamofuse.handle import FileHandle
+from dynamofuse.records.file import File
+from dynamofuse.records.link import Link
+from dynamofuse.writebuffer import WriteBuffer
+
+BLOCK_SIZE = 16
+
+class StubFS(object):
+    """Just what DynamoFS.flushHandle uses"""
+    log = logging.getLogger("dynamo-fuse-oper  ")
+
+    def __init__(self, record):
+        self.record = record
+        self.writes = []
+
+    def getFileRecord(self, path, fh):
+        return self.record
+
+    def writeRecord(self, path, fh, data, offset):
+        self.writes.append((offset, str(data)))
+
+class StubAccessor(object):
+    """Returns the current stored records"""
+    def __init__(self, records):
+        self.records = records
+        self.invalidated = []
+
+    def invalidateRecord(self, path):
+        self.invalidated.append(path)
+
+    def getRecordOrThrow(self, path, attrs=None, ignoreDeleted=False):
+        record = File()
+        record.record = dict(self.records[path])
+        return record
+
+class TestLink(unittest.TestCase):
+    """Hard links pass the file operations through to the file"""
+
+    def setUp(self):
+        file = File()
+        file.record = {"blockId": "1", "st_size": 0, "st_blksize": BLOCK_SIZE}
+        self.link = Link()
+        self.link.record = {"link": "/file"}
+        self.link.link = file
+
+    def testBlockSize(self):
+        self.assertEqual(BLOCK_SIZE, self.link.blockSize())
+
+    def testReload(self):
+        accessor = StubAccessor({"/link": {"link": "/file"}, "/file": {"blockId": "2", "st_size": 5, "st_blksize": BLOCK_SIZE}})
+        self.link.accessor = self.link.link.accessor = accessor
+        self.link.path = "/link"
+        self.link.link.path = "/file"
+        self.link.reload()
+        self.assertEqual(["/link", "/file"], accessor.invalidated)
+        self.assertEqual({"blockId": "2", "st_size": 5, "st_blksize": BLOCK_SIZE}, self.link.getRecord())
+
+    def testFlushBufferedWrites(self):
+        # Over the limit of the buffer - the complete blocks are stored, the partial last one is kept
+        handle = FileHandle(1, "/link", self.link, None, writeBuffer=WriteBuffer(BLOCK_SIZE))
+        handle.writeBuffer.add(0, "a" * (BLOCK_SIZE + 4))
+        fs = StubFS(self.link)
+        DynamoFS.flushHandle.__func__(fs, "/link", handle, keepTail=True)
+        self.assertEqual([(0, "a" * BLOCK_SIZE)], fs.writes)
+        self.assertTrue(handle.writeBuffer.isDirty())
+
+if __name__ == '__main__':
+    unittest.main()
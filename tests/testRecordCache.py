@@ -0,0 +1,127 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dynamofuse.recordcache
+from dynamofuse.recordcache import RecordCache
+
+class TestRecordCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.origTime = dynamofuse.recordcache.time
+        dynamofuse.recordcache.time = lambda: self.now
+
+    def tearDown(self):
+        dynamofuse.recordcache.time = self.origTime
+
+    def record(self, version=1):
+        return {"name": "a", "path": "/d", "version": version}
+
+    def testCopies(self):
+        cache = RecordCache(10, 1)
+        attrs = self.record()
+        cache.put("/d/a", attrs)
+        attrs["version"] = 2
+        got = cache.get("/d/a")
+        self.assertEqual(1, got["version"])
+        got["version"] = 3
+        self.assertEqual(1, cache.get("/d/a")["version"])
+
+    def testTtl(self):
+        cache = RecordCache(10, 1)
+        cache.put("/d/a", self.record())
+        self.now += 1
+        self.assertIsNotNone(cache.get("/d/a"))
+        self.now += 0.5
+        self.assertIsNone(cache.get("/d/a"))
+        # Expired entries are gone
+        self.now -= 1
+        self.assertIsNone(cache.get("/d/a"))
+
+    def testDisabled(self):
+        for cache in [RecordCache(0, 1), RecordCache(10, 0)]:
+            cache.put("/d/a", self.record())
+            self.assertIsNone(cache.get("/d/a"))
+            cache.putAccess("/d", 1, 1, 1, 1, True)
+            self.assertIsNone(cache.getAccess("/d", 1, 1, 1))
+        cache = RecordCache(10, 1)
+        cache.putMissing("/d/a")
+        self.assertFalse(cache.isMissing("/d/a"))
+
+    def testLru(self):
+        cache = RecordCache(2, 1)
+        cache.put("/a", self.record())
+        cache.put("/b", self.record())
+        cache.get("/a")
+        cache.put("/c", self.record())
+        self.assertIsNotNone(cache.get("/a"))
+        self.assertIsNone(cache.get("/b"))
+        self.assertIsNotNone(cache.get("/c"))
+        self.assertEqual(2, cache.stats()["entries"])
+
+    def testMissing(self):
+        cache = RecordCache(10, 1, missingTtl=2)
+        cache.putMissing("/d/a")
+        cache.putMissing("/d/b")
+        cache.putMissing("/e/a")
+        self.assertTrue(cache.isMissing("/d/a"))
+        self.assertFalse(cache.isMissing("/d/c"))
+
+        # Created in the directory
+        cache.invalidateMissing("/d")
+        self.assertFalse(cache.isMissing("/d/a"))
+        self.assertFalse(cache.isMissing("/d/b"))
+        self.assertTrue(cache.isMissing("/e/a"))
+
+        cache.invalidate("/e/a")
+        self.assertFalse(cache.isMissing("/e/a"))
+
+        cache.putMissing("/d/a")
+        self.now += 3
+        self.assertFalse(cache.isMissing("/d/a"))
+        self.assertEqual(0, cache.stats()["missing"])
+
+    def testAccess(self):
+        cache = RecordCache(10, 1)
+        cache.put("/d", self.record(version=1))
+        cache.putAccess("/d", 1, 1, 3, 1, True)
+        cache.putAccess("/d", 2, 2, 3, 1, False)
+        self.assertTrue(cache.getAccess("/d", 1, 1, 3))
+        self.assertFalse(cache.getAccess("/d", 2, 2, 3))
+        self.assertIsNone(cache.getAccess("/d", 1, 1, 1))
+
+        # Made on an older version of the directory
+        cache.put("/d", self.record(version=2))
+        self.assertIsNone(cache.getAccess("/d", 1, 1, 3))
+
+        cache.putAccess("/d", 1, 1, 3, 2, True)
+        self.now += 2
+        self.assertIsNone(cache.getAccess("/d", 1, 1, 3))
+
+        cache.putAccess("/d", 1, 1, 3, 2, True)
+        cache.invalidate("/d")
+        self.assertIsNone(cache.getAccess("/d", 1, 1, 3))
+        self.assertEqual(0, cache.stats()["access"])
+
+    def testInvalidateTree(self):
+        cache = RecordCache(10, 1, missingTtl=1)
+        for path in ["/d", "/d/a", "/d/a/b", "/dd", "/e"]:
+            cache.put(path, self.record())
+        cache.putMissing("/d/a/c")
+        cache.putMissing("/d")
+        cache.putAccess("/d/a", 1, 1, 3, 1, True)
+        cache.invalidateTree("/d")
+        for path in ["/d", "/d/a", "/d/a/b"]:
+            self.assertIsNone(cache.get(path))
+        self.assertIsNotNone(cache.get("/dd"))
+        self.assertIsNotNone(cache.get("/e"))
+        self.assertFalse(cache.isMissing("/d/a/c"))
+        self.assertFalse(cache.isMissing("/d"))
+        self.assertIsNone(cache.getAccess("/d/a", 1, 1, 3))
+
+if __name__ == '__main__':
+    unittest.main()
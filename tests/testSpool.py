@@ -0,0 +1,189 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.spool import WriteSpool
+from errno import EAGAIN, EIO, ENOENT
+from fuse import FuseOSError
+
+class StubAccessor:
+    """Stores the spooled writes into in-memory files, failing with the given errors first"""
+    def __init__(self, errors=None):
+        self.files = dict()
+        self.owners = []
+        self.errors = list(errors or [])
+
+    def storeSpooled(self, path, offset, data, lockOwner):
+        if self.errors:
+            error = self.errors.pop(0)
+            raise error if isinstance(error, Exception) else FuseOSError(error)
+        self.owners.append(lockOwner)
+        content = self.files.setdefault(path, bytearray())
+        if len(content) < offset:
+            content.extend("\0" * (offset - len(content)))
+        content[offset:offset + len(data)] = data
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "test.spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def newSpool(self, accessor):
+        spool = WriteSpool(self.fileName, 1024 * 1024, accessor.storeSpooled)
+        spool.RETRY_DELAY = 0
+        return spool
+
+    def testReplay(self):
+        # Spooled by a mount which died before storing them
+        spool = self.newSpool(StubAccessor())
+        spool.add("/a", 0, "aaaa", 10)
+        spool.add("/b", 2, "bb", 10)
+        spool.add("/a", 2, "cc", 11)
+        spool.close()
+
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        self.assertTrue(spool.isDirty("/a"))
+        self.assertEqual((4, spool.dirtyAttrs("/a")[1]), spool.dirtyAttrs("/a"))
+        data = bytearray("0123456")
+        spool.apply("/a", data, 0)
+        self.assertEqual("aacc456", str(data))
+        spool.start()
+        spool.wait()
+        self.assertEqual({"/a": bytearray("aacc"), "/b": bytearray("\0\0bb")}, accessor.files)
+        # The owners are gone with the previous mount
+        self.assertEqual([None, None, None], accessor.owners)
+        self.assertFalse(spool.isDirty("/a"))
+        self.assertEqual(WriteSpool.FILE_HEADER_SIZE, os.path.getsize(self.fileName))
+        spool.close()
+
+        spool = self.newSpool(StubAccessor())
+        self.assertFalse(spool.pending)
+        spool.close()
+
+    def testTornTail(self):
+        spool = self.newSpool(StubAccessor())
+        spool.add("/a", 0, "aaaa")
+        spool.add("/a", 4, "bbbb")
+        spool.close()
+        size = os.path.getsize(self.fileName)
+        with open(self.fileName, "r+b") as f:
+            f.truncate(size - 1)
+
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        self.assertEqual(1, len(spool.pending))
+        self.assertEqual(size - 1 - WriteSpool.ENTRY_HEADER.size - len("/a") - 3, os.path.getsize(self.fileName))
+        spool.add("/a", 4, "cccc")
+        spool.start()
+        spool.wait("/a")
+        self.assertEqual(bytearray("aaaacccc"), accessor.files["/a"])
+        spool.close()
+
+    def testLockOwner(self):
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        spool.start()
+        spool.add("/a", 0, "a", 5)
+        spool.wait()
+        self.assertEqual([5], accessor.owners)
+        spool.close()
+
+    def testRetry(self):
+        accessor = StubAccessor([EAGAIN, EIO])
+        spool = self.newSpool(accessor)
+        spool.start()
+        spool.add("/a", 0, "aaaa")
+        spool.wait("/a")
+        self.assertEqual(bytearray("aaaa"), accessor.files["/a"])
+        spool.checkError("/a")
+        spool.close()
+
+    def testRetriesExhausted(self):
+        accessor = StubAccessor([EIO] * WriteSpool.MAX_STORE_RETRIES)
+        spool = self.newSpool(accessor)
+        spool.start()
+        spool.add("/a", 0, "aaaa")
+        spool.add("/b", 0, "bbbb")
+        spool.wait()
+        self.assertNotIn("/a", accessor.files)
+        self.assertEqual(bytearray("bbbb"), accessor.files["/b"])
+        with self.assertRaises(FuseOSError) as e:
+            spool.checkError("/a")
+        self.assertEqual(EIO, e.exception.errno)
+        # Reported once
+        spool.checkError("/a")
+        spool.checkError("/b")
+        spool.close()
+
+    def testOtherErrorsExhausted(self):
+        accessor = StubAccessor([ValueError("throttled")] * WriteSpool.MAX_STORE_RETRIES)
+        spool = self.newSpool(accessor)
+        spool.start()
+        spool.add("/a", 0, "aaaa")
+        spool.wait()
+        self.assertNotIn("/a", accessor.files)
+        with self.assertRaises(FuseOSError):
+            spool.checkError("/a")
+        spool.close()
+
+    def testUnicodePath(self):
+        path = u"/\u0444\u0430\u0439\u043b"
+        data = "\xff\x00abc"
+        spool = self.newSpool(StubAccessor())
+        spool.add(path, 0, data, 1)
+        self.assertTrue(spool.isDirty(path))
+        spool.close()
+
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        self.assertTrue(spool.isDirty(path))
+        spool.start()
+        spool.wait(path)
+        self.assertEqual({path: bytearray(data)}, accessor.files)
+        self.assertEqual(WriteSpool.FILE_HEADER_SIZE, os.path.getsize(self.fileName))
+        spool.close()
+
+    def testDroppedWithoutFile(self):
+        accessor = StubAccessor([ENOENT])
+        spool = self.newSpool(accessor)
+        spool.start()
+        spool.add("/a", 0, "aaaa")
+        spool.wait()
+        self.assertNotIn("/a", accessor.files)
+        spool.checkError("/a")
+        spool.close()
+
+    def testCompact(self):
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        for i in range(20):
+            spool.add("/a", i * 10, "%010d" % i)
+        spool.maxBytes = 100
+        # Stores the first half of the writes, the file is compacted past them
+        for i in range(10):
+            (seq, path, offset, mtime, data, lockOwner) = spool.pending[0]
+            spool.storeWrite(path, offset, data, lockOwner)
+            spool.removePending()
+        self.assertTrue(os.path.getsize(self.fileName) < WriteSpool.FILE_HEADER_SIZE + 20 * (WriteSpool.ENTRY_HEADER.size + 12))
+        spool.close()
+
+        accessor = StubAccessor()
+        spool = self.newSpool(accessor)
+        self.assertEqual(10, len(spool.pending))
+        spool.start()
+        spool.wait()
+        self.assertEqual(bytearray("\0" * 100 + "".join("%010d" % i for i in range(10, 20))), accessor.files["/a"])
+        spool.close()
+
+if __name__ == '__main__':
+    unittest.main()
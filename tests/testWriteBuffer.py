@@ -0,0 +1,74 @@
+__author__ = 'Denis Mikhalkin'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dynamofuse.writebuffer import WriteBuffer
+
+class TestWriteBuffer(unittest.TestCase):
+
+    def extents(self, buffer):
+        return [(offset, str(data)) for (offset, data) in buffer.extents]
+
+    def testSequentialWritesMerged(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(0, "aaaa")
+        buffer.add(4, "bbbb")
+        buffer.add(8, "cc")
+        self.assertEqual([(0, "aaaabbbbcc")], self.extents(buffer))
+        self.assertEqual(10, buffer.size)
+        self.assertEqual(10, buffer.end())
+
+    def testSeparateExtentsSorted(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(20, "cc")
+        buffer.add(0, "aa")
+        buffer.add(10, "bb")
+        self.assertEqual([(0, "aa"), (10, "bb"), (20, "cc")], self.extents(buffer))
+        self.assertEqual(6, buffer.size)
+
+    def testOverlappingWriteWins(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(0, "aaaa")
+        buffer.add(6, "cccc")
+        buffer.add(2, "bbbbb")
+        self.assertEqual([(0, "aabbbbbccc")], self.extents(buffer))
+        self.assertEqual(10, buffer.size)
+
+    def testWriteBeforeExtent(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(4, "bbbb")
+        buffer.add(0, "aaaa")
+        self.assertEqual([(0, "aaaabbbb")], self.extents(buffer))
+        buffer.add(10, "dd")
+        buffer.add(7, "ccc")
+        self.assertEqual([(0, "aaaabbbcccdd")], self.extents(buffer))
+        self.assertEqual(12, buffer.size)
+
+    def testLimit(self):
+        buffer = WriteBuffer(8)
+        self.assertFalse(buffer.add(0, "aaaa"))
+        self.assertFalse(buffer.add(0, ""))
+        self.assertTrue(buffer.add(4, "bbbb"))
+
+    def testApply(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(2, "aa")
+        buffer.add(8, "bbbb")
+        data = bytearray("0123456789")
+        buffer.apply(data, 1)
+        self.assertEqual("0aa3456bbb", str(data))
+
+    def testTakeKeepsPartialBlock(self):
+        buffer = WriteBuffer(1024)
+        buffer.add(0, "a" * 10)
+        self.assertEqual([(0, "a" * 8)], buffer.take(4))
+        self.assertEqual([(8, "aa")], self.extents(buffer))
+        self.assertEqual(2, buffer.size)
+        self.assertEqual([(8, "aa")], buffer.take())
+        self.assertFalse(buffer.isDirty())
+
+if __name__ == '__main__':
+    unittest.main()